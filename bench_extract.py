@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Замер разбора сохранённых страниц DeviantArt: extract_page (быстрый путь
+без DOM, soup только если картинок не нашлось) против полного BeautifulSoup.
+Страницы сохраняются из браузера («Сохранить как», только HTML) или curl'ом.
+--synthetic добавляет сгенерированную страницу ~4.7 МБ (длинное тело и
+большое состояние на 8000 работ) — та, на которой сделаны замеры в описании
+изменений.
+
+  python bench_extract.py pages/ [ещё.html ...] [--repeat 5] [--synthetic]
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+from statistics import median
+
+import deviantart_dl as da
+
+
+def collect_pages(inputs: list[str]) -> list[Path]:
+    pages: list[Path] = []
+    for raw in inputs:
+        p = Path(raw)
+        if p.is_dir():
+            pages.extend(sorted(p.glob("*.htm*")))
+        elif p.is_file():
+            pages.append(p)
+    return pages
+
+
+SYNTHETIC_URL = "https://www.deviantart.com/x/art/Merchant-1104774946"
+
+
+def synthetic_page(divs: int = 20000, works: int = 8000) -> str:
+    """Страница как у DeviantArt по форме: og-мета, длинный DOM, __INITIAL_STATE__ в конце."""
+    head = (
+        '<!DOCTYPE html><html><head><meta charset="utf-8">'
+        '<meta property="og:title" content="Merchant &amp; wolf by X">'
+        f'<meta property="og:url" content="{SYNTHETIC_URL}">'
+        '<meta property="og:image" content="https://images-wixmp.com/main.jpg?token=a&amp;b=1">'
+        '<meta name="twitter:title" content="tw"><script>var a=1;</script></head><body>'
+    )
+    body = "".join(f"<div class='c{i}'><span>text {i}</span><img src='/a/{i}.svg'></div>" for i in range(divs))
+    state = {"@@entities": {"deviation": {
+        str(i): {
+            "title": f"Work {i}",
+            "url": f"https://www.deviantart.com/u/art/w-{i}",
+            "media": {"baseUri": f"https://images-wixmp.com/f/{i}.jpg",
+                      "types": [{"t": "fullview", "src": f"https://images-wixmp.com/f/{i}/full.png"}]},
+            "blob": "x" * 200,
+        } for i in range(works)
+    }}}
+    return f"{head}{body}<script>window.__INITIAL_STATE__ = {json.dumps(state)};</script></body></html>"
+
+
+def timed(fn, page: str, url: str, repeat: int) -> tuple[float, tuple]:
+    """Медиана времени одного разбора (мс) и результат."""
+    times = []
+    result = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = fn(page, url)
+        times.append((time.perf_counter() - t0) * 1000)
+    return median(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк разбора страниц DeviantArt")
+    parser.add_argument("inputs", nargs="*", help="HTML-файлы или папки с ними")
+    parser.add_argument("--repeat", type=int, default=5, help="Повторов на страницу")
+    parser.add_argument("--synthetic", action="store_true", help="Добавить сгенерированную страницу")
+    args = parser.parse_args()
+
+    pages: list[tuple[str, str]] = [(p.name, p.read_text(encoding="utf-8", errors="replace"))
+                                    for p in collect_pages(args.inputs)]
+    if args.synthetic:
+        pages.append(("synthetic", synthetic_page()))
+    if not pages:
+        raise SystemExit("Не найдено ни одной страницы (*.html); можно взять --synthetic.")
+
+    total_fast = total_soup = 0.0
+    mismatched = 0
+    for name, page in pages:
+        # og:url страницы — по нему ищется объект работы в состоянии
+        url = da.extract_from_meta_fast(page)[1] or "https://www.deviantart.com/deviation/0"
+        fast_ms, fast = timed(da.extract_page, page, url, args.repeat)
+        soup_ms, soup = timed(da.extract_page_soup, page, url, args.repeat)
+        total_fast += fast_ms
+        total_soup += soup_ms
+        # главное совпадение — заголовок, ссылка и первая (основная) картинка
+        same = fast[:2] == soup[:2] and fast[2][:1] == soup[2][:1]
+        mismatched += not same
+        print(f"{name}: {len(page) / 1024:.0f} КиБ, быстро {fast_ms:.1f} мс, soup {soup_ms:.1f} мс, "
+              f"x{soup_ms / max(fast_ms, 1e-6):.1f}{'' if same else '  [РАЗНЫЕ РЕЗУЛЬТАТЫ]'}")
+        if not same:
+            print(f"    быстро: {fast[0]!r} {fast[1]!r} {fast[2][:1]}")
+            print(f"    soup:   {soup[0]!r} {soup[1]!r} {soup[2][:1]}")
+
+    print(f"Итого {len(pages)} стр.: быстро {total_fast:.1f} мс, soup {total_soup:.1f} мс, "
+          f"x{total_soup / max(total_fast, 1e-6):.1f}; расхождений: {mismatched}")
+    sys.exit(1 if mismatched else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,4 @@
 import asyncio
-import json
 import os
 import random
 import re
@@ -8,22 +7,37 @@ import time
 import html
 import logging
 import base64
-import subprocess
+import functools
+import hashlib
 import sys
-from dataclasses import dataclass
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
-from typing import Optional
+from typing import Callable, Container, Optional
 from datetime import datetime
 
 from aiogram.client.default import DefaultBotProperties
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command, CommandObject
-from aiogram.types import Message, FSInputFile
+from aiogram.types import Message, FSInputFile, InputMediaPhoto
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest
 from dotenv import load_dotenv
 from pathlib import Path
 from urllib.parse import urlparse
 
+from image_dedup import AVAILABLE as PHASH_AVAILABLE, PerceptualIndex, image_hash
+from image_prep import (AVAILABLE as PREP_AVAILABLE, INDEX_NAME, PREP_DIR, PREP_MAX_SIDE, PREP_QUALITY,
+                        VariantIndex, decode_problem, drop_variants, prepare_photo, prepared_path, process_pool,
+                        prune_dir, sweep_variants, thumb_path)
+from name_search import NameIndex
+from post_schedule import Schedule, humanize_seconds, parse_duration, parse_schedule
+from selection import ItemInfo, Selector, make_selector, parse_weights
+from send_queue import PRIORITY_BACKGROUND, PRIORITY_POST, SendQueue, send_priority
+from state_store import StateStore
+
 # ---------- Конфиг ----------
 
 load_dotenv()
@@ -62,25 +76,71 @@ def _out_dir_for_current_bot() -> Path:
 DEFAULT_TAGS = [t.strip() for t in os.getenv("DEFAULT_TAGS", "").split(",") if t.strip()]
 MAX_TAGS = int(os.getenv("MAX_TAGS", "8"))
 BOT_TOKEN = os.getenv("BOT_TOKEN", "").strip()
-CHANNEL_ID = os.getenv("CHANNEL_ID", "").strip()
+# Можно несколько каналов через запятую: первый получает загрузку файла, остальные — тот же file_id
+CHANNEL_IDS = [c for c in re.split(r"[,;\s]+", os.getenv("CHANNEL_ID", "")) if c]
+CHANNEL_ID = CHANNEL_IDS[0] if CHANNEL_IDS else ""
+FANOUT_POLICY = os.getenv("FANOUT_POLICY", "all").strip().lower()    # all | primary | any — когда считать пост успешным
+CHAT_MIN_INTERVAL_SEC = float(os.getenv("CHAT_MIN_INTERVAL_SEC", "3"))  # пауза между отправками в один канал/группу
+# Лимиты Telegram для всех исходящих (send_queue.py): сообщений в секунду всего, пауза в личном чате, повторы после flood control
+TG_GLOBAL_RATE = float(os.getenv("TG_GLOBAL_RATE", "30"))
+TG_PRIVATE_INTERVAL_SEC = float(os.getenv("TG_PRIVATE_INTERVAL_SEC", "1"))
+TG_SEND_RETRIES = int(os.getenv("TG_SEND_RETRIES", "5"))
+PREFETCH_LEAD_SEC = int(os.getenv("PREFETCH_LEAD_SEC", "120"))   # за сколько до поста готовить следующий (0 — выкл.)
+STAGING_CHAT_ID = os.getenv("STAGING_CHAT_ID", "").strip()       # приватный чат для предзагрузки (получаем file_id заранее)
+PHOTO_MAX_BYTES = 10 * 1024 * 1024                               # лимит Telegram для send_photo
+DOCUMENT_MAX_BYTES = 50 * 1024 * 1024                            # лимит Telegram для send_document
+# Подготовка перед загрузкой (нужен Pillow): большие/огромные оригиналы уменьшаются в пуле процессов,
+# копии кэшируются в PREP_DIR по хэшу содержимого (PREP_DIR, PREP_MAX_SIDE, PREP_QUALITY — в image_prep.py,
+# их же используют загрузчики, готовящие копии сразу после скачивания)
+PREP_ENABLED = PREP_AVAILABLE and os.getenv("PREP", "1").strip() != "0"
+PREP_WORKERS = max(1, int(os.getenv("PREP_WORKERS", "1")))
+PREP_CACHE_MAX_MB = int(os.getenv("PREP_CACHE_MAX_MB", "500"))
+# Если фото не принято (или его не подготовить) — отправить оригинал документом вместо ошибки
+PHOTO_FALLBACK_DOCUMENT = os.getenv("PHOTO_FALLBACK_DOCUMENT", "0").strip() != "0"
+# Альбомы: страницы одной работы (_p0, _p1, ...) из очереди уходят одним send_media_group (до 10 штук)
+ALBUM_MODE = os.getenv("ALBUM_MODE", "0").strip() != "0"
+ALBUM_MAX = max(2, min(10, int(os.getenv("ALBUM_MAX", "10"))))
+# Что делать со слотами, пропущенными больше чем на интервал (простой бота, долгая отправка):
+#   once — один пост сразу, дальше по сетке; skip — ждать следующий слот; catchup — допостить пропущенные
+MISSED_SLOT_POLICY = os.getenv("MISSED_SLOT_POLICY", "once").strip().lower()
+MAX_CATCHUP_POSTS = int(os.getenv("MAX_CATCHUP_POSTS", "3"))
 IMAGES_DIR = Path(os.getenv("IMAGES_DIR", "./imagesartbot")).resolve()
 USED_DIR = Path(os.getenv("USED_DIR", "./imagesartbot_used")).resolve()
+DUPES_DIR = Path(os.getenv("DUPES_DIR", str(USED_DIR / "dupes"))).resolve()   # сюда уходят уже публиковавшиеся
+SKIP_POSTED = os.getenv("SKIP_POSTED", "1").strip() != "0"                    # сверять выбор с историей публикаций
+# Проверка очереди в фоне: в выбор попадают только файлы, прошедшие проверку (сигнатура, размер, декодирование);
+# негодные уходят в карантин. Свежие (моложе VALIDATE_SETTLE_SEC) не трогаем — их могут ещё дописывать
+VALIDATE = os.getenv("VALIDATE", "1").strip() != "0"
+VALIDATE_WORKERS = max(1, int(os.getenv("VALIDATE_WORKERS", "2")))
+VALIDATE_SETTLE_SEC = int(os.getenv("VALIDATE_SETTLE_SEC", "60"))
+QUARANTINE_DIR = Path(os.getenv("QUARANTINE_DIR", str(USED_DIR / "quarantine"))).resolve()
+# Почти-дубликаты по перцептивному хэшу (нужны numpy + Pillow): dhash | phash, порог — расстояние Хэмминга из 64 бит
+PHASH_ENABLED = PHASH_AVAILABLE and os.getenv("PHASH", "1").strip() != "0"
+PHASH_METHOD = os.getenv("PHASH_METHOD", "dhash").strip().lower()
+PHASH_MAX_DIST = int(os.getenv("PHASH_MAX_DIST", "6"))
+# Как выбирать следующий пост: random | weighted | fifo | bag (см. selection.py)
+PICK_STRATEGY = os.getenv("PICK_STRATEGY", "random").strip().lower()
+PICK_WEIGHTS = parse_weights(os.getenv("PICK_WEIGHTS", ""))      # для weighted: "tag:foo=3, source:pixiv.net=0.5"
+AUTHOR_COOLDOWN = int(os.getenv("AUTHOR_COOLDOWN", "0"))         # сколько постов подряд не повторять автора (0 — выкл.)
 DEFAULT_INTERVAL_STR = os.getenv("DEFAULT_INTERVAL", "30m").strip()
+DEFAULT_SCHEDULE_STR = os.getenv("DEFAULT_SCHEDULE", "").strip()   # напр. "cron */30 9-23 * * *"; пусто — DEFAULT_INTERVAL
 ADMINS = {int(x) for x in re.findall(r"-?\d+", os.getenv("ADMINS", ""))}
+DL_WORKERS = max(1, int(os.getenv("DL_WORKERS", "2")))        # сколько загрузок идёт параллельно
+DL_JOBS_KEEP = max(1, int(os.getenv("DL_JOBS_KEEP", "50")))   # сколько задач помним для /jobs
+INDEX_RECONCILE_SEC = int(os.getenv("INDEX_RECONCILE_SEC", "300"))  # как часто сверять индекс с диском
+META_CACHE_SIZE = int(os.getenv("META_CACHE_SIZE", "4096"))          # сколько имён файлов держим в кэше метаданных
 
-STATE_FILE = Path("./state.json")
+STATE_DB = Path("./state.db")                                # состояние, история, кэш file_id (SQLite)
+STATE_FILE = STATE_DB.with_name("state.json")                # старые JSON-файлы: переносятся в state.db при старте
+FILE_ID_CACHE_FILE = STATE_DB.with_name("file_ids.json")
+FILE_ID_CACHE_SIZE = int(os.getenv("FILE_ID_CACHE_SIZE", "5000"))
 
 ALLOWED_EXT = {".jpg", ".jpeg", ".png", ".webp", ".gif", ".bmp"}
 
 if not BOT_TOKEN or not CHANNEL_ID:
     raise RuntimeError("Заполни BOT_TOKEN и CHANNEL_ID в .env")
-
-# ---------- Утилиты ----------
-
-DURATION_RE = re.compile(
-    r"^\s*(?:(\d+)\s*d)?\s*(?:(\d+)\s*h)?\s*(?:(\d+)\s*m)?\s*(?:(\d+)\s*s)?\s*$",
-    re.IGNORECASE,
-)
+if FANOUT_POLICY not in ("all", "primary", "any"):
+    raise RuntimeError(f"Неизвестная FANOUT_POLICY «{FANOUT_POLICY}», доступны: all, primary, any")
 
 # ---------- Логгирование ----------
 logging.basicConfig(
@@ -94,69 +154,252 @@ if not BOT_TOKEN or not CHANNEL_ID:
     logger.error("BOT_TOKEN или CHANNEL_ID не заданы в .env")
     raise RuntimeError("Заполни BOT_TOKEN и CHANNEL_ID в .env")
 else:
-    logger.info("Бот запущен. Канал: %s", CHANNEL_ID)
-
-def parse_duration(s: str) -> int:
-    """
-    '90' -> 90 sec
-    '10m' -> 600
-    '2h30m' -> 9000
-    '1d' -> 86400
-    """
-    s = s.strip().lower()
-    if s.isdigit():
-        return int(s)
-    m = DURATION_RE.match(s)
-    if not m:
-        raise ValueError("Не смог понять интервал. Примеры: 45, 10m, 2h30m, 1d.")
-    d, h, mnt, sec = (int(x) if x else 0 for x in m.groups())
-    total = d * 86400 + h * 3600 + mnt * 60 + sec
-    if total <= 0:
-        raise ValueError("Интервал должен быть больше 0 секунд.")
-    return total
-
-def humanize_seconds(sec: int) -> str:
-    d, r = divmod(sec, 86400)
-    h, r = divmod(r, 3600)
-    m, s = divmod(r, 60)
-    parts = []
-    if d: parts.append(f"{d}d")
-    if h: parts.append(f"{h}h")
-    if m: parts.append(f"{m}m")
-    if s or not parts: parts.append(f"{s}s")
-    return "".join(parts)
+    logger.info("Бот запущен. Каналы: %s (политика: %s)", ", ".join(CHANNEL_IDS), FANOUT_POLICY)
 
-def list_images() -> list[Path]:
-    if not IMAGES_DIR.exists():
-        IMAGES_DIR.mkdir(parents=True, exist_ok=True)
-    return [p for p in IMAGES_DIR.iterdir() if p.is_file() and p.suffix.lower() in ALLOWED_EXT]
+# ---------- Утилиты ----------
 
-def count_images_in(dir_path: Path) -> int:
+def scan_image_names(dir_path: Path) -> set[str]:
+    """Полный проход по папке (scandir без лишних stat). Вызывать не из event loop."""
     if not dir_path.exists():
-        return 0
-    return sum(1 for p in dir_path.iterdir() if p.is_file() and p.suffix.lower() in ALLOWED_EXT)
+        return set()
+    with os.scandir(dir_path) as it:
+        return {e.name for e in it
+                if e.is_file() and os.path.splitext(e.name)[1].lower() in ALLOWED_EXT}
 
-def move_used(src: Path) -> Path:
+class ImageIndex:
+    """
+    Индекс картинок одной папки в памяти: строится один раз при старте,
+    дальше обновляется точечно (move_used, загрузки) и периодической сверкой.
+    Подсчёт и проверка наличия — O(1); выбор — через selector (O(log n)),
+    если он задан, иначе равномерно за O(1). search — поиск по имени для /post и /find.
+    admit — если задан, новые файлы при сверке не добавляются сразу, а
+    передаются ему списком (проверка); он сам вызывает add для годных.
+    pending — имена, уже переданные admit и ещё не решённые: сверка их не трогает.
+    """
+
+    def __init__(self, folder: Path, selector: Optional[Selector] = None, search: Optional[NameIndex] = None,
+                 admit: Optional[Callable[[list[Path]], None]] = None):
+        self.folder = folder
+        self.selector = selector
+        self.search = search
+        self.admit = admit
+        self.pending: Container[str] = frozenset()
+        self._items: list[Path] = []
+        self._pos: dict[str, int] = {}
+        self._works: dict[str, set[str]] = {}    # work_key -> имена файлов этой работы в папке
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self._pos
+
+    def add(self, path: Path) -> None:
+        if path.name in self._pos or path.suffix.lower() not in ALLOWED_EXT:
+            return
+        self._pos[path.name] = len(self._items)
+        self._items.append(self.folder / path.name)
+        key = work_of(path)[0]
+        if key:
+            self._works.setdefault(key, set()).add(path.name)
+        if self.selector is not None:
+            self.selector.add(item_info(self.folder / path.name, self.selector.uses_mtime))
+        if self.search is not None:
+            self.search.add(path.name, search_terms(path))
+
+    def discard(self, name: str) -> None:
+        i = self._pos.pop(name, None)
+        if i is None:
+            return
+        key = work_of(self._items[i])[0]
+        names = self._works.get(key)
+        if names is not None:
+            names.discard(name)
+            if not names:
+                del self._works[key]
+        if self.selector is not None:
+            self.selector.discard(name)
+        if self.search is not None:
+            self.search.discard(name)
+        # O(1): на место удалённого ставим последний элемент
+        last = self._items.pop()
+        if i < len(self._items):
+            self._items[i] = last
+            self._pos[last.name] = i
+
+    def has_work(self, work_key: str) -> bool:
+        return work_key in self._works
+
+    def work_files(self, work_key: str) -> list[Path]:
+        """Файлы работы в папке по номеру страницы (для альбомов)."""
+        paths = [self.folder / n for n in self._works.get(work_key, ())]
+        return sorted(paths, key=lambda p: (work_of(p)[1], p.name))
+
+    def pick(self, exclude: set[str] = frozenset()) -> Optional[Path]:
+        """Следующий кандидат по стратегии; exclude — имена, уже отвергнутые в этом выборе."""
+        if self.selector is not None:
+            name = self.selector.pick(exclude)
+            return self.folder / name if name else None
+        items = [p for p in self._items if p.name not in exclude] if exclude else self._items
+        return random.choice(items) if items else None
+
+    def paths(self) -> list[Path]:
+        return list(self._items)
+
+    def sync(self, names: set[str]) -> tuple[int, int]:
+        """Приводит индекс к списку имён с диска. Возвращает (добавлено, удалено)."""
+        gone = [n for n in self._pos if n not in names]
+        for n in gone:
+            self.discard(n)
+        new = [self.folder / n for n in names if n not in self._pos and n not in self.pending]
+        if self.admit is not None:
+            if new:
+                self.admit(new)
+        else:
+            for p in new:
+                self.add(p)
+        return len(new), len(gone)
+
+    async def reconcile(self) -> tuple[int, int]:
+        names = await asyncio.to_thread(scan_image_names, self.folder)
+        return self.sync(names)
+
+pending_index = ImageIndex(IMAGES_DIR, make_selector(PICK_STRATEGY, PICK_WEIGHTS, AUTHOR_COOLDOWN), NameIndex())
+used_index = ImageIndex(USED_DIR)
+
+def list_images() -> list[Path]:
+    return pending_index.paths()
+
+async def move_used(src: Path) -> Path:
     USED_DIR.mkdir(parents=True, exist_ok=True)
     # чтобы избежать коллизий имен — добавим timestamp
     ts = int(time.time())
     dst = USED_DIR / f"{src.stem}_{ts}{src.suffix.lower()}"
     shutil.move(str(src), str(dst))
+    pending_index.discard(src.name)
+    used_index.add(dst)
+    if PHASH_ENABLED:
+        phash_index.rename(str(src), str(dst))
+    await asyncio.to_thread(_store_moved, src, dst)
     return dst
 
-def load_state() -> dict:
-    if STATE_FILE.exists():
+def _store_moved(src: Path, dst: Path) -> None:
+    """Записи state.db о файле, переехавшем из очереди в used. Вызывать не из event loop."""
+    state_store.check_drop(str(src))
+    if PHASH_ENABLED:
+        state_store.phash_rename(str(src), str(dst), dst.stat().st_mtime_ns)
+
+def _store_dropped(src: Path) -> None:
+    """Записи state.db о файле, убранном из очереди не в used (дубликат, карантин). Вызывать не из event loop."""
+    state_store.check_drop(str(src))
+    state_store.phash_drop(str(src))
+
+SAVED_LINE_RE = re.compile(r"^Saved: (.+)$", re.MULTILINE)
+
+def index_saved_files(output: str) -> list[Path]:
+    """Добавляет в индекс файлы из строк «Saved: ...» вывода загрузчиков. Возвращает добавленные."""
+    added = []
+    for m in SAVED_LINE_RE.finditer(output or ""):
+        p = Path(m.group(1).strip())
+        if p.parent == IMAGES_DIR and p.name not in pending_index and p.name not in pending_index.pending:
+            added.append(p)
+    if pending_index.admit is not None:
+        if added:
+            pending_index.admit(added)
+    else:
+        for p in added:
+            pending_index.add(p)
+    return added
+
+async def index_reconcile_loop():
+    """Дешёвая периодическая сверка индексов с диском (на случай ручных правок папок)."""
+    while True:
+        await asyncio.sleep(INDEX_RECONCILE_SEC)
         try:
-            return json.loads(STATE_FILE.read_text(encoding="utf-8"))
-        except Exception:
-            pass
-    return {}
+            for idx in (pending_index, used_index):
+                added, removed = await idx.reconcile()
+                if added or removed:
+                    logger.info("Индекс %s: +%d / -%d", idx.folder, added, removed)
+            if PREP_ENABLED and PREP_DIR.exists():
+                await prune_prepared()
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error("Ошибка сверки индекса: %s", e)
+
+async def prune_prepared() -> None:
+    """
+    Копии и превью пишут и загрузчики: убираем те, чьи файлы ушли из очереди
+    (и их записи в индексе), и держим PREP_DIR в пределах PREP_CACHE_MAX_MB.
+    """
+    if IMAGES_DIR.exists():
+        dropped = await asyncio.to_thread(sweep_variants, variant_index, IMAGES_DIR)
+        if dropped:
+            logger.info("Подготовленные копии: убрано %d записей для файлов вне очереди", dropped)
+    await asyncio.to_thread(prune_dir, PREP_DIR, PREP_CACHE_MAX_MB * 1024 * 1024)
+
+state_store = StateStore(STATE_DB)
+for _name in state_store.import_legacy(STATE_FILE, FILE_ID_CACHE_FILE):
+    logger.info("Перенесено в %s: %s", STATE_DB, _name)
+
+def load_state() -> dict:
+    return state_store.get_all()
 
 def save_state(state: dict) -> None:
-    STATE_FILE.write_text(json.dumps(state, ensure_ascii=False, indent=2), encoding="utf-8")
+    """Атомарно обновляет только переданные ключи (остальное состояние не трогаем)."""
+    state_store.set_many(state)
+
+# --------- Кэш file_id (чтобы не грузить одни и те же байты повторно) ---------
+
+def file_sha256(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+@functools.lru_cache(maxsize=META_CACHE_SIZE)
+def _sha256_by_stat(path_str: str, size: int, mtime_ns: int) -> str:
+    return file_sha256(Path(path_str))
+
+def content_hash(path: Path) -> str:
+    """sha256 файла, кэшируется по (путь, размер, mtime). Вызывать не из event loop."""
+    st = path.stat()
+    return _sha256_by_stat(str(path), st.st_size, st.st_mtime_ns)
+
+class FileIdCache:
+    """
+    Хэш содержимого -> file_id уже загруженного в Telegram фото.
+    LRU на max_size записей, хранится в state.db.
+    Протухшие file_id выкидываются при первой неудачной отправке (drop).
+    """
+
+    def __init__(self, store: StateStore, max_size: int):
+        self.store = store
+        self.max_size = max_size
+
+    def __len__(self) -> int:
+        return self.store.file_id_count()
+
+    def get(self, digest: str) -> Optional[str]:
+        return self.store.file_id_get(digest)
+
+    def put(self, digest: str, file_id: str) -> None:
+        self.store.file_id_put(digest, file_id, self.max_size)
+
+    def drop(self, digest: str) -> None:
+        self.store.file_id_drop(digest)
+
+file_id_cache = FileIdCache(state_store, FILE_ID_CACHE_SIZE)
 
 # --------- Парсинг имени файла ---------
 
+UNDERSCORES_RE = re.compile(r"_+")
+SOURCE_RE = re.compile(r"\(([^)]+)\)")
+TAGS_RE = re.compile(r"\[([^\]]+)\]")
+TAG_SPLIT_RE = re.compile(r"[,\s]+")
+AUTHOR_TITLE_RE = re.compile(r"(.+?)\s*-\s*(.+)$")
+
 def _decode_source_token(token: str) -> str:
     """
     Преобразует токен из круглых скобок в нормальный URL.
@@ -186,7 +429,7 @@ def _decode_source_token(token: str) -> str:
     if "___" in token:
         t = token.replace("___", "://", 1)
         # заменим оставшиеся "_" на "/"
-        t = re.sub(r"_+", "/", t)
+        t = UNDERSCORES_RE.sub("/", t)
         return t if t.startswith(("http://", "https://")) else "https://" + t
 
     # 4) Простой формат: домен_путь (без протокола)
@@ -212,52 +455,67 @@ def parse_filename_meta(image_path: Path) -> dict:
       [tag1, tag-two another]  — теги
       (https___pixiv_net)      — источник (Windows-friendly)
       author - title           — если есть, иначе всё оставшееся — title
+    Результат целиком определяется именем файла, поэтому кэшируется (LRU по stem).
     """
-    name = image_path.stem.strip()
+    return _meta_for_stem(image_path.stem)
+
+
+def _meta_for_stem(stem: str) -> dict:
+    # каждый раз новый dict: вызывающие могут его менять, кэш при этом не портится
+    title, author_name, source_url, tags = _parse_stem_meta(stem)
+    return {
+        "title": title,
+        "author_name": author_name,
+        "source_url": source_url,
+        "tags": list(tags),
+    }
+
+
+@functools.lru_cache(maxsize=META_CACHE_SIZE)
+def _parse_stem_meta(stem: str) -> tuple[str, str, str, tuple[str, ...]]:
+    name = stem.strip()
 
     # Собираем все ( ... ) и [ ... ] где угодно в строке, вырезая их
     tags: list[str] = []
     source_url = ""
 
     # 1) ссылки в круглых
-    for m in re.finditer(r"\(([^)]+)\)", name):
+    for m in SOURCE_RE.finditer(name):
         token = m.group(1).strip()
         url = _decode_source_token(token)
         if url and not source_url:  # берём первую осмысленную
             source_url = url
-    name = re.sub(r"\([^)]+\)", "", name).strip()
+    name = SOURCE_RE.sub("", name).strip()
 
     # 2) теги в квадратных
-    for m in re.finditer(r"\[([^\]]+)\]", name):
+    for m in TAGS_RE.finditer(name):
         raw = m.group(1).strip()
-        pieces = [p.strip() for p in re.split(r"[,\s]+", raw) if p.strip()]
+        pieces = [p.strip() for p in TAG_SPLIT_RE.split(raw) if p.strip()]
         tags.extend(pieces)
-    name = re.sub(r"\[[^\]]+\]", "", name).strip()
+    name = TAGS_RE.sub("", name).strip()
 
     # 3) author - title (опционально)
     author_name = ""
     title = ""
-    m_at = re.match(r"(.+?)\s*-\s*(.+)$", name)
+    m_at = AUTHOR_TITLE_RE.match(name)
     if m_at:
         author_name = m_at.group(1).strip()
         title = m_at.group(2).strip()
     else:
         title = name.strip()
 
-    return {
-        "title": title,
-        "author_name": author_name,
-        "source_url": source_url,
-        "tags": tags,
-    }
+    return title, author_name, source_url, tuple(tags)
 
 
 # --------- Вспомогательные для подписи ---------
 
+TAG_CLEAN_RE = re.compile(r"[^a-z0-9_а-яё]")
+
+@functools.lru_cache(maxsize=META_CACHE_SIZE)
 def _sanitize_tag(tag: str) -> str:
     # хештег: нижний регистр, пробелы -> _, оставляем буквы/цифры/_
     t = str(tag).strip().lower().replace(" ", "_")
-    return re.sub(r"[^a-z0-9_а-яё]", "", t)
+    return TAG_CLEAN_RE.sub("", t)
 
 def _domain(u: str) -> str:
     try:
@@ -299,14 +557,128 @@ def build_caption_from_meta(meta: dict, default_tags: list[str] = None, max_tags
     return caption
 
 
+def get_meta(image_path: Path) -> dict:
+    """Метаданные файла из кэша (общий вход для постинга и команд со списками)."""
+    return parse_filename_meta(image_path)
+
+def get_caption(image_path: Path) -> str:
+    """Готовая подпись с DEFAULT_TAGS/MAX_TAGS, кэшируется по имени файла."""
+    return _caption_for_stem(image_path.stem)
+
+@functools.lru_cache(maxsize=META_CACHE_SIZE)
+def _caption_for_stem(stem: str) -> str:
+    meta = _meta_for_stem(stem)
+    return build_caption_from_meta(meta, default_tags=DEFAULT_TAGS, max_tags=MAX_TAGS)
+
+
+# --------- Ключ работы (для истории и дедупликации) ---------
+
+PIXIV_WORK_RE = re.compile(r"pixiv\.net/(?:[a-z]{2}/)?artworks/(\d+)", re.I)
+DA_WORK_RE = re.compile(r"deviantart\.com/(?:deviation/|.+?/art/.+?-)(\d+)", re.I)
+PAGE_RE = re.compile(r"_p(\d+)(?: \(\d+\))?$")
+
+def work_key_for_url(url: str) -> str:
+    """pixiv:<id> / deviantart:<id>, для остальных — URL без схемы и www. Пусто, если URL нет."""
+    if not url:
+        return ""
+    m = PIXIV_WORK_RE.search(url)
+    if m:
+        return f"pixiv:{m.group(1)}"
+    m = DA_WORK_RE.search(url)
+    if m:
+        return f"deviantart:{m.group(1)}"
+    u = urlparse(url)
+    netloc = u.netloc.lower()
+    if netloc.startswith("www."):
+        netloc = netloc[4:]
+    return f"{netloc}{u.path.rstrip('/')}".lower()
+
+@functools.lru_cache(maxsize=META_CACHE_SIZE)
+def _work_of_stem(stem: str) -> tuple[str, int]:
+    key = work_key_for_url(_parse_stem_meta(stem)[2])
+    m = PAGE_RE.search(stem)
+    return key, int(m.group(1)) if m else 0
+
+def work_of(image_path: Path) -> tuple[str, int]:
+    """(ключ работы, номер страницы _pN) по имени файла."""
+    return _work_of_stem(image_path.stem)
+
+def author_of(image_path: Path) -> str:
+    return get_meta(image_path)["author_name"].strip().lower()
+
+def search_terms(image_path: Path) -> list[str]:
+    """
+    Что ищется помимо имени файла. Теги и автор уже в имени, а источник там
+    закодирован (https___pixiv_net_...) — добавляем ключ работы: «pixiv 123456».
+    """
+    return [work_of(image_path)[0]]
+
+def item_info(image_path: Path, with_mtime: bool = False) -> ItemInfo:
+    """Что нужно стратегиям выбора: автор, теги, домен источника и (для fifo) время скачивания."""
+    meta = get_meta(image_path)
+    domain = urlparse(meta["source_url"]).netloc.lower() if meta["source_url"] else ""
+    mtime = 0.0
+    if with_mtime:
+        try:
+            mtime = image_path.stat().st_mtime
+        except OSError:
+            pass
+    return ItemInfo(
+        name=image_path.name,
+        author=meta["author_name"].strip().lower(),
+        tags=tuple(t.lower() for t in meta["tags"]),
+        domain=domain[4:] if domain.startswith("www.") else domain,
+        mtime=mtime,
+    )
+
+
 # ---------- Глобальное состояние планировщика ----------
 
 @dataclass
 class SchedulerState:
-    interval_sec: int
-    next_post_ts: Optional[float] = None
+    schedule: Schedule                        # интервал / cron / окна + тихие часы (post_schedule.py)
+    next_post_ts: Optional[float] = None      # wall-clock копия дедлайна: для state.json и перезапуска
+    next_post_mono: Optional[float] = None    # сам дедлайн по time.monotonic (не прыгает при NTP)
+    prefetched: Optional[Path] = None         # заранее выбранный и проверенный следующий файл
+    prefetch_for: Optional[float] = None      # для какого next_post_mono уже делали prefetch
+    prefetch_task: Optional[asyncio.Task] = None   # идущая подготовка (start_prefetch)
+
+scheduler_state = SchedulerState(
+    schedule=parse_schedule(DEFAULT_SCHEDULE_STR) if DEFAULT_SCHEDULE_STR
+    else Schedule("interval", interval_sec=parse_duration(DEFAULT_INTERVAL_STR))
+)
 
-scheduler_state = SchedulerState(interval_sec=parse_duration(DEFAULT_INTERVAL_STR))
+def save_scheduler_state() -> None:
+    save_state({"schedule": scheduler_state.schedule.to_spec(),
+                "next_post_ts": scheduler_state.next_post_ts})
+
+def set_next_post_wall(ts: float) -> None:
+    """
+    Назначает следующий слот по wall-clock времени из расписания: переводим его
+    в монотонный дедлайн один раз, ожидание дальше не зависит от скачков часов.
+    """
+    scheduler_state.next_post_mono = time.monotonic() + (ts - time.time())
+    scheduler_state.next_post_ts = ts
+    save_scheduler_state()
+
+def reset_next_post() -> None:
+    """Сброс отсчёта (/post, /settime, /schedule): следующий слот считается от текущего момента."""
+    set_next_post_wall(scheduler_state.schedule.next_after(time.time()))
+
+def seconds_until_next_post() -> Optional[float]:
+    if scheduler_state.next_post_mono is None:
+        return None
+    return scheduler_state.next_post_mono - time.monotonic()
+
+def posts_for_missed(missed: int) -> int:
+    """Сколько постов сделать за наступивший слот, если после него прошло ещё missed слотов."""
+    if missed <= 0:
+        return 1
+    if MISSED_SLOT_POLICY == "skip":
+        return 0
+    if MISSED_SLOT_POLICY == "catchup":
+        return 1 + min(missed, MAX_CATCHUP_POSTS)
+    return 1
 
 # События/локи
 reset_event = asyncio.Event()        # когда надо немедленно перепланировать /post
@@ -319,81 +691,742 @@ bot = Bot(
     default=DefaultBotProperties(parse_mode=ParseMode.HTML)
 )
 dp = Dispatcher()
+# все отправки бота (посты и ответы) идут через общую очередь с лимитами и повтором после RetryAfter
+send_queue = SendQueue(TG_GLOBAL_RATE, CHAT_MIN_INTERVAL_SEC, TG_PRIVATE_INTERVAL_SEC, TG_SEND_RETRIES)
+bot.session.middleware(send_queue)
 
 def is_admin(user_id: int) -> bool:
     return (not ADMINS) or (user_id in ADMINS)
 
-async def do_post_random_or_specific(filename: Optional[str] = None) -> str:
+prep_pool: Optional[ProcessPoolExecutor] = None   # создаётся при первой подготовке
+variant_index = VariantIndex(PREP_DIR / INDEX_NAME) if PREP_ENABLED else None   # что подготовили загрузчики
+preparing: dict[str, asyncio.Future] = {}   # digest → идущая подготовка
+
+class PhotoTooLarge(Exception):
+    """Оригинал больше PHOTO_MAX_BYTES, а уменьшенной копии нет — фото не отправить."""
+
+async def upload_file(path: Path, digest: str) -> Path:
+    """
+    Что грузить в Telegram вместо path: уменьшенную копию из PREP_DIR, если
+    оригинал не годится для send_photo как есть, иначе сам path. Пережатие —
+    в пуле процессов, event loop не блокируется. PhotoTooLarge — копию сделать
+    не удалось (не декодируется, слишком вытянутая, анимация), а оригинал
+    больше PHOTO_MAX_BYTES.
+    """
+    # одну копию могут запросить сразу несколько (предзагрузка и пост) — готовим её один раз
+    task = preparing.get(digest)
+    if task is None:
+        task = preparing[digest] = asyncio.ensure_future(_prepare_upload(path, digest))
+        task.add_done_callback(lambda _: preparing.pop(digest, None))
+    upload = await asyncio.shield(task)
+    if upload == path:
+        size = path.stat().st_size
+        if size > PHOTO_MAX_BYTES:
+            raise PhotoTooLarge(f"{size / 1024 / 1024:.1f} МБ без уменьшенной копии")
+    return upload
+
+async def _prepare_upload(path: Path, digest: str) -> Path:
+    global prep_pool
+    if not PREP_ENABLED:
+        return path
+    dst = prepared_path(digest)
+    if dst.exists():
+        return dst
+    rec = await asyncio.to_thread(variant_index.get, digest)
+    if rec is not None and not rec["prep_size"]:
+        return path   # загрузчик уже проверил: оригинал годится как есть
+    PREP_DIR.mkdir(parents=True, exist_ok=True)
+    if prep_pool is None:
+        prep_pool = process_pool(PREP_WORKERS)
+    loop = asyncio.get_running_loop()
+    try:
+        made = await loop.run_in_executor(prep_pool, prepare_photo, str(path), str(dst),
+                                          PREP_MAX_SIDE, PHOTO_MAX_BYTES, PREP_QUALITY)
+    except Exception as e:
+        logger.warning("Не удалось подготовить %s (%s), остаётся оригинал", path.name, e)
+        return path
+    if not made:
+        return path
+    logger.info("Подготовлена копия %s: %.1f → %.1f МБ", path.name,
+                path.stat().st_size / 1024 / 1024, dst.stat().st_size / 1024 / 1024)
+    await asyncio.to_thread(prune_dir, PREP_DIR, PREP_CACHE_MAX_MB * 1024 * 1024)
+    return dst
+
+async def send_photo_cached(chat_id: int | str, path: Path, caption: Optional[str]) -> Message:
+    """
+    send_photo с переиспользованием file_id: если эти байты уже загружались —
+    шлём по file_id, иначе грузим файл (или его подготовленную копию) и
+    запоминаем file_id из ответа. При PHOTO_FALLBACK_DOCUMENT непринятое фото
+    уходит оригиналом через send_document.
+    """
+    digest = await asyncio.to_thread(content_hash, path)
+    fid = await asyncio.to_thread(file_id_cache.get, digest)
+    if fid:
+        try:
+            return await bot.send_photo(chat_id=chat_id, photo=fid, caption=caption)
+        except TelegramBadRequest as e:
+            # file_id больше не принимается — забываем и грузим файл заново
+            logger.warning("file_id для %s отвергнут (%s), загружаем файл", path.name, e)
+            await asyncio.to_thread(file_id_cache.drop, digest)
+
+    try:
+        upload = await upload_file(path, digest)
+        sent = await bot.send_photo(chat_id=chat_id, photo=FSInputFile(str(upload)), caption=caption)
+    except (TelegramBadRequest, PhotoTooLarge) as e:
+        if not PHOTO_FALLBACK_DOCUMENT or path.stat().st_size > DOCUMENT_MAX_BYTES:
+            raise
+        logger.warning("%s не принят как фото (%s), отправляем документом", path.name, e)
+        thumb = thumb_path(digest)
+        return await bot.send_document(chat_id=chat_id, document=FSInputFile(str(path)), caption=caption,
+                                       thumbnail=FSInputFile(str(thumb)) if thumb.exists() else None)
+    if sent.photo:
+        await asyncio.to_thread(file_id_cache.put, digest, sent.photo[-1].file_id)
+    return sent
+
+def album_media(photos: list, caption: Optional[str]) -> list[InputMediaPhoto]:
+    """Элементы send_media_group; подпись — у первого (её Telegram и показывает под альбомом)."""
+    return [InputMediaPhoto(media=ph, caption=caption if i == 0 else None) for i, ph in enumerate(photos)]
+
+async def send_album_cached(chat_id: int | str, paths: list[Path], caption: Optional[str]) -> list[Message]:
+    """
+    send_media_group с переиспользованием file_id, как send_photo_cached:
+    уже загружавшиеся страницы идут по file_id, остальные — файлами.
+    """
+    digests = [await asyncio.to_thread(content_hash, p) for p in paths]
+    fids = [await asyncio.to_thread(file_id_cache.get, d) for d in digests]
+    if any(fids):
+        try:
+            photos = [fid or FSInputFile(str(await upload_file(p, d))) for fid, p, d in zip(fids, paths, digests)]
+            sent = await bot.send_media_group(chat_id=chat_id, media=album_media(photos, caption))
+        except TelegramBadRequest as e:
+            # какой именно file_id отвергнут, Telegram не говорит — забываем все и грузим файлы
+            logger.warning("file_id в альбоме %s отвергнут (%s), загружаем файлы", paths[0].name, e)
+            for d, fid in zip(digests, fids):
+                if fid:
+                    await asyncio.to_thread(file_id_cache.drop, d)
+        else:
+            await asyncio.to_thread(_remember_album, digests, sent)
+            return sent
+
+    photos = [FSInputFile(str(await upload_file(p, d))) for p, d in zip(paths, digests)]
+    sent = await bot.send_media_group(chat_id=chat_id, media=album_media(photos, caption))
+    await asyncio.to_thread(_remember_album, digests, sent)
+    return sent
+
+def _remember_album(digests: list[str], sent: list[Message]) -> None:
+    """Вызывать не из event loop (пишет в state.db)."""
+    for d, m in zip(digests, sent):
+        if m.photo:
+            file_id_cache.put(d, m.photo[-1].file_id)
+
+async def fanout(label: str, chats: list[str], upload: Callable,
+                 resend: Callable) -> tuple[list[str], dict[str, Exception]]:
+    """
+    Публикует в chats: файлы загружаются один раз (upload в первый канал,
+    принявший их, возвращает file_id или None), остальным параллельно уходит
+    resend(чат, file_id). Возвращает (успешные чаты, {чат: ошибка}).
+    """
+    ok: list[str] = []
+    failed: dict[str, Exception] = {}
+    file_ids: Optional[list[str]] = None
+
+    # ищем, кто примет загрузку; до первого успеха — по очереди, чтобы не грузить файлы N раз
+    pending = list(chats)
+    while pending and file_ids is None:
+        chat = pending.pop(0)
+        try:
+            file_ids = await upload(chat)
+            ok.append(chat)
+        except Exception as e:
+            logger.error("Не удалось отправить %s в %s: %s", label, chat, e)
+            failed[chat] = e
+
+    results = await asyncio.gather(*(resend(c, file_ids) for c in pending), return_exceptions=True)
+    for chat, res in zip(pending, results):
+        if isinstance(res, Exception):
+            logger.error("Не удалось отправить %s в %s: %s", label, chat, res)
+            failed[chat] = res
+        else:
+            ok.append(chat)
+    return ok, failed
+
+async def send_photo_fanout(path: Path, caption: Optional[str],
+                            chats: list[str]) -> tuple[list[str], dict[str, Exception]]:
+    """Одно фото в chats (см. fanout)."""
+    async def upload(chat: str) -> Optional[list[str]]:
+        sent = await send_photo_cached(chat, path, caption)
+        return [sent.photo[-1].file_id] if sent.photo else None
+
+    async def resend(chat: str, file_ids: Optional[list[str]]) -> None:
+        if file_ids:
+            await bot.send_photo(chat_id=chat, photo=file_ids[0], caption=caption)
+        else:
+            await send_photo_cached(chat, path, caption)
+
+    return await fanout(path.name, chats, upload, resend)
+
+async def send_album_fanout(paths: list[Path], caption: Optional[str],
+                            chats: list[str]) -> tuple[list[str], dict[str, Exception]]:
+    """Альбом (одним send_media_group) в chats (см. fanout)."""
+    async def upload(chat: str) -> Optional[list[str]]:
+        sent = await send_album_cached(chat, paths, caption)
+        file_ids = [m.photo[-1].file_id for m in sent if m.photo]
+        return file_ids if len(file_ids) == len(paths) else None
+
+    async def resend(chat: str, file_ids: Optional[list[str]]) -> None:
+        if file_ids:
+            await bot.send_media_group(chat_id=chat, media=album_media(file_ids, caption))
+        else:
+            await send_album_cached(chat, paths, caption)
+
+    return await fanout(f"альбом {paths[0].name}", chats, upload, resend)
+
+def delivered_to(digests: list[str]) -> set[str]:
+    """Каналы, которые уже получили все эти файлы (альбом — целиком). Вызывать не из event loop."""
+    sets = [state_store.delivered_get(d) for d in digests]
+    return set.intersection(*sets) if sets else set()
+
+def fanout_succeeded(ok: list[str], failed: dict[str, Exception]) -> bool:
+    """Выполнена ли FANOUT_POLICY (тогда файл можно переносить в used)."""
+    if FANOUT_POLICY == "any":
+        return bool(ok)
+    if FANOUT_POLICY == "primary":
+        return CHANNEL_ID in ok
+    return bool(ok) and not failed
+
+def pick_random_image(exclude: set[str] = frozenset()) -> Optional[Path]:
+    """Следующий файл по стратегии PICK_STRATEGY (название историческое)."""
+    chosen = pending_index.pick(exclude)
+    # файл могли удалить руками между сверками индекса — выкидываем и берём другой
+    while chosen is not None and not chosen.exists():
+        pending_index.discard(chosen.name)
+        chosen = pending_index.pick(exclude)
+    return chosen
+
+async def posted_before(path: Path) -> Optional[str]:
+    """Если эта работа/страница или эти же байты уже публиковались — описание, иначе None."""
+    key, page = work_of(path)
+    found = state_store.history_find_work(key, page)
+    if found is None:
+        found = state_store.history_find_hash(await asyncio.to_thread(content_hash, path))
+    if found is None:
+        return None
+    name, ts = found
+    return f"уже публиковался {datetime.fromtimestamp(ts):%Y-%m-%d %H:%M} как {name}"
+
+async def move_duplicate(src: Path) -> Path:
+    DUPES_DIR.mkdir(parents=True, exist_ok=True)
+    dst = DUPES_DIR / src.name
+    if dst.exists():
+        dst = DUPES_DIR / f"{src.stem}_{int(time.time())}{src.suffix}"
+    shutil.move(str(src), str(dst))
+    pending_index.discard(src.name)
+    phash_index.discard(str(src))
+    await asyncio.to_thread(_store_dropped, src)
+    return dst
+
+# --------- Проверка файлов очереди (карантин) ---------
+
+def validate_image(path: Path) -> Optional[str]:
+    """Проверка для допуска в очередь: check_photo_file и (с Pillow) полное декодирование. None — годится."""
+    reason = check_photo_file(path)
+    if reason is None and PREP_AVAILABLE:
+        reason = decode_problem(str(path))
+    return reason
+
+def validate_cached(path: Path) -> tuple[Optional[str], float]:
+    """
+    validate_image с кэшем в state.db по (путь, размер, mtime): неизменённый
+    файл второй раз не декодируется. Возвращает (причина или None, mtime).
+    FileNotFoundError — файла уже нет. Вызывать не из event loop.
+    """
+    st = path.stat()
+    reason = state_store.check_get(str(path), st.st_size, st.st_mtime_ns)
+    if reason is None:
+        reason = validate_image(path) or ""
+        state_store.check_put(str(path), st.st_size, st.st_mtime_ns, reason)
+    return reason or None, st.st_mtime
+
+def checked_ok(paths: list[Path]) -> set[str]:
+    """Имена файлов, чья прошлая проверка прошла и которые с тех пор не менялись. Вызывать не из event loop."""
+    ok = set()
+    for p in paths:
+        try:
+            st = p.stat()
+        except OSError:
+            continue
+        if state_store.check_get(str(p), st.st_size, st.st_mtime_ns) == "":
+            ok.add(p.name)
+    return ok
+
+async def move_quarantine(src: Path) -> Path:
+    QUARANTINE_DIR.mkdir(parents=True, exist_ok=True)
+    dst = QUARANTINE_DIR / src.name
+    if dst.exists():
+        dst = QUARANTINE_DIR / f"{src.stem}_{int(time.time())}{src.suffix}"
+    shutil.move(str(src), str(dst))
+    pending_index.discard(src.name)
+    phash_index.discard(str(src))
+    await asyncio.to_thread(_store_dropped, src)
+    return dst
+
+class ImageValidator:
+    """
+    Фоновая проверка новых файлов очереди: годные добавляются в индекс (и
+    только тогда видны выбору), негодные переносятся в QUARANTINE_DIR.
+    """
+
+    def __init__(self, index: ImageIndex, workers: int):
+        self.index = index
+        self.workers = workers
+        self.quarantined = 0            # сколько отправлено в карантин с запуска
+        self.pending: set[str] = set()  # ждут решения: разбор, очередь проверки, повтор свежего файла
+        self._queue: asyncio.Queue[Path] = asyncio.Queue()
+        self._tasks: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self.pending)
+
+    def has_work(self, work_key: str) -> bool:
+        return any(work_of(Path(n))[0] == work_key for n in self.pending)
+
+    def submit(self, paths: list[Path]) -> None:
+        """Новые файлы очереди. Вызывать из event loop."""
+        new = [p for p in paths if p.name not in self.pending and p.name not in self.index]
+        if not new:
+            return
+        self.pending.update(p.name for p in new)
+        task = asyncio.create_task(self._triage(new))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _triage(self, paths: list[Path]) -> None:
+        """
+        Уже проверенные раньше и не изменившиеся файлы (кэш в state.db) допускаются
+        сразу — после перезапуска очередь доступна, не дожидаясь декодирования;
+        остальные идут в очередь проверки.
+        """
+        try:
+            known = await asyncio.to_thread(checked_ok, paths)
+        except Exception as e:
+            logger.error("Ошибка чтения кэша проверок: %s", e)
+            known = set()
+        admitted = []
+        for p in paths:
+            if p.name in known:
+                self.index.add(p)
+                self.pending.discard(p.name)
+                admitted.append(p)
+            else:
+                self._queue.put_nowait(p)
+        if PHASH_ENABLED:
+            for p in admitted:
+                try:
+                    await index_phash(p)
+                except OSError:
+                    continue
+
+    def start(self) -> None:
+        for _ in range(self.workers):
+            asyncio.create_task(self._worker())
+
+    async def _worker(self) -> None:
+        while True:
+            path = await self._queue.get()
+            retry = False
+            try:
+                reason, mtime = await asyncio.to_thread(validate_cached, path)
+                if reason is None:
+                    self.index.add(path)
+                    if PHASH_ENABLED:
+                        # build_phash_index берёт снимок очереди при старте — допущенных позже добавляем сами
+                        await index_phash(path)
+                elif time.time() - mtime < VALIDATE_SETTLE_SEC:
+                    # возможно, ещё дописывается — проверим снова, когда уляжется (сверка может быть выключена)
+                    logger.info("Проверка %s: %s — файл свежий, повторим позже", path.name, reason)
+                    delay = max(1.0, mtime + VALIDATE_SETTLE_SEC - time.time())
+                    asyncio.get_running_loop().call_later(delay, self._queue.put_nowait, path)
+                    retry = True   # остаётся в pending, чтобы сверка не подавала его заново
+                else:
+                    dst = await move_quarantine(path)
+                    self.quarantined += 1
+                    logger.warning("В карантин: %s (%s) → %s", path.name, reason, dst.parent)
+            except FileNotFoundError:
+                pass    # файл успели убрать (дубликат, ручное удаление)
+            except Exception as e:
+                logger.error("Ошибка проверки %s: %s", path.name, e)
+            finally:
+                if not retry:
+                    self.pending.discard(path.name)
+
+validator = ImageValidator(pending_index, VALIDATE_WORKERS) if VALIDATE else None
+if validator is not None:
+    pending_index.admit = validator.submit
+    pending_index.pending = validator.pending
+
+# --------- Почти-дубликаты (перцептивный хэш) ---------
+
+phash_index = PerceptualIndex(PHASH_METHOD)
+
+def perceptual_hash(path: Path) -> Optional[int]:
+    """Хэш из кэша state.db или посчитанный заново. None — не картинка. Вызывать не из event loop."""
+    st = path.stat()
+    h = state_store.phash_get(str(path), st.st_size, st.st_mtime_ns, PHASH_METHOD)
+    if h is None:
+        try:
+            h = image_hash(path, PHASH_METHOD)
+        except Exception as e:
+            logger.debug("Не удалось посчитать хэш %s: %s", path.name, e)
+            return None
+        state_store.phash_put(str(path), st.st_size, st.st_mtime_ns, PHASH_METHOD, h)
+    return h
+
+async def index_phash(path: Path) -> Optional[int]:
+    h = await asyncio.to_thread(perceptual_hash, path)
+    if h is not None:
+        phash_index.add(str(path), h)
+    return h
+
+async def build_phash_index() -> None:
+    """Фоново хэшируем очередь и used при старте; после первого раза почти всё берётся из кэша."""
+    for idx in (used_index, pending_index):
+        for p in idx.paths():
+            try:
+                await index_phash(p)
+            except OSError:
+                continue
+    logger.info("Индекс почти-дубликатов: %d файлов (%s)", len(phash_index), PHASH_METHOD)
+
+def _is_used_key(key: str) -> bool:
+    return Path(key).parent == USED_DIR
+
+async def similar_image(path: Path, posted_only: bool) -> Optional[str]:
+    """
+    Ищет почти-дубликат path среди уже опубликованных (posted_only) или вообще
+    среди очереди и used. Страницы той же работы не считаются: варианты одной
+    картинки (с текстом и без, другие цвета) обычно в пределах PHASH_MAX_DIST
+    друг от друга, но это не повтор. Возвращает описание находки или None.
+    """
+    if not PHASH_ENABLED:
+        return None
+    h = await index_phash(path)
+    if h is None:
+        return None
+    work = work_of(path)[0]
+
+    def where(key: str) -> bool:
+        if posted_only and not _is_used_key(key):
+            return False
+        return not work or work_of(Path(key))[0] != work
+
+    hits = phash_index.find_similar(h, PHASH_MAX_DIST, exclude=str(path), where=where)
+    if not hits:
+        return None
+    dist, key = hits[0]
+    return f"похож на {Path(key).name} (расстояние {dist})"
+
+async def upload_problem(path: Path, as_document: bool) -> Optional[str]:
+    """
+    Почему path не отправить даже с подготовкой; None — можно. Заодно готовит
+    копию заранее (она кэшируется). as_document — можно ли уйти документом
+    (PHOTO_FALLBACK_DOCUMENT, не для альбомов).
+    """
+    if not PREP_ENABLED:
+        return None   # без подготовки размер уже проверил check_photo_file
+    digest = await asyncio.to_thread(content_hash, path)
+    try:
+        await upload_file(path, digest)
+    except PhotoTooLarge as e:
+        if as_document and PHOTO_FALLBACK_DOCUMENT and path.stat().st_size <= DOCUMENT_MAX_BYTES:
+            return None
+        return str(e)
+    return None
+
+async def pick_postable_image(attempts: int = 20) -> Optional[Path]:
+    """
+    Случайный файл из очереди, который можно постить: проходит check_photo_file
+    и upload_problem и (при SKIP_POSTED) ещё не публиковался — такие уходят в DUPES_DIR.
+    """
+    rejected: set[str] = set()
+    for _ in range(min(attempts, len(pending_index))):
+        cand = pick_random_image(rejected)
+        if cand is None:
+            return None
+        reason = await asyncio.to_thread(check_photo_file, cand) or await upload_problem(cand, as_document=True)
+        if reason is not None:
+            logger.warning("Пропускаем %s: %s", cand.name, reason)
+            rejected.add(cand.name)
+            continue
+        if SKIP_POSTED:
+            dup = await posted_before(cand) or await similar_image(cand, posted_only=True)
+            if dup:
+                logger.warning("Пропускаем %s: %s → %s", cand.name, dup, DUPES_DIR)
+                await move_duplicate(cand)
+                continue
+        return cand
+    return None
+
+async def album_for(chosen: Path) -> list[Path]:
+    """
+    При ALBUM_MODE — страницы той же работы из очереди (по номеру, до ALBUM_MAX,
+    включая chosen), которые можно постить; уже публиковавшиеся уходят в DUPES_DIR.
+    Иначе или если страница одна — [chosen].
+    """
+    key = work_of(chosen)[0]
+    if not ALBUM_MODE or not key:
+        return [chosen]
+    if await upload_problem(chosen, as_document=False):
+        return [chosen]   # фото из него не сделать — уйдёт один, документом
+    # по файлу на страницу («_p1 (1)» — копия той же страницы, второй раз не шлём); за chosen — его место
+    by_page: dict[int, Path] = {}
+    for p in pending_index.work_files(key):
+        by_page.setdefault(work_of(p)[1], p)
+    by_page[work_of(chosen)[1]] = chosen
+    pages = [by_page[n] for n in sorted(by_page)]
+    start = pages.index(chosen) // ALBUM_MAX * ALBUM_MAX
+    album = []
+    for p in pages[start:start + ALBUM_MAX]:
+        if p != chosen:
+            if not p.exists() or await asyncio.to_thread(check_photo_file, p) is not None:
+                continue
+            if await upload_problem(p, as_document=False):
+                continue
+            if SKIP_POSTED:
+                dup = await posted_before(p) or await similar_image(p, posted_only=True)
+                if dup:
+                    logger.warning("Из альбома исключён %s: %s → %s", p.name, dup, DUPES_DIR)
+                    await move_duplicate(p)
+                    continue
+        album.append(p)
+    return album
+
+IMAGE_MAGIC = (
+    (b"\xff\xd8\xff", None),            # jpeg
+    (b"\x89PNG\r\n\x1a\n", None),       # png
+    (b"GIF87a", None),
+    (b"GIF89a", None),
+    (b"RIFF", b"WEBP"),                 # webp: RIFF....WEBP
+    (b"BM", None),                      # bmp
+)
+
+def check_photo_file(path: Path) -> Optional[str]:
+    """Быстрая проверка перед отправкой (размер и сигнатура). None — ок, иначе причина."""
+    try:
+        size = path.stat().st_size
+        with open(path, "rb") as f:
+            head = f.read(12)
+    except OSError as e:
+        return f"не читается: {e}"
+    if size == 0:
+        return "пустой файл"
+    # с подготовкой большой файл уменьшится; документом можно до 50 МБ
+    limit = None if PREP_ENABLED else DOCUMENT_MAX_BYTES if PHOTO_FALLBACK_DOCUMENT else PHOTO_MAX_BYTES
+    if limit is not None and size > limit:
+        return f"больше {limit // (1024 * 1024)} МБ"
+    for magic, extra in IMAGE_MAGIC:
+        if head.startswith(magic) and (extra is None or head[8:12] == extra):
+            return None
+    return "не похоже на изображение"
+
+async def prefetch_next_post() -> None:
+    """
+    Готовит следующий пост заранее: выбирает и проверяет файл, а при заданном
+    STAGING_CHAT_ID загружает его туда, чтобы к дедлайну file_id уже был в кэше.
+    """
+    prev = scheduler_state.prefetched
+    if prev is not None and prev.name in pending_index and prev.exists():
+        chosen = prev
+    else:
+        chosen = await pick_postable_image()
+    scheduler_state.prefetched = chosen
+    if chosen is None:
+        return
+    logger.info("[prefetch] Следующий пост: %s", chosen.name)
+
+    if STAGING_CHAT_ID:
+        # в режиме альбомов заранее грузим все его страницы: send_media_group возьмёт их file_id
+        for path in await album_for(chosen):
+            try:
+                with send_priority(PRIORITY_BACKGROUND):
+                    sent = await send_photo_cached(STAGING_CHAT_ID, path, None)
+                await bot.delete_message(chat_id=STAGING_CHAT_ID, message_id=sent.message_id)
+            except Exception as e:
+                logger.warning("[prefetch] Предзагрузка %s не удалась: %s", path.name, e)
+
+async def _prefetch_logged() -> None:
+    try:
+        await prefetch_next_post()
+    except Exception as e:
+        logger.error("[prefetch] Ошибка: %s", e)
+
+def start_prefetch() -> None:
+    """
+    prefetch_next_post отдельной задачей: загрузка в служебный чат может
+    затянуться (большой файл, flood control), а планировщик не должен её ждать.
+    Предыдущая подготовка, если ещё идёт, отменяется.
+    """
+    stop_prefetch()
+    scheduler_state.prefetch_task = asyncio.create_task(_prefetch_logged())
+
+def stop_prefetch() -> None:
+    task = scheduler_state.prefetch_task
+    if task is not None and not task.done():
+        task.cancel()
+    scheduler_state.prefetch_task = None
+
+def find_queued(query: str) -> Path:
+    """
+    Файл очереди по имени или его части: точное имя, иначе лучший по рангу из
+    содержащих запрос целиком. Нечёткие совпадения только подсказываются.
+    """
+    hits = pending_index.search.search(query, limit=5)
+    if hits and hits[0][2]:
+        return IMAGES_DIR / hits[0][1]
+    msg = f"Файл '{query}' не найден в {IMAGES_DIR}"
+    if hits:
+        msg += ". Похожие: " + ", ".join(name for _, name, _ in hits)
+    raise RuntimeError(msg)
+
+async def do_post_random_or_specific(filename: Optional[str] = None, preferred: Optional[Path] = None) -> str:
     """
     Если filename указан — ищем по имени (поддерживает частичное совпадение без учёта регистра).
-    Иначе — случайное изображение.
+    Если передан preferred (заранее подготовленный файл) и он ещё в очереди — постим его.
+    Иначе — случайное изображение. При ALBUM_MODE вместе с ним уходят
+    остальные страницы той же работы (одним альбомом).
     Возвращает человекочитаемое описание того, что отправлено.
     """
-    imgs = list_images()
-    if not imgs:
+    if not len(pending_index):
         raise RuntimeError("Папка с изображениями пуста.")
 
     # выбор файла
-    if filename:
-        needle = filename.strip().lower()
-        exact = [p for p in imgs if p.name.lower() == needle]
-        chosen = exact[0] if exact else None
-        if not chosen:
-            subset = [p for p in imgs if needle in p.name.lower()]
-            if not subset:
-                raise RuntimeError(f"Файл '{filename}' не найден в {IMAGES_DIR}")
-            chosen = random.choice(subset)
+    if preferred is not None and preferred.name in pending_index and preferred.exists():
+        chosen = preferred
+    elif filename:
+        chosen = find_queued(filename)
     else:
-        chosen = random.choice(imgs)
+        chosen = await pick_postable_image()
+        if chosen is None:
+            raise RuntimeError("Не нашлось подходящих изображений (пусто, битые или уже публиковались).")
 
     logger.info("Выбран файл: %s", chosen)
 
     # метаданные + подпись
-    meta = parse_filename_meta(chosen)
-    caption = build_caption_from_meta(meta, default_tags=DEFAULT_TAGS, max_tags=MAX_TAGS)
+    meta = get_meta(chosen)
+    caption = get_caption(chosen)
     logger.info("Meta: %s", meta)
     logger.info("Caption preview: %r", caption)
 
+    album = await album_for(chosen)
+
+    # хэши до отправки: send_photo_cached возьмёт их из кэша, а после переноса файлов они нужны для истории
+    digests = [await asyncio.to_thread(content_hash, p) for p in album]
+
     # отправка + перенос
     async with post_lock:
-        file = FSInputFile(str(chosen))
-        await bot.send_photo(chat_id=CHANNEL_ID, photo=file, caption=caption if caption else None)
-        moved_to = move_used(chosen)
-
-    logger.info("Файл %s отправлен и перемещён в %s", chosen.name, USED_DIR)
-    return f"Опубликовано: <code>{moved_to.name}</code> (перенесено в {USED_DIR})"
+        # каналы, получившие эти файлы при прошлой (не засчитанной по FANOUT_POLICY) попытке, второй раз не шлём
+        delivered = await asyncio.to_thread(delivered_to, digests)
+        chats = [c for c in CHANNEL_IDS if c not in delivered]
+        ok, failed = [], {}
+        if delivered:
+            logger.info("Уже доставлено в %s, отправляем только в %s", ", ".join(sorted(delivered)),
+                        ", ".join(chats) or "—")
+        if chats:
+            with send_priority(PRIORITY_POST):   # вперёд ответов админу, если очередь отправки занята
+                if len(album) > 1:
+                    ok, failed = await send_album_fanout(album, caption if caption else None, chats)
+                else:
+                    ok, failed = await send_photo_fanout(chosen, caption if caption else None, chats)
+        if ok:
+            await asyncio.to_thread(state_store.delivered_add, digests, ok, time.time())
+        ok = [c for c in CHANNEL_IDS if c in delivered or c in ok]
+        if not fanout_succeeded(ok, failed):
+            errors = "; ".join(f"{c}: {e}" for c, e in failed.items())
+            raise RuntimeError(
+                f"Не опубликовано по политике {FANOUT_POLICY} (успешно: {len(ok)}/{len(CHANNEL_IDS)}): {errors}"
+            )
+        now = time.time()
+        moved = []
+        for path, digest in zip(album, digests):
+            moved.append(await move_used(path))
+            work_key, page = work_of(path)
+            await asyncio.to_thread(state_store.history_add, work_key, page, digest, path.name, now)
+        await asyncio.to_thread(state_store.delivered_drop, digests)
+        if variant_index is not None:
+            await asyncio.to_thread(drop_variants, variant_index, digests)
+        pending_index.selector.posted(author_of(chosen))
+
+    logger.info("%s отправлен в %d/%d каналов и перемещён в %s",
+                f"Альбом из {len(album)} ({chosen.name})" if len(album) > 1 else f"Файл {chosen.name}",
+                len(ok), len(CHANNEL_IDS), USED_DIR)
+    if len(album) > 1:
+        info = (f"Опубликован альбом из {len(album)}: <code>{html.escape(moved[0].name)}</code> и др. "
+                f"(перенесено в {USED_DIR})")
+    else:
+        info = f"Опубликовано: <code>{moved[0].name}</code> (перенесено в {USED_DIR})"
+    if failed:
+        info += "\n⚠️ Не доставлено в: " + ", ".join(f"<code>{html.escape(c)}</code>" for c in failed)
+    return info
 
 
 async def scheduler_loop():
     """
-    Простой цикл: спит до следующего времени постинга,
-    реагирует на reset_event (когда /post делает пост и сбрасывает отсчёт).
+    Цикл по монотонным дедлайнам с фиксированной каденцией: следующий слот
+    считается от запланированного, а не от момента окончания поста.
+    Реагирует на reset_event (когда /post или /settime сбрасывают отсчёт).
     """
-    logger.info("Планировщик запущен. Интервал: %s", humanize_seconds(scheduler_state.interval_sec))
-    # восстановим состояние (интервал/следующее время) при старте
+    # восстановим состояние (расписание/следующее время) при старте
     state = load_state()
-    if "interval_sec" in state:
-        scheduler_state.interval_sec = int(state["interval_sec"])
+    if "schedule" in state:
+        try:
+            scheduler_state.schedule = parse_schedule(state["schedule"])
+        except ValueError as e:
+            logger.error("Расписание из state.json не разобрано (%s), оставляем по умолчанию", e)
+    elif "interval_sec" in state and int(state["interval_sec"]) > 0:
+        scheduler_state.schedule = Schedule("interval", interval_sec=int(state["interval_sec"]))
+    logger.info("Планировщик запущен. Расписание: %s, пропущенные слоты: %s",
+                scheduler_state.schedule.describe(), MISSED_SLOT_POLICY)
     if "next_post_ts" in state:
+        # wall-clock переводим в монотонное время один раз; просроченный слот останется в прошлом
         scheduler_state.next_post_ts = float(state["next_post_ts"])
+        scheduler_state.next_post_mono = time.monotonic() + (scheduler_state.next_post_ts - time.time())
 
     while True:
         try:
-            now = time.time()
-            if scheduler_state.next_post_ts is None or scheduler_state.next_post_ts <= now:
-                # Сразу постим (если времени нет или просрочено)
-                try:
-                    await do_post_random_or_specific(None)
-                except Exception as e:
-                    # Если пусто — просто перенесём next_post, чтобы не спамить
-                    print(f"[scheduler] Ошибка постинга: {e}")
-                # Назначаем следующее
-                scheduler_state.next_post_ts = time.time() + scheduler_state.interval_sec
-                save_state({"interval_sec": scheduler_state.interval_sec,
-                            "next_post_ts": scheduler_state.next_post_ts})
-
-            # Ждём либо до дедлайна, либо сброса
-            wait_time = max(0, scheduler_state.next_post_ts - time.time())
+            now = time.monotonic()
+            if scheduler_state.next_post_mono is None or scheduler_state.next_post_mono <= now:
+                planned = scheduler_state.next_post_mono if scheduler_state.next_post_mono is not None else now
+                # слоты расписания считаем в wall-clock, но от запланированного, а не от текущего момента
+                planned_wall = time.time() - (now - planned)
+                _, missed = scheduler_state.schedule.iter_until(planned_wall, time.time())
+                posts = posts_for_missed(missed)
+                if posts != 1:
+                    logger.info("[scheduler] Слот просрочен на %s, постов: %d (%s)",
+                                humanize_seconds(int(now - planned)), posts, MISSED_SLOT_POLICY)
+                # не успевшая подготовка больше не нужна: пост загрузит файл сам, а не вторым потоком рядом
+                stop_prefetch()
+                for _ in range(posts):
+                    try:
+                        await do_post_random_or_specific(None, preferred=scheduler_state.prefetched)
+                    except Exception as e:
+                        # Если пусто — просто ждём следующий слот, чтобы не спамить
+                        logger.error("[scheduler] Ошибка постинга: %s", e)
+                    scheduler_state.prefetched = None
+                # Следующий слот — по расписанию от запланированного
+                nxt, _ = scheduler_state.schedule.iter_until(planned_wall, time.time())
+                set_next_post_wall(nxt)
+
+            # Незадолго до дедлайна готовим следующий пост (один раз на слот)
+            deadline = scheduler_state.next_post_mono
+            prefetch_at = deadline - PREFETCH_LEAD_SEC
+            need_prefetch = PREFETCH_LEAD_SEC > 0 and scheduler_state.prefetch_for != deadline
+            if need_prefetch and time.monotonic() >= prefetch_at:
+                scheduler_state.prefetch_for = deadline
+                start_prefetch()
+                need_prefetch = False
+
+            # Ждём либо до prefetch/дедлайна, либо сброса
+            target = prefetch_at if need_prefetch else deadline
+            wait_time = max(0, target - time.monotonic())
             try:
                 reset_event.clear()
                 # ждем меньше из двух: либо таймаут, либо ресет
@@ -420,8 +1453,11 @@ async def cmd_help(msg: Message):
         "<b>Команды для админа</b>\n"
         "/post — запостить сразу случайное изображение и <i>сбросить таймер</i>\n"
         "/post <имя_файла_или_часть> — запостить конкретный файл (если есть) и сбросить таймер\n"
+        "/find <запрос> — найти файлы в очереди по имени, тегам, автору или ID работы\n"
         "/settime <интервал> — установить интервал (напр. 45, 10m, 2h30m, 1d)\n"
+        "/schedule [расписание] — cron, окна с разными интервалами, тихие часы\n"
         "/status — показать текущие настройки\n"
+        "/jobs [id] — очередь фоновых загрузок /img, /dl, /dl_da\n"
     )
     await msg.answer(text)
 
@@ -430,20 +1466,31 @@ async def cmd_status(msg: Message):
     if not is_admin(msg.from_user.id):
         return
 
-    nxt = scheduler_state.next_post_ts
-    eta = int(max(0, (nxt - time.time()))) if nxt else None
+    left = seconds_until_next_post()
+    eta = int(max(0, left)) if left is not None else None
 
-    total_pending = count_images_in(IMAGES_DIR)
-    total_used = count_images_in(USED_DIR)
+    total_pending = len(pending_index)
+    total_used = len(used_index)
 
     text_lines = [
         "📊 <b>Статус</b>",
         f"Папка: <code>{IMAGES_DIR}</code>",
         f"Использованные: <code>{USED_DIR}</code>",
         f"Доступно к постингу: <b>{total_pending}</b> шт.",
-        f"Уже опубликовано (в used): <b>{total_used}</b> шт.",
-        f"Интервал: <code>{humanize_seconds(scheduler_state.interval_sec)}</code>",
+        f"Уже опубликовано (в used): <b>{total_used}</b> шт., в истории: <b>{state_store.history_count()}</b>",
+        f"Расписание: <code>{html.escape(scheduler_state.schedule.describe())}</code>",
+        f"Выбор: <code>{html.escape(pending_index.selector.describe())}</code>",
+        f"Отправка: {send_queue.describe()}",
+        f"Альбомы: {f'до {ALBUM_MAX} страниц' if ALBUM_MODE else 'выкл.'}",
     ]
+    if validator is not None:
+        text_lines.append(f"Проверка файлов: ждут {len(validator)}, в карантин с запуска {validator.quarantined} "
+                          f"(<code>{QUARANTINE_DIR}</code>)")
+    if variant_index is not None:
+        names = {p.name for p in pending_index.paths()}
+        ready, orig, upload = await asyncio.to_thread(variant_index.summary, names)
+        text_lines.append(f"Подготовлено при скачивании: {ready} из {total_pending} "
+                          f"({orig / 1024 / 1024:.0f} МБ оригиналов → {upload / 1024 / 1024:.0f} МБ к загрузке)")
     if eta is not None:
         text_lines.append(f"Следующий пост через: <code>{humanize_seconds(eta)}</code>")
     else:
@@ -465,10 +1512,8 @@ async def cmd_settime(msg: Message, command: CommandObject):
 
     try:
         sec = parse_duration(command.args)
-        scheduler_state.interval_sec = sec
-        scheduler_state.next_post_ts = time.time() + sec
-        save_state({"interval_sec": scheduler_state.interval_sec,
-                    "next_post_ts": scheduler_state.next_post_ts})
+        scheduler_state.schedule = scheduler_state.schedule.with_interval(sec)
+        reset_next_post()
         reset_event.set()
 
         logger.info("Команда /settime от %s (%s) новый интервал: %s",
@@ -476,13 +1521,52 @@ async def cmd_settime(msg: Message, command: CommandObject):
 
         await msg.answer(
             f"✅ Интервал установлен: <code>{humanize_seconds(sec)}</code>. "
-            f"Следующий пост через <code>{humanize_seconds(sec)}</code>."
+            f"Следующий пост через <code>{humanize_seconds(int(seconds_until_next_post()))}</code>."
+        )
+    except ValueError as e:
+        # интервал не разобран или не больше нуля — расписание не меняем
+        return await msg.answer(
+            f"❌ {html.escape(str(e))}\n"
+            "Примеры: <code>/settime 45</code>, <code>/settime 10m</code>, <code>/settime 2h30m</code>"
         )
     except Exception as e:
         logger.exception("Ошибка в /settime: %s", e)
         return await msg.answer(f"❌ {e}", parse_mode=None)
 
 
+@dp.message(Command("schedule"))
+async def cmd_schedule(msg: Message, command: CommandObject):
+    if not is_admin(msg.from_user.id):
+        return
+    if not command or not command.args:
+        return await msg.answer(
+            f"Текущее расписание: <code>{html.escape(scheduler_state.schedule.to_spec())}</code>\n"
+            "Примеры:\n"
+            "<code>/schedule interval 30m quiet=01:00-08:00</code>\n"
+            "<code>/schedule cron */30 9-23 * * *</code>\n"
+            "<code>/schedule windows 09:00-13:00=30m 18:00-23:30=15m default=2h</code>"
+        )
+
+    try:
+        schedule = parse_schedule(command.args)
+        schedule.next_after(time.time())    # проверим, что расписание вообще срабатывает
+        scheduler_state.schedule = schedule
+        reset_next_post()
+        reset_event.set()
+
+        logger.info("Команда /schedule от %s (%s): %s",
+                    msg.from_user.full_name, msg.from_user.id, schedule.to_spec())
+
+        nxt = datetime.fromtimestamp(scheduler_state.next_post_ts).strftime("%Y-%m-%d %H:%M")
+        await msg.answer(
+            f"✅ Расписание: <code>{html.escape(schedule.to_spec())}</code>\n"
+            f"Следующий пост: <code>{nxt}</code>."
+        )
+    except Exception as e:
+        logger.exception("Ошибка в /schedule: %s", e)
+        return await msg.answer(f"❌ {e}", parse_mode=None)
+
+
 @dp.message(Command("post"))
 async def cmd_post(msg: Message, command: CommandObject):
     if not is_admin(msg.from_user.id):
@@ -499,18 +1583,200 @@ async def cmd_post(msg: Message, command: CommandObject):
         info = await do_post_random_or_specific(filename)
 
         # Сбрасываем таймер и пересчитываем
-        scheduler_state.next_post_ts = time.time() + scheduler_state.interval_sec
-        save_state({"interval_sec": scheduler_state.interval_sec,
-                    "next_post_ts": scheduler_state.next_post_ts})
+        reset_next_post()
         reset_event.set()
 
         await msg.answer(
-            f"✅ {info}\nТаймер сброшен. Следующий пост через <code>{humanize_seconds(scheduler_state.interval_sec)}</code>."
+            f"✅ {info}\nТаймер сброшен. Следующий пост через <code>{humanize_seconds(int(seconds_until_next_post()))}</code>."
         )
     except Exception as e:
         logger.exception("Ошибка в /post: %s", e)
         return await msg.answer(f"❌ {e}", parse_mode=None)
 
+@dp.message(Command("find"))
+async def cmd_find(msg: Message, command: CommandObject):
+    if not is_admin(msg.from_user.id):
+        return
+    if not command or not command.args:
+        return await msg.answer("Укажи запрос: <code>/find часть имени, тег, автор или ID</code>")
+
+    query = command.args.strip()
+    t0 = time.perf_counter()
+    hits = pending_index.search.search(query, limit=10)
+    took_ms = (time.perf_counter() - t0) * 1000
+    logger.info("Команда /find от %s (%s): %r → %d (%.1f мс)",
+                msg.from_user.full_name, msg.from_user.id, query, len(hits), took_ms)
+    if not hits:
+        return await msg.answer("Ничего не нашлось.")
+    lines = [f"🔎 <b>{html.escape(query)}</b> ({took_ms:.1f} мс, в очереди {len(pending_index)})"]
+    for i, (score, name, contains) in enumerate(hits, 1):
+        mark = "" if contains else " ≈"
+        lines.append(f"{i}. <code>{html.escape(name)}</code>{mark}")
+    lines.append("Запостить: <code>/post имя</code>")
+    await msg.answer("\n".join(lines))
+
+# ---------------- Фоновые загрузки ----------------
+
+@dataclass
+class DownloadJob:
+    job_id: str
+    label: str
+    chat_id: int
+    cmds: list[tuple[str, list[str]]]            # (подпись, argv) — запускаются по очереди
+    report: Callable[["DownloadJob"], str]       # как оформить итог для чата
+    status: str = "queued"                       # queued / running / done / failed
+    results: list[tuple[str, int, str, str]] = field(default_factory=list)  # (подпись, код, stdout, stderr)
+    created_ts: float = field(default_factory=time.time)
+    finished_ts: Optional[float] = None
+    notes: list[str] = field(default_factory=list)      # что бот сделал с результатом (дубликаты и т.п.)
+
+dl_jobs: "OrderedDict[str, DownloadJob]" = OrderedDict()
+dl_queue: asyncio.Queue = asyncio.Queue()
+
+async def run_script(argv: list[str]) -> tuple[int, str, str]:
+    """
+    Запускает скрипт загрузчика дочерним процессом, не блокируя event loop.
+    Возвращает (код выхода, stdout, stderr).
+    """
+    # PREP_DIR — тот же, что у бота: туда загрузчик кладёт копии и превью
+    env = {**os.environ, "PYTHONIOENCODING": "utf-8", "PREP_DIR": str(PREP_DIR)}
+    if not PREP_ENABLED:
+        env["DL_VARIANTS"] = "0"
+    proc = await asyncio.create_subprocess_exec(
+        *argv,
+        cwd=str(BASE_DIR),
+        env=env,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    try:
+        out, err = await proc.communicate()
+    except asyncio.CancelledError:
+        proc.kill()
+        raise
+    return (
+        proc.returncode,
+        out.decode("utf-8", errors="replace").strip(),
+        err.decode("utf-8", errors="replace").strip(),
+    )
+
+def submit_download(label: str, chat_id: int, cmds: list[tuple[str, list[str]]],
+                    report: Callable[[DownloadJob], str]) -> DownloadJob:
+    """Ставит загрузку в очередь и сразу возвращает задачу (с её ID)."""
+    job = DownloadJob(job_id=uuid.uuid4().hex[:8], label=label, chat_id=chat_id, cmds=cmds, report=report)
+    dl_jobs[job.job_id] = job
+    # помним ограниченное число задач: вытесняем самые старые завершённые
+    while len(dl_jobs) > DL_JOBS_KEEP:
+        old = next((jid for jid, j in dl_jobs.items() if j.finished_ts is not None), None)
+        if old is None:
+            break
+        del dl_jobs[old]
+    dl_queue.put_nowait(job)
+    logger.info("Загрузка %s поставлена в очередь: %s (в очереди: %d)", job.job_id, label, dl_queue.qsize())
+    return job
+
+async def check_downloaded(job: DownloadJob, path: Path) -> None:
+    """Свежескачанный файл, похожий на уже имеющийся (в очереди или в used), сразу уходит в DUPES_DIR."""
+    try:
+        dup = await similar_image(path, posted_only=False)
+    except OSError:
+        return
+    if dup:
+        await move_duplicate(path)
+        job.notes.append(f"{path.name}: {dup} → дубликат")
+
+async def download_worker(n: int):
+    """Один из DL_WORKERS воркеров: берёт задачи из очереди и отчитывается в чат."""
+    while True:
+        job = await dl_queue.get()
+        job.status = "running"
+        logger.info("[dl-%d] Старт загрузки %s: %s", n, job.job_id, job.label)
+        try:
+            for label, argv in job.cmds:
+                code, out, err = await run_script(argv)
+                job.results.append((label, code, out, err))
+                for p in index_saved_files(out):
+                    await check_downloaded(job, p)
+            job.status = "done" if all(r[1] == 0 for r in job.results) else "failed"
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.exception("[dl-%d] Ошибка загрузки %s: %s", n, job.job_id, e)
+            job.results.append((job.label, -1, "", str(e)))
+            job.status = "failed"
+        finally:
+            job.finished_ts = time.time()
+            dl_queue.task_done()
+
+        logger.info("[dl-%d] Загрузка %s завершена: %s", n, job.job_id, job.status)
+        try:
+            await bot.send_message(job.chat_id, job.report(job))
+        except Exception as e:
+            logger.error("[dl-%d] Не удалось отправить отчёт по %s: %s", n, job.job_id, e)
+
+def _report_img(unknown_items: list[str], skipped: list[str]) -> Callable[[DownloadJob], str]:
+    def report(job: DownloadJob) -> str:
+        lines = [f"📥 Загрузка <code>{job.job_id}</code>:"]
+        if unknown_items:
+            lines.append("⚠️ Неопознаны: " + ", ".join(map(html.escape, unknown_items)))
+        if skipped:
+            lines.append("⏭ Пропущены: " + ", ".join(map(html.escape, skipped)))
+        for note in job.notes:
+            lines.append("♻️ " + html.escape(note))
+
+        for label, code, out, err in job.results:
+            status = "ok" if code == 0 else f"exit {code}"
+            lines.append(f"— <b>{label}</b>: <code>{status}</code>")
+            if out:
+                # ограничим размер, чтобы не упереться в лимит Telegram
+                out_trim = out[-3500:] if len(out) > 3500 else out
+                lines.append(f"<pre>{html.escape(out_trim)}</pre>")
+            if err:
+                err_trim = err[-1500:] if len(err) > 1500 else err
+                lines.append(f"<pre>{html.escape(err_trim)}</pre>")
+
+        if len(lines) == 1:
+            lines.append("✅ Готово (без вывода).")
+        return "\n".join(lines)
+    return report
+
+def _report_single(site: str, out_dir: Path) -> Callable[[DownloadJob], str]:
+    def report(job: DownloadJob) -> str:
+        _, code, stdout, stderr = job.results[-1]
+        if code != 0:
+            return "❌ Ошибка {} (<code>{}</code>):\n<pre>{}</pre>".format(
+                site, job.job_id, html.escape(stderr or stdout or "no output")
+            )
+        text = "✅ {} → <code>{}</code> (<code>{}</code>)\n<pre>{}</pre>".format(
+            site, html.escape(str(out_dir)), job.job_id, html.escape(stdout or "Скрипт отработал без вывода")
+        )
+        return "\n".join([text] + ["♻️ " + html.escape(n) for n in job.notes])
+    return report
+
+@dp.message(Command("jobs"))
+async def cmd_jobs(msg: Message, command: CommandObject):
+    if not is_admin(msg.from_user.id):
+        return
+
+    # /jobs <id> — подробный отчёт по одной задаче
+    if command and command.args:
+        job = dl_jobs.get(command.args.strip())
+        if not job:
+            return await msg.answer("❌ Задача не найдена.")
+        if job.finished_ts is None:
+            return await msg.answer(f"⏳ <code>{job.job_id}</code> {html.escape(job.label)}: {job.status}")
+        return await msg.answer(job.report(job))
+
+    if not dl_jobs:
+        return await msg.answer("Загрузок пока не было.")
+    now = time.time()
+    lines = [f"📥 <b>Загрузки</b> (в очереди: {dl_queue.qsize()}, воркеров: {DL_WORKERS})"]
+    for job in reversed(dl_jobs.values()):
+        age = humanize_seconds(int(now - job.created_ts))
+        lines.append(f"<code>{job.job_id}</code> {job.status} — {html.escape(job.label)} ({age} назад)")
+    await msg.answer("\n".join(lines[:30]))
+
+
 # ---------------- /img (универсальная загрузка) ----------------
 
 PIXIV_URL_RE = re.compile(r"pixiv\.net", re.I)
@@ -544,6 +1810,24 @@ def _classify_item(token: str) -> tuple[str, str]:
 
     return ("unknown", t)
 
+def _known_work(site: str, value: str) -> Optional[str]:
+    """Если работа уже в очереди или публиковалась — причина пропуска, иначе None."""
+    if site == "pixiv":
+        m = PIXIV_WORK_RE.search(value)
+        wid = m.group(1) if m else (value if ONLY_DIGITS.match(value) else None)
+        key = f"pixiv:{wid}" if wid else ""
+    else:
+        m = DA_WORK_RE.search(value) or re.fullmatch(r"(\d{6,})", value)
+        key = f"deviantart:{m.group(1)}" if m else ""
+    if not key:
+        return None
+    if pending_index.has_work(key) or (validator is not None and validator.has_work(key)):
+        return "уже в очереди"
+    found = state_store.history_find_work(key)
+    if found:
+        return f"публиковалось {datetime.fromtimestamp(found[1]):%Y-%m-%d}"
+    return None
+
 @dp.message(Command("img"))
 async def cmd_img(msg: Message, command: CommandObject):
     if not is_admin(msg.from_user.id):
@@ -552,7 +1836,7 @@ async def cmd_img(msg: Message, command: CommandObject):
     if not command or not command.args:
         return await msg.answer(
             "❌ Использование:\n"
-            "<code>/img &lt;ID|URL[,ID|URL,...]&gt; [теги...] [--all]</code>\n"
+            "<code>/img &lt;ID|URL[,ID|URL,...]&gt; [теги...] [--all] [--force]</code>\n"
             "Примеры:\n"
             "<code>/img 126867032 ai --all</code>\n"
             "<code>/img https://www.pixiv.net/en/artworks/132054690 ai --all</code>\n"
@@ -573,19 +1857,29 @@ async def cmd_img(msg: Message, command: CommandObject):
         # вытащим теги и флаг --all из хвоста
         rest_tokens = [t for t in (tail.split() if tail else []) if t.strip()]
         download_all = any(t == "--all" for t in rest_tokens)
-        extra_tags = [t for t in rest_tokens if t != "--all"]
+        force = any(t == "--force" for t in rest_tokens)
+        extra_tags = [t for t in rest_tokens if t not in ("--all", "--force")]
 
-        # 2) Классифицируем по сайтам
-        pixiv_items, da_items, unknown_items = [], [], []
+        # 2) Классифицируем по сайтам (уже скачанное/опубликованное пропускаем, если нет --force)
+        pixiv_items, da_items, unknown_items, skipped = [], [], [], []
         for tok in tokens:
             site, val = _classify_item(tok)
-            if site == "pixiv":
+            known = _known_work(site, val) if site != "unknown" and not force else None
+            if known:
+                skipped.append(f"{val} ({known})")
+            elif site == "pixiv":
                 pixiv_items.append(val)
             elif site == "da":
                 da_items.append(val)
             else:
                 unknown_items.append(val)
 
+        if not pixiv_items and not da_items and skipped:
+            return await msg.answer(
+                "⏭ Всё уже есть: " + ", ".join(map(html.escape, skipped))
+                + "\nЧтобы скачать заново, добавь <code>--force</code>."
+            )
+
         # Если вообще ничего валидного
         if not pixiv_items and not da_items:
             return await msg.answer(
@@ -597,18 +1891,10 @@ async def cmd_img(msg: Message, command: CommandObject):
         # Сформируем команды к внешним скриптам
         # Используем тот же Python-интерпретатор, что и бот.
         PY = sys.executable
-        BASEDIR = Path(__file__).resolve().parent
-        PIXIV_SCRIPT = str(BASEDIR / "pixiv_dl.py")
-        DA_SCRIPT    = str(BASEDIR / "deviantart_dl.py")
+        PIXIV_SCRIPT = str(BASE_DIR / "pixiv_dl.py")
+        DA_SCRIPT    = str(BASE_DIR / "deviantart_dl.py")
 
-        results = []
-
-        async def run_one(cmd: list[str], label: str):
-            proc = subprocess.run(cmd, capture_output=True, text=True)
-            out = proc.stdout.strip()
-            err = proc.stderr.strip()
-            status = "ok" if proc.returncode == 0 else f"exit {proc.returncode}"
-            results.append((label, status, out, err))
+        cmds: list[tuple[str, list[str]]] = []
 
         # Pixiv пакетно
         if pixiv_items:
@@ -618,7 +1904,9 @@ async def cmd_img(msg: Message, command: CommandObject):
             cmd.extend(extra_tags)
             if download_all:
                 cmd.append("--all")
-            await run_one(cmd, f"pixiv [{len(pixiv_items)}]")
+            if force:
+                cmd.append("--no-resume")   # и не пропускать уже лежащие файлы
+            cmds.append((f"pixiv [{len(pixiv_items)}]", cmd))
 
         # DeviantArt пакетно
         if da_items:
@@ -627,27 +1915,17 @@ async def cmd_img(msg: Message, command: CommandObject):
             cmd.extend(extra_tags)
             if download_all:
                 cmd.append("--all")
-            await run_one(cmd, f"deviantart [{len(da_items)}]")
-
-        # Сводный отчёт
-        lines = []
-        if unknown_items:
-            lines.append("⚠️ Неопознаны: " + ", ".join(map(html.escape, unknown_items)))
+            if force:
+                cmd.append("--no-resume")   # и не пропускать уже лежащие файлы
+            cmds.append((f"deviantart [{len(da_items)}]", cmd))
 
-        for label, status, out, err in results:
-            lines.append(f"— <b>{label}</b>: <code>{status}</code>")
-            if out:
-                # ограничим размер, чтобы не упереться в лимит Telegram
-                out_trim = out[-3500:] if len(out) > 3500 else out
-                lines.append(f"<pre>{html.escape(out_trim)}</pre>")
-            if err:
-                err_trim = err[-1500:] if len(err) > 1500 else err
-                lines.append(f"<pre>{html.escape(err_trim)}</pre>")
-
-        if not lines:
-            lines = ["✅ Готово (без вывода)."]
+        label = " + ".join(c[0] for c in cmds)
+        job = submit_download(label, msg.chat.id, cmds, _report_img(unknown_items, skipped))
 
-        await msg.answer("\n".join(lines))
+        await msg.answer(
+            f"⏳ Загрузка <code>{job.job_id}</code> поставлена в очередь: {html.escape(label)}.\n"
+            f"Отчёт придёт сюда, статус — <code>/jobs {job.job_id}</code>."
+        )
 
     except Exception as e:
         logger.exception("Ошибка в /img: %s", e)
@@ -671,31 +1949,11 @@ async def cmd_dl(msg: Message, command: CommandObject):
     out_dir.mkdir(parents=True, exist_ok=True)
 
     try:
-        env = {**os.environ, "PYTHONIOENCODING": "utf-8"}
-        result = subprocess.run(
-            [sys.executable, str(BASE_DIR / "pixiv_dl.py"),
-             "--id", pixiv_id, "--tags", extra_tag, "--out", str(out_dir)],
-            cwd=str(BASE_DIR),
-            capture_output=True,
-            text=True,
-            env=env,
-        )
-
-        stdout = (result.stdout or "").strip()
-        stderr = (result.stderr or "").strip()
-
-        if result.returncode != 0:
-            return await msg.answer(
-                "❌ Ошибка Pixiv:\n<pre>{}</pre>".format(html.escape(stderr or stdout or "no output")),
-                parse_mode=ParseMode.HTML,
-            )
-
-        await msg.answer(
-            "✅ Pixiv → <code>{}</code>\n<pre>{}</pre>".format(
-                html.escape(str(out_dir)), html.escape(stdout or "Скрипт отработал без вывода")
-            ),
-            parse_mode=ParseMode.HTML,
-        )
+        argv = [sys.executable, str(BASE_DIR / "pixiv_dl.py"),
+                "--id", pixiv_id, "--tags", extra_tag, "--out", str(out_dir)]
+        job = submit_download(f"pixiv {pixiv_id}", msg.chat.id, [("pixiv", argv)],
+                              _report_single("Pixiv", out_dir))
+        await msg.answer(f"⏳ Pixiv: загрузка <code>{job.job_id}</code> поставлена в очередь.")
     except Exception as e:
         logger.exception("Ошибка в /dl: %s", e)
         await msg.answer(f"❌ Ошибка запуска: {e}")
@@ -719,36 +1977,17 @@ async def cmd_dl_da(msg: Message, command: CommandObject):
     out_dir.mkdir(parents=True, exist_ok=True)
 
     try:
-        env = {**os.environ, "PYTHONIOENCODING": "utf-8"}
-        result = subprocess.run(
-            [sys.executable, str(BASE_DIR / "deviantart_dl.py"),
-             "--id", dev_id, "--tags", tag, "--out", str(out_dir)],
-            cwd=str(BASE_DIR),
-            capture_output=True,
-            text=True,
-            env=env,
-        )
-
-        stdout = (result.stdout or "").strip()
-        stderr = (result.stderr or "").strip()
-
-        if result.returncode != 0:
-            return await msg.answer(
-                "❌ Ошибка DeviantArt:\n<pre>{}</pre>".format(html.escape(stderr or stdout or "no output")),
-                parse_mode=ParseMode.HTML,
-            )
-
-        await msg.answer(
-            "✅ DeviantArt → <code>{}</code>\n<pre>{}</pre>".format(
-                html.escape(str(out_dir)), html.escape(stdout or "Скрипт отработал без вывода")
-            ),
-            parse_mode=ParseMode.HTML,
-        )
+        argv = [sys.executable, str(BASE_DIR / "deviantart_dl.py"),
+                "--id", dev_id, "--tags", tag, "--out", str(out_dir)]
+        job = submit_download(f"deviantart {dev_id}", msg.chat.id, [("deviantart", argv)],
+                              _report_single("DeviantArt", out_dir))
+        await msg.answer(f"⏳ DeviantArt: загрузка <code>{job.job_id}</code> поставлена в очередь.")
     except Exception as e:
         logger.exception("Ошибка в /dl_da: %s", e)
         await msg.answer(f"❌ Ошибка запуска: {e}")
 
 
+
 # ---------- Точка входа ----------
 
 async def main():
@@ -757,6 +1996,24 @@ async def main():
     IMAGES_DIR.mkdir(parents=True, exist_ok=True)
     USED_DIR.mkdir(parents=True, exist_ok=True)
 
+    # индекс очереди строим один раз, дальше он обновляется точечно;
+    # файлы очереди попадают в него через проверку (уже проверенные — сразу из кэша)
+    if validator is not None:
+        validator.start()
+    for idx in (pending_index, used_index):
+        await idx.reconcile()
+    logger.info("Индекс: в очереди %d (на проверке %d), в used %d",
+                len(pending_index), len(validator or ()), len(used_index))
+    # кулдаун авторов переживает перезапуск: восстанавливаем по истории публикаций
+    for name in reversed(state_store.history_recent(AUTHOR_COOLDOWN)):
+        pending_index.selector.posted(author_of(Path(name)))
+    logger.info("Выбор постов: %s", pending_index.selector.describe())
+    if PREP_ENABLED and PREP_DIR.exists():
+        try:
+            await prune_prepared()   # файлы, ушедшие из очереди, пока бот не работал
+        except Exception as e:
+            logger.error("Ошибка чистки %s: %s", PREP_DIR, e)
+
     # Узнаём кто мы
     me = await bot.get_me()
     CURRENT_BOT_ID = me.id
@@ -765,6 +2022,12 @@ async def main():
                 CURRENT_BOT_ID, CURRENT_BOT_USERNAME, _out_dir_for_current_bot())
 
     asyncio.create_task(scheduler_loop())
+    if INDEX_RECONCILE_SEC > 0:
+        asyncio.create_task(index_reconcile_loop())
+    if PHASH_ENABLED:
+        asyncio.create_task(build_phash_index())
+    for n in range(DL_WORKERS):
+        asyncio.create_task(download_worker(n))
     await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
 
 
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import argparse
+import html
 import os
 import re
 import sys
@@ -13,6 +14,9 @@ import requests
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
 
+from http_client import download_to, get_session
+from image_prep import AVAILABLE as PREP_AVAILABLE, VariantPool
+
 # --- Фикс кодировки Windows-консоли (безопасно на Linux) ---
 try:
     sys.stdout.reconfigure(encoding="utf-8")
@@ -25,6 +29,13 @@ load_dotenv()
 OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", "./images")).resolve()
 DEFAULT_TAGS = [t.strip() for t in (os.getenv("DEFAULT_TAGS", "")).split() if t.strip()]
 
+CHUNK_SIZE = 256 * 1024  # столько максимум держим в памяти на одну загрузку
+# Докачка: уже скачанные картинки пропускаются, оборванные .part докачиваются (--no-resume — выкл.)
+DL_RESUME = os.getenv("DL_RESUME", "1").strip() != "0"
+# Сразу после скачивания готовить копию для Telegram и превью в фоне (image_prep; --no-variants — выкл.)
+DL_VARIANTS = PREP_AVAILABLE and os.getenv("DL_VARIANTS", os.getenv("PREP", "1")).strip() != "0"
+DL_VARIANT_WORKERS = max(1, int(os.getenv("DL_VARIANT_WORKERS", "1")))
+
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
 
 # Примеры URL:
@@ -33,6 +44,15 @@ UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like
 ID_RE = re.compile(r"(\d{6,})")
 URL_ID_RE = re.compile(r"deviantart\.com/(?:deviation/|.+?/art/.+?-)(\d+)", re.I)
 IMG_EXT_RE = re.compile(r"\.(jpg|jpeg|png|gif|webp)(?:\?|$)", re.I)
+# имена, которые пишет run_single: ...(www.deviantart.com_user_art_slug-ID)title[_pN][ (i)].ext
+SAVED_ID_RE = re.compile(r"\((?:www\.)?deviantart\.com_[^)]*?[-_](\d{6,})\)")
+SAVED_PAGE_RE = re.compile(r"_p(\d+)(?: \(\d+\))?\.\w+$")
+
+# Быстрый разбор страницы без DOM: <meta> только из <head>, тела <script> — поиском по строке
+HEAD_END_RE = re.compile(r"</head\s*>", re.I)
+META_TAG_RE = re.compile(r"<meta\b([^>]*)>", re.I)
+ATTR_RE = re.compile(r"""([\w:.-]+)\s*=\s*(?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""")
+SCRIPT_OPEN_RE = re.compile(r"<script\b[^>]*>", re.I)
 
 
 # ----------------- Утилиты -----------------
@@ -79,22 +99,68 @@ def guess_ext_from_url(url: str) -> str:
     return ("." + m.group(1).lower()) if m else ".jpg"
 
 
-def get_soup(sess: requests.Session, url: str) -> BeautifulSoup:
+def fetch_page(sess: requests.Session, url: str) -> str:
     headers = {"User-Agent": UA, "Referer": url}
     r = sess.get(url, headers=headers, timeout=25)
     r.raise_for_status()
-    return BeautifulSoup(r.text, "html.parser")
+    return r.text
+
+
+def scan_meta(page: str) -> Tuple[dict, dict]:
+    """
+    <meta> из <head> без построения дерева: ({property: content}, {name: content}).
+    Как и soup.find, для повторяющихся берётся первое. Если </head> нет — вся страница.
+    """
+    m = HEAD_END_RE.search(page)
+    head = page[:m.start()] if m else page
+    props: dict = {}
+    names: dict = {}
+    for tag in META_TAG_RE.finditer(head):
+        attrs = {}
+        for a in ATTR_RE.finditer(tag.group(1)):
+            value = a.group(2) if a.group(2) is not None else a.group(3) if a.group(3) is not None else a.group(4)
+            attrs.setdefault(a.group(1).lower(), value)
+        content = html.unescape(attrs.get("content") or "").strip()
+        if "property" in attrs:
+            props.setdefault(attrs["property"], content)
+        if "name" in attrs:
+            names.setdefault(attrs["name"], content)
+    return props, names
+
+
+def iter_script_texts(page: str) -> Iterable[str]:
+    """Содержимое <script>...</script> по порядку — поиском подстрок, без DOM."""
+    pos = 0
+    while True:
+        m = SCRIPT_OPEN_RE.search(page, pos)
+        if not m:
+            return
+        end = page.find("</script", m.end())
+        if end < 0:
+            return
+        yield page[m.end():end]
+        pos = end + 9
+
+
+def extract_from_meta_fast(page: str) -> Tuple[str, str, List[str]]:
+    """То же, что extract_from_meta, но по сырому HTML (scan_meta)."""
+    props, names = scan_meta(page)
+    return meta_fields(lambda prop: props.get(prop) or names.get(prop) or "")
 
 
 def extract_from_meta(soup: BeautifulSoup) -> Tuple[str, str, List[str]]:
     """
-    Основной способ: og:/twitter: мета.
+    Основной способ: og:/twitter: мета (медленный путь через soup — запасной).
     Возвращаем (title, canonical_url, [image_urls]).
     """
     def mprop(prop):
         el = soup.find("meta", attrs={"property": prop}) or soup.find("meta", attrs={"name": prop})
         return (el.get("content") or "").strip() if el else ""
 
+    return meta_fields(mprop)
+
+
+def meta_fields(mprop) -> Tuple[str, str, List[str]]:
     og_title = mprop("og:title") or mprop("twitter:title")
     og_url   = mprop("og:url")
     og_img   = mprop("og:image") or mprop("twitter:image")
@@ -106,60 +172,167 @@ def extract_from_meta(soup: BeautifulSoup) -> Tuple[str, str, List[str]]:
     return og_title, og_url, imgs
 
 
-def try_extract_nextdata_all_images(soup: BeautifulSoup) -> Tuple[Optional[str], Optional[str], List[str]]:
+STATE_MARKERS = ("__INITIAL_STATE__", "__NEXT_DATA__", "__PRELOADED_STATE__")
+STATE_MAX_NODES = 300_000  # обход JSON не дольше этого числа узлов, даже на огромных страницах
+_json_decoder = json.JSONDecoder()
+
+
+def _decode_state_script(txt: str, marker_pos: int):
     """
-    Фоллбек: пробуем найти все возможные URL изображений в больших JSON-скриптах (Next.js/initial state).
-    Возвращаем (title|None, canonical_url|None, [image_urls]).
+    JSON после маркера: объект-литерал (= {...}) или строка в JSON.parse("...").
+    raw_decode читает ровно одно значение и не требует, чтобы скрипт на нём кончался.
+    """
+    parse_at = txt.find("JSON.parse(", marker_pos)
+    brace_at = txt.find("{", marker_pos)
+    if parse_at >= 0 and (brace_at < 0 or parse_at < brace_at):
+        q = parse_at + len("JSON.parse(")
+        while q < len(txt) and txt[q] in " \t\r\n":
+            q += 1
+        if q >= len(txt) or txt[q] != '"':
+            return None  # строку в одинарных кавычках JSON не прочитает
+        try:
+            inner, _ = _json_decoder.raw_decode(txt, q)
+        except ValueError:
+            # JS-экранирование \' внутри "..." — в JSON такого нет
+            try:
+                inner, _ = _json_decoder.raw_decode(txt[q:].replace("\\'", "'"))
+            except ValueError:
+                return None
+        try:
+            return json.loads(inner)
+        except (ValueError, RecursionError):
+            return None
+    if brace_at < 0:
+        return None
+    try:
+        return _json_decoder.raw_decode(txt, brace_at)[0]
+    except (ValueError, RecursionError):
+        return None
+
+
+def find_state_blob(scripts: List[str]):
+    """Разобранное состояние страницы из того <script>, где есть маркер; None, если такого нет."""
+    for txt in scripts:
+        for marker in STATE_MARKERS:
+            pos = txt.find(marker)
+            if pos >= 0:
+                obj = _decode_state_script(txt, pos + len(marker))
+                if obj is not None:
+                    return obj
+    return None
+
+
+def media_urls(media: dict) -> List[str]:
+    """
+    URL картинки из объекта media состояния DeviantArt: fullview (baseUri + путь
+    с подставленным prettyName) или сам baseUri; token добавляется как ?token=.
+    """
+    base = media.get("baseUri")
+    if not isinstance(base, str) or not base:
+        return []
+    pretty = media.get("prettyName") or ""
+    tokens = media.get("token")
+    token = tokens[0] if isinstance(tokens, list) and tokens else None
+    url = base
+    for t in media.get("types") or []:
+        if isinstance(t, dict) and t.get("t") == "fullview" and isinstance(t.get("c"), str):
+            url = base.rstrip("/") + "/" + t["c"].lstrip("/").replace("<prettyName>", pretty)
+            break
+    if token:
+        url += ("&" if "?" in url else "?") + "token=" + token
+    return [url] if IMG_EXT_RE.search(url.split("?", 1)[0]) else []
+
+
+def _deviation_media(dev: dict, state) -> List[str]:
+    """Основная картинка и дополнительные (additionalMedia) для найденного объекта работы."""
+    urls = media_urls(dev["media"])
+    extended = dev.get("extended")
+    if not isinstance(extended, dict) and isinstance(state, dict):
+        ents = state.get("@@entities")
+        if isinstance(ents, dict):
+            extended = (ents.get("deviationExtended") or {}).get(str(dev.get("deviationId")))
+    for extra in (extended or {}).get("additionalMedia") or []:
+        if isinstance(extra, dict) and isinstance(extra.get("media"), dict):
+            urls.extend(media_urls(extra["media"]))
+    return urls
+
+
+def walk_json(obj, deviation_id: Optional[str] = None, max_nodes: int = STATE_MAX_NODES,
+              ) -> Tuple[Optional[str], Optional[str], List[str], bool]:
+    """
+    Итеративный обход (порядок как у рекурсивного: узел, затем дети по порядку)
+    со стеком вместо рекурсии и лимитом узлов. Собирает title, canonical и URL
+    картинок (src/href/url). Если встречен объект работы deviation_id с media —
+    сразу возвращает его данные: (title, canonical, urls, True).
     """
     title = None
     canonical = None
     image_urls: List[str] = []
+    seen = set()
+    stack = [obj]
+    nodes = 0
+    while stack and nodes < max_nodes:
+        o = stack.pop()
+        nodes += 1
+        if isinstance(o, dict):
+            if (deviation_id and isinstance(o.get("media"), dict)
+                    and str(o.get("deviationId")) == deviation_id):
+                urls = _deviation_media(o, obj)
+                if urls:
+                    t = o.get("title")
+                    u = o.get("url")
+                    return (t.strip() if isinstance(t, str) and t.strip() else title,
+                            u if isinstance(u, str) and u else canonical,
+                            unique_preserve_order(urls), True)
+            if not title:
+                t = o.get("title")
+                if isinstance(t, str) and t.strip():
+                    title = t.strip()
+            if not canonical:
+                u = o.get("url")
+                if isinstance(u, str) and "deviantart.com" in u:
+                    canonical = u
+            for k in ("src", "href", "url"):
+                v = o.get(k)
+                if isinstance(v, str) and v not in seen and IMG_EXT_RE.search(v):
+                    seen.add(v)
+                    image_urls.append(v)
+            children = [v for v in o.values() if isinstance(v, (dict, list))]
+        elif isinstance(o, list):
+            children = [v for v in o if isinstance(v, (dict, list))]
+        else:
+            continue
+        stack.extend(reversed(children))
+    return title, canonical, image_urls, False
 
-    def add_url(u: str):
-        if not u:
-            return
-        if IMG_EXT_RE.search(u) and u not in image_urls:
-            image_urls.append(u)
 
-    for sc in soup.find_all("script"):
-        txt = sc.string or sc.text or ""
-        if not txt or ("{" not in txt or "}" not in txt):
-            continue
+def try_extract_nextdata_all_images(scripts: Iterable[str], deviation_id: Optional[str] = None,
+                                    ) -> Tuple[Optional[str], Optional[str], List[str]]:
+    """
+    Фоллбек: URL изображений из JSON состояния страницы (initial state / Next.js).
+    scripts — тексты <script> (iter_script_texts или из soup).
+    Сначала ищем один скрипт с состоянием и обходим только его; если такого нет —
+    как раньше, пробуем JSON в каждом скрипте (с общим лимитом узлов).
+    Возвращаем (title|None, canonical_url|None, [image_urls]).
+    """
+    scripts = list(scripts)
+    blob = find_state_blob(scripts)
+    if blob is not None:
+        title, canonical, urls, _ = walk_json(blob, deviation_id)
+        return title, canonical, urls
+
+    # все разобранные скрипты обходим как один список: общий лимит узлов и общий дедуп
+    objs = []
+    for txt in scripts:
         start = txt.find("{")
-        end = txt.rfind("}")
-        if start < 0 or end <= start:
+        if start < 0:
             continue
-        jtxt = txt[start:end+1]
-
         try:
-            obj = json.loads(jtxt)
-        except Exception:
+            objs.append(_json_decoder.raw_decode(txt, start)[0])
+        except (ValueError, RecursionError):
             continue
-
-        def walk(o):
-            nonlocal title, canonical
-            if isinstance(o, dict):
-                if not title:
-                    t = o.get("title")
-                    if isinstance(t, str) and t.strip():
-                        title = t.strip()
-                if not canonical:
-                    u = o.get("url")
-                    if isinstance(u, str) and "deviantart.com" in u:
-                        canonical = u
-                for k in ("src", "href", "url"):
-                    v = o.get(k)
-                    if isinstance(v, str):
-                        add_url(v)
-                for v in o.values():
-                    walk(v)
-            elif isinstance(o, list):
-                for v in o:
-                    walk(v)
-
-        walk(obj)
-
-    return title, canonical, image_urls
+    title, canonical, urls, _ = walk_json(objs, deviation_id)
+    return title, canonical, urls
 
 
 def unique_preserve_order(items: Iterable[str]) -> List[str]:
@@ -189,16 +362,31 @@ def build_token_from_canonical(canonical_url: str, fallback_id: Optional[str]) -
     return "deviantart.com"
 
 
-def download_image(sess: requests.Session, img_url: str, referer_url: str) -> bytes:
+def download_image(sess: requests.Session, img_url: str, referer_url: str, out_dir: Path,
+                   part: Optional[Path] = None) -> Path:
+    """
+    Потоково качает картинку в .part-файл в out_dir и возвращает его путь.
+    part — постоянное имя для докачки; без него временный файл удаляется при ошибке.
+    """
     if not img_url:
         raise RuntimeError("Не найдено изображение (image_url пуст).")
     headers = {
         "User-Agent": UA,
         "Referer": referer_url or "https://www.deviantart.com/",
     }
-    r = sess.get(img_url, headers=headers, timeout=30)
-    r.raise_for_status()
-    return r.content
+    return download_to(sess, img_url, headers, out_dir, part, chunk_size=CHUNK_SIZE)
+
+
+def scan_existing(out_dir: Path) -> dict:
+    """Уже скачанные работы в out_dir: {ID: {номер картинки: файл}}; файл без _pN — картинка 0."""
+    found: dict = {}
+    for p in out_dir.iterdir():
+        m = SAVED_ID_RE.search(p.name)
+        if not m or not p.is_file():
+            continue
+        pm = SAVED_PAGE_RE.search(p.name)
+        found.setdefault(m.group(1), {}).setdefault(int(pm.group(1)) if pm else 0, p)
+    return found
 
 
 def make_filename(token: str, title: str, tags: List[str]) -> str:
@@ -207,15 +395,25 @@ def make_filename(token: str, title: str, tags: List[str]) -> str:
     return f"[{tag_block}]({token}){safe_title}"
 
 
-def collect_all_images(sess: requests.Session, url: str) -> Tuple[str, str, List[str]]:
-    """
-    Возвращает (title, canonical_url, [image_urls...]) со страницы DeviantArt.
-    Сначала meta, затем JSON; объединяем и убираем дубли; при необходимости парсим <img>.
-    """
-    soup = get_soup(sess, url)
+def extract_page_fast(page: str, url: str) -> Tuple[str, str, List[str]]:
+    """Быстрый путь: meta из <head> + JSON из тел <script>, без DOM."""
+    title1, canonical1, imgs1 = extract_from_meta_fast(page)
+    title2, canonical2, imgs2 = try_extract_nextdata_all_images(iter_script_texts(page), parse_id(url))
+    return (
+        title1 or title2 or "",
+        canonical1 or canonical2 or url,
+        unique_preserve_order([*(imgs1 or []), *(imgs2 or [])]),
+    )
+
+
+def extract_page_soup(page: str, url: str) -> Tuple[str, str, List[str]]:
+    """Полный разбор через BeautifulSoup; дополнительно ищет картинки в <img>."""
+    soup = BeautifulSoup(page, "html.parser")
 
     title1, canonical1, imgs1 = extract_from_meta(soup)
-    title2, canonical2, imgs2 = try_extract_nextdata_all_images(soup)
+    title2, canonical2, imgs2 = try_extract_nextdata_all_images(
+        (sc.string or sc.text or "" for sc in soup.find_all("script")), parse_id(url)
+    )
 
     title = title1 or title2 or ""
     canonical = canonical1 or canonical2 or url
@@ -230,40 +428,99 @@ def collect_all_images(sess: requests.Session, url: str) -> Tuple[str, str, List
     return title, canonical, images
 
 
-def run_single(art_input: str, out_dir: Path, extra_tags: List[str], download_all: bool) -> List[Path]:
-    """Скачивает одно «произведение»: одну или все картинки."""
-    url = make_artwork_url(art_input)
-    out_dir.mkdir(parents=True, exist_ok=True)
+def collect_all_images(sess: requests.Session, url: str) -> Tuple[str, str, List[str]]:
+    """
+    Возвращает (title, canonical_url, [image_urls...]) со страницы DeviantArt.
+    Сначала быстрый разбор без DOM; soup — только если так картинок не нашлось.
+    """
+    return extract_page(fetch_page(sess, url), url)
+
+
+def extract_page(page: str, url: str) -> Tuple[str, str, List[str]]:
+    title, canonical, images = extract_page_fast(page, url)
+    if images:
+        return title, canonical, images
+    return extract_page_soup(page, url)
+
+
+_variants: Optional[VariantPool] = None   # фоновая подготовка копий (open_variants)
 
-    with requests.Session() as sess:
-        title, canonical, images = collect_all_images(sess, url)
-        if not images:
-            raise SystemExit("Не удалось определить URL(ы) изображения со страницы.")
 
-        token = build_token_from_canonical(canonical, parse_id(art_input))
-        tags = (extra_tags or []) if extra_tags else DEFAULT_TAGS
-        base_name = make_filename(token, title, tags)
+def open_variants() -> None:
+    global _variants
+    if DL_VARIANTS and _variants is None:
+        _variants = VariantPool(DL_VARIANT_WORKERS)
 
-        saved: List[Path] = []
-        to_download = images if download_all else images[:1]
 
-        for idx, img_url in enumerate(to_download):
-            data = download_image(sess, img_url, referer_url=canonical)
-            ext = guess_ext_from_url(img_url)
-            suffix = f"_p{idx}" if download_all else ""
+def close_variants() -> None:
+    """Дожидается подготовки копий (процесс не должен выйти раньше)."""
+    global _variants
+    if _variants is None:
+        return
+    for path, e in _variants.close():
+        print(f"[warn] Копия/превью для {path.name} не сделаны: {e}")
+    _variants = None
 
-            out_path = out_dir / f"{base_name}{suffix}{ext}"
-            final_path = out_path
-            i = 1
-            while final_path.exists():
-                final_path = out_dir / f"{out_path.stem} ({i}){ext}"
-                i += 1
 
-            final_path.write_bytes(data)
-            print(f"Saved: {final_path}")
-            saved.append(final_path)
+def run_single(art_input: str, out_dir: Path, extra_tags: List[str], download_all: bool,
+               existing: Optional[dict] = None) -> List[Path]:
+    """
+    Скачивает одно «произведение»: одну или все картинки.
+    existing — режим докачки (индекс scan_existing, пополняется): уже лежащие
+    картинки не качаются заново, а .part-файлы докачиваются.
+    """
+    url = make_artwork_url(art_input)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    resume = existing is not None
+    dev_id = parse_id(art_input)
+    have = existing.get(dev_id, {}) if resume and dev_id else {}
+    if not download_all and 0 in have:
+        print(f"Exists: {have[0]}")   # страницу даже не запрашиваем
+        return [have[0]]
+
+    # общая сессия процесса: соединения к deviantart.com и CDN переживают работы пакета
+    sess = get_session()
+    title, canonical, images = collect_all_images(sess, url)
+    if not images:
+        raise SystemExit("Не удалось определить URL(ы) изображения со страницы.")
+
+    token = build_token_from_canonical(canonical, parse_id(art_input))
+    tags = (extra_tags or []) if extra_tags else DEFAULT_TAGS
+    base_name = make_filename(token, title, tags)
+    dev_id = dev_id or parse_id(canonical)
+    resume = resume and bool(dev_id)   # без ID не по чему узнавать файлы
+    if resume:
+        have = existing.setdefault(dev_id, {})
+
+    saved: List[Path] = []
+    to_download = images if download_all else images[:1]
+
+    for idx, img_url in enumerate(to_download):
+        if idx in have:
+            print(f"Exists: {have[idx]}")
+            saved.append(have[idx])
+            continue
+        part = out_dir / f".dl-da-{dev_id}-p{idx}.part" if resume else None
+        part = download_image(sess, img_url, referer_url=canonical, out_dir=out_dir, part=part)
+        ext = guess_ext_from_url(img_url)
+        suffix = f"_p{idx}" if download_all else ""
+
+        out_path = out_dir / f"{base_name}{suffix}{ext}"
+        final_path = out_path
+        i = 1
+        while final_path.exists():
+            final_path = out_dir / f"{out_path.stem} ({i}){ext}"
+            i += 1
+
+        os.replace(part, final_path)
+        print(f"Saved: {final_path}")
+        saved.append(final_path)
+        if _variants is not None:
+            _variants.submit(final_path)
+        if resume:
+            have[idx] = final_path
 
-        return saved
+    return saved
 
 
 # ----------------- CLI -----------------
@@ -291,6 +548,10 @@ def main():
     # Общие опции
     parser.add_argument("--out", default=str(OUTPUT_DIR), help="Выходная папка")
     parser.add_argument("--all", dest="download_all", action="store_true", help="Скачать все картинки со страницы")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", default=DL_RESUME,
+                        help="Качать заново, даже если работа уже есть в папке (копии получат (1), (2)...)")
+    parser.add_argument("--no-variants", dest="variants", action="store_false", default=DL_VARIANTS,
+                        help="Не готовить копии для Telegram и превью после скачивания")
 
     args = parser.parse_args()
 
@@ -318,13 +579,19 @@ def main():
     # 3) Куда сохраняем
     out_dir = Path(args.out).resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
+    existing = scan_existing(out_dir) if args.resume else None
 
-    # 4) Обрабатываем список
-    for tok in tokens:
-        try:
-            run_single(tok, out_dir, extra_tags, download_all)
-        except Exception as e:
-            print(f"[error] {tok}: {e}")
+    # 4) Обрабатываем список (копии и превью готовятся в фоне, пока качаются следующие)
+    if args.variants:
+        open_variants()
+    try:
+        for tok in tokens:
+            try:
+                run_single(tok, out_dir, extra_tags, download_all, existing)
+            except Exception as e:
+                print(f"[error] {tok}: {e}")
+    finally:
+        close_variants()
 
 
 if __name__ == "__main__":
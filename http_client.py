@@ -0,0 +1,458 @@
+"""
+Общий HTTP-клиент загрузчиков (pixiv_dl, deviantart_dl).
+
+Одна сессия на процесс: соединения к pixiv.net, i.pximg.net, deviantart.com
+и CDN wixmp живут между работами пакета (keep-alive), а не открываются
+заново на каждую. Размер пула задаётся на хост.
+
+Если установлен httpx с поддержкой HTTP/2 (pip install "httpx[http2]"), и
+HTTP2 не выключен, используется он: запросы к одному хосту мультиплексируются
+в одном соединении. Интерфейс — подмножество requests, которым пользуются
+загрузчики (get, stream=True, iter_content, raise_for_status, json, text).
+
+Поверх любого из них — PacedSession: темп запросов на хост (token bucket,
+который сам замедляется после 429 и разгоняется на успехах), повторы с
+экспоненциальной задержкой и учётом Retry-After, и «предохранитель» хоста
+после серии неудач. download_to докачивает файл через Range.
+"""
+import email.utils
+import importlib.util
+import os
+import random
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+from urllib.parse import urlsplit
+
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+    HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None   # без h2 httpx умеет только HTTP/1.1
+except ImportError:  # HTTP/2 просто не используется
+    httpx = None
+    HTTP2_AVAILABLE = False
+
+
+# загрузчики читают .env после импорта этого модуля, а настройки ниже нужны сразу
+load_dotenv()
+
+
+def _parse_host_values(s: str) -> dict[str, float]:
+    """«i.pximg.net=8, www.deviantart.com=2» → {хост: число}."""
+    values = {}
+    for pair in (s or "").split(","):
+        host, sep, value = pair.partition("=")
+        try:
+            if sep and host.strip():
+                values[host.strip().lower()] = float(value)
+        except ValueError:
+            continue
+    return values
+
+
+def _parse_host_pools(s: str) -> dict[str, int]:
+    return {h: max(1, int(v)) for h, v in _parse_host_values(s).items()}
+
+
+HTTP_PER_HOST = max(1, int(os.getenv("HTTP_PER_HOST", "4")))   # соединений на хост по умолчанию
+HTTP_HOST_POOLS = _parse_host_pools(os.getenv("HTTP_HOST_POOLS", ""))
+HTTP2 = HTTP2_AVAILABLE and os.getenv("HTTP2", "1").strip() != "0"
+# Темп: запросов в секунду на хост (потолок, до которого разгоняемся) и нижняя граница после 429
+HTTP_RATE = float(os.getenv("HTTP_RATE", "4"))
+HTTP_RATE_MIN = float(os.getenv("HTTP_RATE_MIN", "0.2"))
+HTTP_HOST_RATES = _parse_host_values(os.getenv("HTTP_HOST_RATES", ""))   # «www.pixiv.net=1.5, i.pximg.net=8»
+# Повторы: 429, 5xx и сетевые ошибки; задержка base*2^n со случайным разбросом, но не меньше Retry-After
+HTTP_RETRIES = max(0, int(os.getenv("HTTP_RETRIES", "4")))
+HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "1"))
+HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "120"))
+# Предохранитель: после стольких неудач подряд хост не трогаем HTTP_BREAKER_SEC секунд
+HTTP_BREAKER_FAILS = max(1, int(os.getenv("HTTP_BREAKER_FAILS", "5")))
+HTTP_BREAKER_SEC = float(os.getenv("HTTP_BREAKER_SEC", "60"))
+CHUNK_SIZE = 256 * 1024
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+NETWORK_ERRORS = (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError)
+
+
+# ---------- requests (HTTP/1.1) ----------
+
+def make_requests_session(per_host: int = HTTP_PER_HOST, host_pools: Optional[dict] = None) -> requests.Session:
+    """
+    requests.Session с пулами: per_host соединений на любой хост, для хостов из
+    host_pools — свой размер. pool_block: при нехватке соединений поток ждёт,
+    а не открывает лишнее.
+    """
+    sess = requests.Session()
+    default = HTTPAdapter(pool_connections=8, pool_maxsize=per_host, pool_block=True)
+    sess.mount("https://", default)
+    sess.mount("http://", default)
+    for host, size in (HTTP_HOST_POOLS if host_pools is None else host_pools).items():
+        # requests выбирает адаптер по самому длинному префиксу URL
+        sess.mount(f"https://{host}/", HTTPAdapter(pool_connections=1, pool_maxsize=size, pool_block=True))
+    return sess
+
+
+# ---------- httpx (HTTP/2) ----------
+
+def _translate(e: Exception) -> Exception:
+    """Сетевые ошибки httpx → исключения requests, чтобы вызывающему было всё равно, какой клиент."""
+    if isinstance(e, httpx.TimeoutException):
+        return requests.Timeout(str(e))
+    return requests.ConnectionError(str(e))
+
+
+class Http2Response:
+    """Ответ httpx с методами requests, которые нужны загрузчикам."""
+
+    def __init__(self, resp, release):
+        self._resp = resp
+        self._release = release       # освобождает слот хоста; вызывается один раз при close()
+        self.status_code = resp.status_code
+        self.headers = resp.headers
+        self.url = str(resp.url)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self) -> None:
+        self._resp.close()
+        if self._release is not None:
+            self._release()
+            self._release = None
+
+    @property
+    def text(self) -> str:
+        return self._resp.text
+
+    def json(self):
+        return self._resp.json()
+
+    def iter_content(self, chunk_size: int = 64 * 1024):
+        try:
+            yield from self._resp.iter_bytes(chunk_size)
+        except httpx.TransportError as e:
+            raise _translate(e) from e
+
+    def raise_for_status(self) -> None:
+        # то же исключение, что у requests: загрузчики и ретраи разбирают только его
+        if self.status_code >= 400:
+            raise requests.HTTPError(f"{self.status_code} Error for url: {self.url}", response=self)
+
+
+class Http2Session:
+    """
+    Обёртка над httpx.Client(http2=True). В HTTP/2 запросы к хосту идут одним
+    соединением, поэтому размер «пула» хоста — это число одновременных запросов
+    к нему (семафор), как pool_block у requests.
+    """
+
+    def __init__(self, per_host: int = HTTP_PER_HOST, host_pools: Optional[dict] = None):
+        self.per_host = per_host
+        self.host_pools = HTTP_HOST_POOLS if host_pools is None else host_pools
+        self._sems: dict[str, threading.BoundedSemaphore] = {}
+        self._lock = threading.Lock()
+        self._client = httpx.Client(http2=True, follow_redirects=True)
+
+    def _slot(self, host: str) -> threading.BoundedSemaphore:
+        with self._lock:
+            sem = self._sems.get(host)
+            if sem is None:
+                sem = self._sems[host] = threading.BoundedSemaphore(self.host_pools.get(host, self.per_host))
+            return sem
+
+    def get(self, url: str, headers: Optional[dict] = None, timeout: float = 30,
+            stream: bool = False) -> Http2Response:
+        req = self._client.build_request("GET", url, headers=headers, timeout=timeout)
+        sem = self._slot(req.url.host)
+        sem.acquire()
+        try:
+            resp = self._client.send(req, stream=True)
+        except httpx.TransportError as e:
+            sem.release()
+            raise _translate(e) from e
+        except BaseException:
+            sem.release()
+            raise
+        r = Http2Response(resp, sem.release)
+        if not stream:
+            # тело читаем сразу и отпускаем слот, как requests без stream
+            try:
+                resp.read()
+            except httpx.TransportError as e:
+                raise _translate(e) from e
+            finally:
+                r.close()
+        return r
+
+    def close(self) -> None:
+        self._client.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---------- темп, повторы, предохранитель ----------
+
+class CircuitOpen(RuntimeError):
+    """Хост временно отключён предохранителем — запрос даже не отправлялся."""
+
+
+class HostPacer:
+    """
+    Token bucket на каждый хост. Темп адаптивный (AIMD): 429 вдвое снижает
+    скорость, каждый успешный ответ понемногу возвращает её к потолку.
+    """
+
+    def __init__(self, rate: float = HTTP_RATE, min_rate: float = HTTP_RATE_MIN,
+                 host_rates: Optional[dict] = None):
+        self.rate = rate
+        self.min_rate = min_rate
+        self.host_rates = HTTP_HOST_RATES if host_rates is None else host_rates
+        self._state: dict[str, list] = {}   # хост -> [текущий темп, токены, время пополнения]
+        self._lock = threading.Lock()
+
+    def _get(self, host: str) -> list:
+        st = self._state.get(host)
+        if st is None:
+            st = self._state[host] = [self.max_rate(host), 1.0, time.monotonic()]
+        return st
+
+    def max_rate(self, host: str) -> float:
+        return self.host_rates.get(host, self.rate)
+
+    def acquire(self, host: str) -> None:
+        if self.max_rate(host) <= 0:
+            return  # 0 — без ограничения
+        while True:
+            with self._lock:
+                st = self._get(host)
+                now = time.monotonic()
+                # запас не больше секунды работы на текущем темпе (минимум 1 запрос)
+                st[1] = min(max(1.0, st[0]), st[1] + (now - st[2]) * st[0])
+                st[2] = now
+                if st[1] >= 1:
+                    st[1] -= 1
+                    return
+                wait = (1 - st[1]) / st[0]
+            time.sleep(wait)
+
+    def slow_down(self, host: str) -> None:
+        with self._lock:
+            st = self._get(host)
+            st[0] = max(self.min_rate, st[0] / 2)
+
+    def speed_up(self, host: str) -> None:
+        with self._lock:
+            st = self._get(host)
+            top = self.max_rate(host)
+            st[0] = min(top, st[0] + top / 20)
+
+    def current(self, host: str) -> float:
+        with self._lock:
+            return self._get(host)[0]
+
+
+class CircuitBreaker:
+    """
+    После fails неудач подряд (уже с повторами) хост «открыт» на cooldown
+    секунд: запросы сразу падают с CircuitOpen. Потом пропускается пробный
+    запрос; успех закрывает предохранитель, неудача снова открывает.
+    """
+
+    def __init__(self, fails: int = HTTP_BREAKER_FAILS, cooldown: float = HTTP_BREAKER_SEC):
+        self.fails = fails
+        self.cooldown = cooldown
+        self._state: dict[str, list] = {}   # хост -> [неудач подряд, открыт до (monotonic)]
+        self._lock = threading.Lock()
+
+    def check(self, host: str) -> None:
+        with self._lock:
+            st = self._state.get(host)
+            if st and st[1] > time.monotonic():
+                raise CircuitOpen(f"{host}: {st[0]} ошибок подряд, запросы на паузе ещё {st[1] - time.monotonic():.0f} с")
+
+    def success(self, host: str) -> None:
+        with self._lock:
+            self._state.pop(host, None)
+
+    def failure(self, host: str) -> None:
+        with self._lock:
+            st = self._state.setdefault(host, [0, 0.0])
+            st[0] += 1
+            if st[0] >= self.fails:
+                st[1] = time.monotonic() + self.cooldown
+
+
+def retry_after_sec(r) -> Optional[float]:
+    """Retry-After в секундах (число или HTTP-дата) или None."""
+    value = (r.headers.get("Retry-After") or "").strip()
+    if not value:
+        return None
+    if value.isdigit():
+        return float(value)
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max(0.0, when.timestamp() - time.time())
+
+
+def backoff_sec(attempt: int) -> float:
+    """Экспоненциальная задержка с полным разбросом: случайно от 0 до base*2^attempt."""
+    return random.uniform(0, min(HTTP_BACKOFF_MAX, HTTP_BACKOFF_BASE * (2 ** attempt)))
+
+
+class PacedSession:
+    """
+    Сессия (requests или Http2Session) с темпом на хост, повторами и
+    предохранителем. get() возвращает ответ, как обычно; если все попытки
+    исчерпаны на 429/5xx — последний ответ (raise_for_status сработает у
+    вызывающего), на сетевых ошибках — исключение.
+    """
+
+    def __init__(self, inner, pacer: Optional[HostPacer] = None, breaker: Optional[CircuitBreaker] = None,
+                 retries: int = HTTP_RETRIES):
+        self.inner = inner
+        self.pacer = pacer or HostPacer()
+        self.breaker = breaker or CircuitBreaker()
+        self.retries = retries
+
+    def get(self, url: str, headers: Optional[dict] = None, timeout: float = 30, stream: bool = False):
+        host = (urlsplit(url).hostname or "").lower()
+        self.breaker.check(host)
+        for attempt in range(self.retries + 1):
+            last = attempt == self.retries
+            self.pacer.acquire(host)
+            try:
+                r = self.inner.get(url, headers=headers, timeout=timeout, stream=stream)
+            except NETWORK_ERRORS:
+                if last:
+                    self.breaker.failure(host)
+                    raise
+                time.sleep(backoff_sec(attempt))
+                continue
+            if r.status_code not in RETRY_STATUSES:
+                self.pacer.speed_up(host)
+                self.breaker.success(host)
+                return r
+            if r.status_code == 429:
+                self.pacer.slow_down(host)
+            if last:
+                self.breaker.failure(host)
+                return r
+            delay = max(backoff_sec(attempt), min(retry_after_sec(r) or 0, HTTP_BACKOFF_MAX))
+            r.close()
+            time.sleep(delay)
+        raise AssertionError("unreachable")
+
+    def close(self) -> None:
+        self.inner.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# ---------- докачка ----------
+
+def download_to(sess, url: str, headers: dict, out_dir: Path, part: Optional[Path] = None,
+                timeout: float = 30, retries: int = HTTP_RETRIES, chunk_size: int = CHUNK_SIZE) -> Path:
+    """
+    Потоково качает url в .part-файл в out_dir и возвращает его путь.
+    part — постоянное имя для режима докачки: если такой файл уже есть,
+    запрашивается остаток (Range: bytes=N-), а при обрыве он остаётся на
+    диске до следующего запуска. Без part — временный файл, который при
+    ошибке удаляется. Обрыв посреди тела повторяется с места остановки
+    (retries раз); сетевые ошибки до ответа повторяет sess.
+    В памяти одновременно не больше chunk_size байт.
+    """
+    keep_partial = part is not None
+    if part is None:
+        # не mkstemp: тот создаёт файл с правами 0600, и они достались бы картинке;
+        # обычный open берёт права по umask, "x" не даст занять чужое имя
+        while True:
+            part = out_dir / f".dl-{uuid.uuid4().hex[:12]}.part"
+            try:
+                open(part, "xb").close()
+                break
+            except FileExistsError:
+                continue
+    try:
+        for attempt in range(retries + 1):
+            have = part.stat().st_size if part.exists() else 0
+            req_headers = dict(headers)
+            if have:
+                req_headers["Range"] = f"bytes={have}-"
+            # соединение и ответ повторяет сама сессия (PacedSession); здесь — только обрывы посреди тела
+            r = sess.get(url, headers=req_headers, timeout=timeout, stream=True)
+            try:
+                with r:
+                    if have and r.status_code == 416:
+                        # .part уже целиком (bytes */N, N == have) — готово; иначе он от другого файла
+                        if (r.headers.get("Content-Range") or "").rpartition("/")[2] == str(have):
+                            return part
+                        part.unlink(missing_ok=True)
+                        continue
+                    r.raise_for_status()
+                    total = None
+                    if have and r.status_code == 206:
+                        mode = "ab"
+                        cr = r.headers.get("Content-Range") or ""      # bytes 100-999/1000
+                        if not cr.startswith(f"bytes {have}-"):
+                            raise RuntimeError(f"Сервер вернул не тот диапазон: {cr!r}")
+                        size = cr.rpartition("/")[2]
+                        total = int(size) if size.isdigit() else None
+                    else:
+                        mode = "wb"   # Range не поддержан (200) — пишем с начала
+                        length = r.headers.get("Content-Length")
+                        if length and not r.headers.get("Content-Encoding"):
+                            total = int(length)
+                    with open(part, mode) as f:
+                        for chunk in r.iter_content(chunk_size):
+                            f.write(chunk)
+                written = part.stat().st_size
+                if total is not None and written != total:
+                    raise RuntimeError(f"Файл скачан не полностью: {written} из {total} байт")
+                return part
+            except NETWORK_ERRORS:
+                if attempt == retries:
+                    raise
+                time.sleep(backoff_sec(attempt))
+        raise RuntimeError("Не удалось докачать файл: сервер не принимает Range")
+    except BaseException:
+        if not keep_partial:
+            part.unlink(missing_ok=True)
+        raise
+
+
+# ---------- сессия процесса ----------
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session(per_host: int = HTTP_PER_HOST) -> PacedSession:
+    """
+    Общая на процесс сессия (создаётся при первом вызове, потокобезопасно):
+    темп, повторы и предохранитель тоже общие на все потоки.
+    Закрывать не нужно: живёт до конца процесса, соединения переиспользуются.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            inner = Http2Session(per_host) if HTTP2 else make_requests_session(per_host)
+            _session = PacedSession(inner)
+        return _session
@@ -0,0 +1,159 @@
+"""
+Поиск почти-дубликатов картинок по перцептивному хэшу (dHash / pHash).
+
+Одна и та же работа часто приходит и с Pixiv, и с DeviantArt, или как копия
+«name (1).png» — байты разные, а картинка та же. Хэш считается один раз на
+файл (кэш по пути+размеру+mtime в state.db), поиск соседей — через BK-дерево
+по расстоянию Хэмминга, без перебора всей очереди.
+
+Нужны numpy и Pillow; без них модуль импортируется, но AVAILABLE = False.
+"""
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+
+try:
+    import numpy as np
+    from PIL import Image
+    AVAILABLE = True
+except ImportError:  # дедупликация по картинке просто выключается
+    np = None
+    Image = None
+    AVAILABLE = False
+
+
+# ---------- хэши ----------
+
+def _bits_to_int(bits) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), "big")
+
+
+def dhash(img, size: int = 8) -> int:
+    """Разностный хэш: сравнение соседних пикселей уменьшенной серой картинки (size*size бит)."""
+    px = np.asarray(img.convert("L").resize((size + 1, size), Image.LANCZOS), dtype=np.int16)
+    return _bits_to_int(px[:, 1:] > px[:, :-1])
+
+
+_DCT_CACHE: dict[int, "np.ndarray"] = {}
+
+
+def _dct_matrix(n: int):
+    m = _DCT_CACHE.get(n)
+    if m is None:
+        k = np.arange(n)
+        m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n))
+        m[0] *= 1 / np.sqrt(2)
+        m *= np.sqrt(2 / n)
+        _DCT_CACHE[n] = m
+    return m
+
+
+def phash(img, size: int = 8, highfreq: int = 4) -> int:
+    """pHash: низкочастотный блок 2D-DCT (матричным умножением) против его медианы."""
+    n = size * highfreq
+    px = np.asarray(img.convert("L").resize((n, n), Image.LANCZOS), dtype=np.float64)
+    d = _dct_matrix(n)
+    low = (d @ px @ d.T)[:size, :size]
+    return _bits_to_int(low > np.median(low))
+
+
+HASHERS: dict[str, Callable] = {"dhash": dhash, "phash": phash}
+
+
+def image_hash(path: Path, method: str = "dhash") -> int:
+    with Image.open(path) as img:
+        img.draft("L", (256, 256))   # JPEG декодируется сразу в уменьшенном виде — быстро и без лишней памяти
+        return HASHERS[method](img)
+
+
+# ---------- BK-дерево ----------
+
+class BKTree:
+    """
+    Метрическое дерево по расстоянию Хэмминга: поиск всех хэшей в радиусе r
+    обходит только ветки с |d - r| <= расстояние до узла <= d + r.
+    """
+
+    def __init__(self):
+        self._root: Optional[list] = None     # узел: [hash, set(ключей), {расстояние: узел}]
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    def add(self, h: int, key: str) -> None:
+        self._size += 1
+        if self._root is None:
+            self._root = [h, {key}, {}]
+            return
+        node = self._root
+        while True:
+            d = (node[0] ^ h).bit_count()
+            if d == 0:
+                node[1].add(key)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [h, {key}, {}]
+                return
+            node = child
+
+    def search(self, h: int, radius: int) -> Iterator[tuple[int, str]]:
+        if self._root is None:
+            return
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = (node[0] ^ h).bit_count()
+            if d <= radius:
+                for key in node[1]:
+                    yield d, key
+            for cd, child in node[2].items():
+                if d - radius <= cd <= d + radius:
+                    stack.append(child)
+
+
+class PerceptualIndex:
+    """
+    Хэши файлов очереди и used-папки + BK-дерево над ними.
+    Удаление ленивое: ключ убирается из alive, дерево периодически перестраивается.
+    Ключ — строковый путь файла.
+    """
+
+    def __init__(self, method: str = "dhash"):
+        self.method = method
+        self.alive: dict[str, int] = {}
+        self._tree = BKTree()
+
+    def __len__(self) -> int:
+        return len(self.alive)
+
+    def add(self, key: str, h: int) -> None:
+        if self.alive.get(key) == h:
+            return
+        self.alive[key] = h
+        self._tree.add(h, key)
+
+    def discard(self, key: str) -> None:
+        if self.alive.pop(key, None) is not None and len(self._tree) > 2 * len(self.alive) + 1000:
+            self._rebuild()
+
+    def rename(self, old_key: str, new_key: str) -> None:
+        h = self.alive.pop(old_key, None)
+        if h is not None:
+            self.add(new_key, h)
+
+    def _rebuild(self) -> None:
+        self._tree = BKTree()
+        for key, h in self.alive.items():
+            self._tree.add(h, key)
+
+    def find_similar(self, h: int, radius: int, exclude: str = "",
+                     where: Optional[Callable[[str], bool]] = None) -> list[tuple[int, str]]:
+        """Живые ключи в радиусе radius, ближайшие первыми."""
+        out = [
+            (d, key) for d, key in self._tree.search(h, radius)
+            if key != exclude and self.alive.get(key) is not None and (where is None or where(key))
+        ]
+        # в дереве могли остаться старые записи ключа с другим хэшем — сверяемся с alive
+        out = [(d, key) for d, key in out if (self.alive[key] ^ h).bit_count() == d]
+        return sorted(set(out))
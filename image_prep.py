@@ -0,0 +1,365 @@
+"""
+Подготовка картинок к отправке фото в Telegram.
+
+send_photo принимает не больше 10 МБ, сумму сторон до 10000 px и отношение
+сторон до 20, а всё, что больше 2560 px, Telegram всё равно пережимает у
+себя. Оригиналы с Pixiv бывают по 30+ МБ — грузить их как есть значит тратить
+канал и ловить отказ. prepare_photo делает уменьшенную JPEG-копию, если она
+нужна; вызывается в пуле процессов (функции модуля — верхнего уровня, их
+можно передавать в ProcessPoolExecutor).
+
+Загрузчики могут делать это сразу после скачивания (make_variants в
+VariantPool): копия для send_photo и маленькое превью кладутся в PREP_DIR
+под хэшем содержимого, а размеры и байты — в индекс VariantIndex рядом.
+Бот потом берёт готовое и не тратит CPU в момент поста.
+
+Нужен Pillow; без него модуль импортируется, но AVAILABLE = False.
+"""
+import hashlib
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Optional
+
+from dotenv import load_dotenv
+
+try:
+    from PIL import Image, ImageOps
+    AVAILABLE = True
+except ImportError:  # подготовка выключается, файлы уходят как есть
+    Image = None
+    ImageOps = None
+    AVAILABLE = False
+
+# общие настройки бота и загрузчиков (импорт раньше, чем вызывающий прочтёт .env)
+load_dotenv()
+PREP_DIR = Path(os.getenv("PREP_DIR", "./prepared")).resolve()
+PREP_MAX_SIDE = int(os.getenv("PREP_MAX_SIDE", "2560"))    # больше Telegram всё равно не показывает (0 — не трогать)
+PREP_QUALITY = int(os.getenv("PREP_QUALITY", "90"))
+THUMB_SIDE = 320                                           # превью документа: Telegram берёт до 320 px и 200 КБ
+THUMB_MAX_BYTES = 200 * 1024
+INDEX_NAME = "index.db"
+
+TG_PHOTO_MAX_BYTES = 10 * 1024 * 1024
+TG_MAX_SIDES_SUM = 10000    # ширина + высота фото
+TG_MAX_RATIO = 20           # отношение большей стороны к меньшей
+MIN_QUALITY = 60            # ниже не пережимаем: лучше уменьшить размер
+
+
+def photo_problem(width: int, height: int, size: int, max_side: int, max_bytes: int) -> Optional[str]:
+    """Почему файл нельзя (или не стоит) слать как есть; None — можно."""
+    if size > max_bytes:
+        return f"{size / 1024 / 1024:.1f} МБ"
+    if width + height > TG_MAX_SIDES_SUM:
+        return f"{width}x{height} px"
+    if max_side and max(width, height) > max_side:
+        return f"больше {max_side} px"
+    return None
+
+
+def _flatten(im):
+    """JPEG без прозрачности и палитры: прозрачное — на белый фон."""
+    if im.mode in ("RGBA", "LA") or (im.mode == "P" and "transparency" in im.info):
+        im = im.convert("RGBA")
+        bg = Image.new("RGB", im.size, (255, 255, 255))
+        bg.paste(im, mask=im.getchannel("A"))
+        return bg
+    return im.convert("RGB") if im.mode != "RGB" else im
+
+
+def _temp_near(dst: str) -> str:
+    """
+    Уникальный временный файл рядом с dst: одну и ту же копию могут готовить
+    сразу двое (бот и загрузчик, предзагрузка и пост) — общий dst.tmp они бы
+    перемешали, и в кэш попал бы битый JPEG.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(dst) or ".", prefix=".", suffix=".tmp")
+    os.close(fd)
+    return tmp
+
+
+def prepare_photo(src: str, dst: str, max_side: int, max_bytes: int, quality: int = 90) -> bool:
+    """
+    Если src не годится для send_photo как есть — пишет в dst уменьшенный JPEG
+    и возвращает True; если годится (или это анимация) — False, dst не трогает.
+    ValueError — такую картинку фото не сделать (слишком вытянутая).
+    """
+    size = os.path.getsize(src)
+    with Image.open(src) as im:
+        if getattr(im, "is_animated", False):
+            return False    # анимацию пережатие сломает
+        im = ImageOps.exif_transpose(im)   # EXIF в копию не попадёт — поворачиваем сразу
+        w, h = im.size
+        if max(w, h) > TG_MAX_RATIO * max(1, min(w, h)):
+            raise ValueError(f"отношение сторон {w}x{h} больше {TG_MAX_RATIO}")
+        if photo_problem(w, h, size, max_side, max_bytes) is None:
+            return False
+
+        scale = min(1.0, TG_MAX_SIDES_SUM / (w + h))
+        if max_side:
+            scale = min(scale, max_side / max(w, h))
+        im = _flatten(im)
+        if scale < 1:
+            im = im.resize((max(1, round(w * scale)), max(1, round(h * scale))), Image.LANCZOS)
+
+        tmp = _temp_near(dst)
+        try:
+            while True:
+                im.save(tmp, "JPEG", quality=quality, optimize=True, progressive=True)
+                if os.path.getsize(tmp) <= max_bytes:
+                    break
+                if quality > MIN_QUALITY:
+                    quality -= 10
+                else:
+                    im = im.resize((max(1, im.width * 3 // 4), max(1, im.height * 3 // 4)), Image.LANCZOS)
+            os.replace(tmp, dst)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+    return True
+
+
+def decode_problem(src: str) -> Optional[str]:
+    """
+    Декодируется ли картинка до конца (обрезанная загрузка или HTML вместо
+    картинки не пройдут). None — да, иначе причина. JPEG декодируется
+    уменьшенным — данные читаются все, но быстрее.
+    """
+    try:
+        with Image.open(src) as im:
+            im.draft("RGB", (1024, 1024))
+            im.load()
+    except Exception as e:   # OSError, SyntaxError, DecompressionBombError...
+        return f"не декодируется: {e}"
+    return None
+
+
+def make_thumbnail(src: str, dst: str, side: int = THUMB_SIDE) -> None:
+    """JPEG-превью не больше side×side и THUMB_MAX_BYTES."""
+    with Image.open(src) as im:
+        im.draft("RGB", (side * 2, side * 2))   # JPEG декодируется сразу уменьшенным
+        im = _flatten(ImageOps.exif_transpose(im))
+        im.thumbnail((side, side), Image.LANCZOS)
+        tmp = _temp_near(dst)
+        try:
+            for quality in (85, 70, 50, 30):
+                im.save(tmp, "JPEG", quality=quality, optimize=True)
+                if os.path.getsize(tmp) <= THUMB_MAX_BYTES:
+                    break
+            os.replace(tmp, dst)
+        except BaseException:
+            Path(tmp).unlink(missing_ok=True)
+            raise
+
+
+def file_digest(path: str) -> str:
+    """sha256 содержимого — тот же ключ, что у кэша file_id в боте."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def prepared_path(digest: str, prep_dir: Path = PREP_DIR) -> Path:
+    return prep_dir / f"{digest}.jpg"
+
+
+def thumb_path(digest: str, prep_dir: Path = PREP_DIR) -> Path:
+    return prep_dir / f"{digest}.thumb.jpg"
+
+
+def make_variants(src: str, prep_dir: str = str(PREP_DIR)) -> dict:
+    """
+    Всё, что нужно боту для быстрого поста этого файла: копия для send_photo
+    (если оригинал не годится как есть), превью и запись в индекс. Возвращает запись.
+    """
+    folder = Path(prep_dir)
+    folder.mkdir(parents=True, exist_ok=True)
+    digest = file_digest(src)
+    size = os.path.getsize(src)
+    with Image.open(src) as im:
+        width, height = im.size
+        if im.getexif().get(0x0112) in (5, 6, 7, 8):   # EXIF-поворот на 90°: стороны меняются местами
+            width, height = height, width
+    dst = prepared_path(digest, folder)
+    try:
+        prepared = dst.exists() or prepare_photo(src, str(dst), PREP_MAX_SIDE, TG_PHOTO_MAX_BYTES, PREP_QUALITY)
+    except ValueError:
+        prepared = False   # фото из неё не сделать — боту останется документ
+    thumb = thumb_path(digest, folder)
+    if not thumb.exists():
+        make_thumbnail(src, str(thumb))
+    record = {
+        "digest": digest,
+        "name": Path(src).name,
+        "width": width,
+        "height": height,
+        "size": size,
+        "prep_size": dst.stat().st_size if prepared else 0,
+        "thumb_size": thumb.stat().st_size,
+    }
+    index = VariantIndex(folder / INDEX_NAME)
+    try:
+        index.put(record)
+    finally:
+        index.close()
+    return record
+
+
+def process_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    Пул процессов без fork. Пулы создаются лениво, когда у процесса уже есть
+    потоки (to_thread бота, потоки загрузчиков), а fork копирует и блокировки,
+    захваченные ими в этот момент (sqlite, logging, httpx), — рабочий процесс
+    может навсегда на них зависнуть. forkserver (или spawn, где его нет)
+    запускает рабочих из чистого процесса.
+    """
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context(method))
+
+
+class VariantPool:
+    """Фоновые make_variants для только что скачанных файлов (в загрузчиках)."""
+
+    def __init__(self, workers: int = 1, prep_dir: Path = PREP_DIR):
+        self.prep_dir = prep_dir
+        self._pool = process_pool(workers)
+        self._futures: list = []
+
+    def submit(self, path: Path) -> None:
+        self._futures.append((path, self._pool.submit(make_variants, str(path), str(self.prep_dir))))
+
+    def close(self) -> list[tuple[Path, Exception]]:
+        """Дожидается всех задач. Возвращает [(файл, ошибка)] для неудавшихся."""
+        errors = []
+        for path, fut in self._futures:
+            try:
+                fut.result()
+            except Exception as e:
+                errors.append((path, e))
+        self._pool.shutdown()
+        self._futures.clear()
+        return errors
+
+
+VARIANTS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS variants (
+    digest     TEXT PRIMARY KEY,   -- sha256 оригинала
+    name       TEXT NOT NULL,      -- имя файла при скачивании
+    width      INTEGER NOT NULL,
+    height     INTEGER NOT NULL,
+    size       INTEGER NOT NULL,   -- байт в оригинале
+    prep_size  INTEGER NOT NULL,   -- байт в копии для send_photo; 0 — оригинал годится как есть
+    thumb_size INTEGER NOT NULL,
+    created_ts REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS variants_name ON variants(name);
+"""
+
+
+class VariantIndex:
+    """Индекс подготовленных копий (SQLite в PREP_DIR): пишут загрузчики, читает бот."""
+
+    FIELDS = ("digest", "name", "width", "height", "size", "prep_size", "thumb_size")
+
+    def __init__(self, path: Path):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(VARIANTS_SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def put(self, record: dict) -> None:
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO variants(digest, name, width, height, size, prep_size, thumb_size, created_ts)"
+                " VALUES(?, ?, ?, ?, ?, ?, ?, ?)",
+                (*(record[f] for f in self.FIELDS), time.time()),
+            )
+
+    def get(self, digest: str) -> Optional[dict]:
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT {', '.join(self.FIELDS)} FROM variants WHERE digest = ?", (digest,)
+            ).fetchone()
+        return dict(zip(self.FIELDS, row)) if row else None
+
+    def entries(self) -> list[tuple[str, str]]:
+        """Все записи: [(digest, имя файла)]."""
+        with self._lock:
+            return self._db.execute("SELECT digest, name FROM variants").fetchall()
+
+    def drop(self, digests: list[str]) -> None:
+        with self._lock:
+            self._db.executemany("DELETE FROM variants WHERE digest = ?", [(d,) for d in digests])
+
+    def summary(self, names: set[str]) -> tuple[int, int, int]:
+        """По файлам с такими именами: (сколько в индексе, байт в оригиналах, байт к загрузке)."""
+        with self._lock:
+            rows = self._db.execute("SELECT name, size, prep_size FROM variants").fetchall()
+        count = orig = upload = 0
+        for name, size, prep_size in rows:
+            if name in names:
+                count += 1
+                orig += size
+                upload += prep_size or size
+        return count, orig, upload
+
+
+def drop_variants(index: VariantIndex, digests: list[str], prep_dir: Path = PREP_DIR) -> None:
+    """Файл ушёл из очереди — его копия, превью и запись в индексе больше не нужны."""
+    for d in digests:
+        prepared_path(d, prep_dir).unlink(missing_ok=True)
+        thumb_path(d, prep_dir).unlink(missing_ok=True)
+    index.drop(digests)
+
+
+def sweep_variants(index: VariantIndex, folder: Path, prep_dir: Path = PREP_DIR) -> int:
+    """
+    drop_variants для всех записей, чьих файлов больше нет в folder (опубликованы,
+    дубликаты, карантин, удалены руками). Возвращает число удалённых записей.
+    """
+    # сначала записи, потом папка: загрузчик пишет запись уже после файла, так что свежая не пропадёт
+    rows = index.entries()
+    with os.scandir(folder) as it:
+        present = {e.name for e in it}
+    gone = [digest for digest, name in rows if name not in present]
+    if gone:
+        drop_variants(index, gone, prep_dir)
+    return len(gone)
+
+
+def prune_dir(folder: Path, max_bytes: int) -> int:
+    """
+    Удаляет самые старые (по mtime) копии и превью (*.jpg), пока они занимают
+    больше max_bytes. Возвращает число удалённых.
+    """
+    files = []
+    total = 0
+    with os.scandir(folder) as it:
+        for e in it:
+            if e.is_file() and e.name.endswith(".jpg"):
+                st = e.stat()
+                files.append((st.st_mtime, st.st_size, e.path))
+                total += st.st_size
+    removed = 0
+    for _, size, path in sorted(files):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+        removed += 1
+    return removed
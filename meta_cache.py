@@ -0,0 +1,88 @@
+"""
+Дисковый кэш JSON-ответов (метаданные Pixiv) с TTL и ограничением размера.
+
+SQLite, а не файлы: загрузчик качает в несколько потоков, а бот может
+запустить несколько загрузчиков сразу — WAL и транзакции это выдерживают.
+Протухшие записи не отдаются; при превышении max_bytes вытесняются те,
+к которым дольше всего не обращались.
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS cache (
+    key        TEXT PRIMARY KEY,
+    value      TEXT NOT NULL,
+    size       INTEGER NOT NULL,
+    fetched_ts REAL NOT NULL,      -- когда получено с сайта (для TTL)
+    last_used  REAL NOT NULL       -- когда читали последний раз (для вытеснения)
+);
+CREATE INDEX IF NOT EXISTS cache_last_used ON cache(last_used);
+"""
+
+
+class MetaCache:
+    def __init__(self, path: Path, ttl_sec: float, max_bytes: int):
+        self.path = path
+        self.ttl_sec = ttl_sec
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None, timeout=30)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")   # кэш: потеря последних записей при сбое не страшна
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def get(self, key: str) -> Optional[Any]:
+        """Значение, если оно есть и моложе TTL; иначе None."""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT value FROM cache WHERE key = ? AND fetched_ts > ?", (key, now - self.ttl_sec)
+            ).fetchone()
+            if row:
+                self._db.execute("UPDATE cache SET last_used = ? WHERE key = ?", (now, key))
+        return json.loads(row[0]) if row else None
+
+    def put(self, key: str, value: Any) -> None:
+        raw = json.dumps(value, ensure_ascii=False, separators=(",", ":"))
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT OR REPLACE INTO cache(key, value, size, fetched_ts, last_used) VALUES(?, ?, ?, ?, ?)",
+                    (key, raw, len(raw), now, now),
+                )
+                self._evict(now)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def _evict(self, now: float) -> None:
+        # сначала всё протухшее, потом самые давно не читанные, пока не влезем в max_bytes
+        self._db.execute("DELETE FROM cache WHERE fetched_ts <= ?", (now - self.ttl_sec,))
+        total = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute("SELECT key, size FROM cache ORDER BY last_used").fetchall()
+        drop = []
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            drop.append((key,))
+            total -= size
+        self._db.executemany("DELETE FROM cache WHERE key = ?", drop)
+
+    def stats(self) -> tuple[int, int]:
+        """(записей, байт)."""
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache").fetchone()
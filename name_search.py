@@ -0,0 +1,111 @@
+"""
+Поиск файлов очереди по имени для /post <часть> и /find.
+
+Инвертированный индекс по триграммам нормализованного имени (регистр,
+скобки и подчёркивания убраны) и по словам (теги, автор, ID источника).
+Индекс обновляется точечно вместе с ImageIndex, поэтому запрос трогает
+только списки своих триграмм, а не всю очередь.
+"""
+import heapq
+import re
+from collections import Counter
+from typing import Iterable, Optional
+
+NON_WORD_RE = re.compile(r"[\W_]+", re.UNICODE)
+
+
+def normalize(text: str) -> str:
+    return NON_WORD_RE.sub(" ", text.lower()).strip()
+
+
+def trigrams(text: str) -> set[str]:
+    padded = f" {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    def __init__(self):
+        self._text: dict[str, str] = {}              # имя файла -> нормализованный текст
+        self._words: dict[str, frozenset[str]] = {}  # имя файла -> слова (для бонуса за точное слово)
+        self._lower: dict[str, str] = {}             # имя в нижнем регистре -> имя (точное совпадение)
+        self._grams: dict[str, set[str]] = {}        # триграмма -> имена файлов
+
+    def __len__(self) -> int:
+        return len(self._text)
+
+    def add(self, name: str, extra: Iterable[str] = ()) -> None:
+        """extra — теги, автор, ID работы: ищутся наравне с самим именем."""
+        if name in self._text:
+            self.discard(name)
+        stem = name.rsplit(".", 1)[0]
+        text = normalize(" ".join([stem, *extra]))
+        self._text[name] = text
+        self._words[name] = frozenset(text.split())
+        self._lower[name.lower()] = name
+        for g in trigrams(text):
+            self._grams.setdefault(g, set()).add(name)
+
+    def discard(self, name: str) -> None:
+        text = self._text.pop(name, None)
+        if text is None:
+            return
+        self._words.pop(name, None)
+        self._lower.pop(name.lower(), None)
+        for g in trigrams(text):
+            names = self._grams.get(g)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._grams[g]
+
+    def exact(self, query: str) -> Optional[str]:
+        return self._lower.get(query.strip().lower())
+
+    def search(self, query: str, limit: int = 10) -> list[tuple[float, str, bool]]:
+        """
+        Ранжированные кандидаты: (оценка, имя, содержит ли запрос целиком).
+        Сначала ищутся имена, содержащие запрос, — пересечением списков его
+        триграмм от короткого к длинному; если таких нет — нечётко, по доле
+        общих триграмм. Бонус за совпадение целых слов, при равенстве — короче имя.
+        """
+        q = normalize(query)
+        if not q:
+            return []
+        exact = self.exact(query)
+        if exact is not None:
+            return [(3.0, exact, True)]
+        qwords = q.split()
+
+        def rank(n: str, base: float) -> tuple[float, int, str]:
+            words = self._words[n]
+            score = base + 0.5 * sum(w in words for w in qwords) / len(qwords)
+            return -score, len(self._text[n]), n
+
+        if len(q) < 3:
+            # одна-две буквы: начало слова (триграмма « ab») или перебор для одной буквы
+            if len(q) == 2:
+                cands = self._grams.get(" " + q, set())
+            else:
+                cands = [n for n, words in self._words.items() if any(w.startswith(q) for w in words)]
+            best = heapq.nsmallest(limit, (rank(n, 2.0) for n in cands))
+            return [(-s, n, True) for s, _, n in best]
+
+        inner = [self._grams.get(q[i:i + 3]) for i in range(len(q) - 2)]
+        if all(inner):
+            inner.sort(key=len)
+            cands = inner[0].intersection(*inner[1:])
+            best = heapq.nsmallest(limit, (rank(n, 2.0) for n in cands if q in self._text[n]))
+            if best:
+                return [(-s, n, True) for s, _, n in best]
+
+        # нечёткий поиск; триграммы, которые есть у большинства файлов, ранжированию не помогают
+        qgrams = trigrams(q)
+        postings = [self._grams.get(g, ()) for g in qgrams]
+        common = max(len(self._text) // 2, 1000)
+        rare = [p for p in postings if len(p) <= common] or postings
+        hits: Counter = Counter()
+        for names in rare:
+            hits.update(names)
+        need = max(1, len(rare) // 2)
+        best = heapq.nsmallest(limit, (rank(n, c / len(qgrams)) for n, c in hits.items() if c >= need))
+        return [(-s, n, False) for s, _, n in best]
@@ -4,12 +4,18 @@ import os
 import re
 import sys
 import pathlib
+import threading
 import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 from typing import Optional, Iterable, List
 
 import requests
 from dotenv import load_dotenv
 
+from http_client import download_to, get_session
+from image_prep import AVAILABLE as PREP_AVAILABLE, VariantPool
+from meta_cache import MetaCache
+
 # --- Фикс кодировки для Windows-консоли (безопасно на Linux) ---
 try:
     sys.stdout.reconfigure(encoding="utf-8")
@@ -27,6 +33,19 @@ PIXIV_PHPSESSID = (
 )
 OUTPUT_DIR = pathlib.Path(os.getenv("OUTPUT_DIR", "./images")).resolve()
 DEFAULT_TAGS = [t.strip() for t in (os.getenv("DEFAULT_TAGS", "")).split() if t.strip()]
+# Параллельный режим: сколько работ/страниц качаем одновременно и сколько соединений держим на хост
+PIXIV_WORKERS = max(1, int(os.getenv("PIXIV_WORKERS", "1")))
+PIXIV_PER_HOST = max(1, int(os.getenv("PIXIV_PER_HOST", "4")))
+CHUNK_SIZE = 256 * 1024  # столько максимум держим в памяти на одну загрузку
+# Кэш ответов /ajax/illust и /pages: повторный /img тех же ID не ходит на pixiv (TTL 0 — выкл.)
+PIXIV_CACHE_DB = pathlib.Path(os.getenv("PIXIV_CACHE_DB", "./pixiv_cache.db"))
+PIXIV_CACHE_TTL = int(os.getenv("PIXIV_CACHE_TTL", str(24 * 3600)))
+PIXIV_CACHE_MAX_MB = int(os.getenv("PIXIV_CACHE_MAX_MB", "50"))
+# Докачка: уже скачанные страницы пропускаются, оборванные .part докачиваются (--no-resume — выкл.)
+DL_RESUME = os.getenv("DL_RESUME", "1").strip() != "0"
+# Сразу после скачивания готовить копию для Telegram и превью в фоне (image_prep; --no-variants — выкл.)
+DL_VARIANTS = PREP_AVAILABLE and os.getenv("DL_VARIANTS", os.getenv("PREP", "1")).strip() != "0"
+DL_VARIANT_WORKERS = max(1, int(os.getenv("DL_VARIANT_WORKERS", "1")))
 
 UA = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
 
@@ -35,6 +54,9 @@ PIXIV_AJAX_PAGES  = "https://www.pixiv.net/ajax/illust/{id}/pages"
 IMG_REFERER_FMT   = "https://www.pixiv.net/en/artworks/{id}"
 
 ID_RE = re.compile(r"(\d{6,})")
+# имена, которые пишет make_filename/save_blob: ...(pixiv.net_en_artworks_ID)title[_pN][ (i)].ext
+SAVED_ID_RE = re.compile(r"\(pixiv\.net_en_artworks_(\d+)\)")
+SAVED_PAGE_RE = re.compile(r"_p(\d+)(?: \(\d+\))?\.\w+$")
 URL_ID_RE = re.compile(r"pixiv\.net/(?:[a-z]{2}/)?artworks/(\d+)", re.I)
 
 
@@ -68,7 +90,70 @@ def sanitize_filename(name: str) -> str:
     return name
 
 
+# ----------------- Кэш метаданных -----------------
+
+_cache: Optional[MetaCache] = None
+_cache_refresh = False   # --refresh: не читать кэш, но обновить его свежими ответами
+_cache_hits = [0, 0]     # [попаданий, промахов] за запуск — для итога (close_cache)
+_cache_hits_lock = threading.Lock()
+
+
+_variants: Optional[VariantPool] = None   # фоновая подготовка копий (open_variants)
+
+
+def open_variants() -> None:
+    global _variants
+    if DL_VARIANTS and _variants is None:
+        _variants = VariantPool(DL_VARIANT_WORKERS)
+
+
+def close_variants() -> None:
+    """Дожидается подготовки копий (процесс не должен выйти раньше)."""
+    global _variants
+    if _variants is None:
+        return
+    for path, e in _variants.close():
+        print(f"[warn] Копия/превью для {path.name} не сделаны: {e}")
+    _variants = None
+
+
+def open_cache(refresh: bool = False) -> None:
+    global _cache, _cache_refresh
+    _cache_refresh = refresh
+    if PIXIV_CACHE_TTL > 0 and _cache is None:
+        try:
+            _cache = MetaCache(PIXIV_CACHE_DB, PIXIV_CACHE_TTL, PIXIV_CACHE_MAX_MB * 1024 * 1024)
+        except Exception as e:
+            print(f"[warn] Кэш метаданных недоступен ({PIXIV_CACHE_DB}): {e}")
+
+
+def close_cache() -> None:
+    """Итог по кэшу в конце запуска: сколько запросов он сэкономил и сколько занимает."""
+    if _cache is None or not sum(_cache_hits):
+        return
+    count, size = _cache.stats()
+    print(f"[cache] попаданий {_cache_hits[0]} из {sum(_cache_hits)}; "
+          f"в кэше {count} записей, {size / 1024 / 1024:.1f} МБ")
+
+
+def cache_get(kind: str, illust_id: str):
+    if _cache is None or _cache_refresh:
+        return None
+    value = _cache.get(f"{kind}:{illust_id}")
+    with _cache_hits_lock:
+        _cache_hits[value is None] += 1
+    return value
+
+
+def cache_put(kind: str, illust_id: str, value) -> None:
+    if _cache is not None:
+        _cache.put(f"{kind}:{illust_id}", value)
+
+
 def get_illust_json(sess: requests.Session, illust_id: str) -> dict:
+    cached = cache_get("illust", illust_id)
+    if cached is not None:
+        return cached
     headers = {
         "User-Agent": UA,
         "Referer": IMG_REFERER_FMT.format(id=illust_id),
@@ -78,11 +163,15 @@ def get_illust_json(sess: requests.Session, illust_id: str) -> dict:
     r.raise_for_status()
     data = r.json()
     if not data.get("error") and data.get("body"):
+        cache_put("illust", illust_id, data["body"])
         return data["body"]
     raise RuntimeError(f"Pixiv ajax error: {data.get('message') or 'unknown'} (id={illust_id})")
 
 
 def get_pages_json(sess: requests.Session, illust_id: str) -> list[dict]:
+    cached = cache_get("pages", illust_id)
+    if cached is not None:
+        return cached
     headers = {
         "User-Agent": UA,
         "Referer": IMG_REFERER_FMT.format(id=illust_id),
@@ -92,6 +181,7 @@ def get_pages_json(sess: requests.Session, illust_id: str) -> list[dict]:
     r.raise_for_status()
     data = r.json()
     if not data.get("error") and data.get("body") is not None:
+        cache_put("pages", illust_id, data["body"])
         return data["body"]
     return []
 
@@ -133,7 +223,13 @@ def iter_all_page_urls(illust: dict, pages: list[dict]) -> Iterable[str]:
             yield url
 
 
-def download_image(sess: requests.Session, url: str, illust_id: str) -> bytes:
+def download_image(sess: requests.Session, url: str, illust_id: str, out_dir: pathlib.Path,
+                   page: Optional[int] = None) -> pathlib.Path:
+    """
+    Потоково качает картинку в .part-файл в out_dir и возвращает его путь.
+    С page (режим докачки) имя .part постоянное: оборванная загрузка
+    продолжится с того же места при следующем запуске.
+    """
     if not url:
         raise RuntimeError("Пустой URL изображения")
     headers = {
@@ -141,9 +237,20 @@ def download_image(sess: requests.Session, url: str, illust_id: str) -> bytes:
         "Referer": IMG_REFERER_FMT.format(id=illust_id),
         "Cookie": f"PHPSESSID={PIXIV_PHPSESSID}",
     }
-    r = sess.get(url, headers=headers, timeout=30)
-    r.raise_for_status()
-    return r.content
+    part = out_dir / f".dl-pixiv-{illust_id}-p{page}.part" if page is not None else None
+    return download_to(sess, url, headers, out_dir, part, chunk_size=CHUNK_SIZE)
+
+
+def scan_existing(out_dir: pathlib.Path) -> dict[str, dict[int, pathlib.Path]]:
+    """Уже скачанные работы в out_dir: {ID: {номер страницы: файл}}; файл без _pN — страница 0."""
+    found: dict[str, dict[int, pathlib.Path]] = {}
+    for p in out_dir.iterdir():
+        m = SAVED_ID_RE.search(p.name)
+        if not m or not p.is_file():
+            continue
+        pm = SAVED_PAGE_RE.search(p.name)
+        found.setdefault(m.group(1), {}).setdefault(int(pm.group(1)) if pm else 0, p)
+    return found
 
 
 def guess_ext_from_url(url: str) -> str:
@@ -158,14 +265,22 @@ def make_filename(illust_id: str, title: str, tags: list[str]) -> str:
     return f"[{tag_block}]({token}){safe_title}"
 
 
-def save_blob(out_dir: pathlib.Path, base: str, ext: str, blob: bytes, suffix: Optional[str] = None) -> pathlib.Path:
+# выбор имени + запись должны быть атомарны относительно других потоков
+_save_lock = threading.Lock()
+
+
+def save_blob(out_dir: pathlib.Path, base: str, ext: str, part: pathlib.Path, suffix: Optional[str] = None) -> pathlib.Path:
+    """Атомарно переименовывает скачанный .part в итоговое имя (с (1), (2)... при коллизии)."""
     name = base + (suffix or "") + ext
-    path = out_dir / name
-    i = 1
-    while path.exists():
-        path = out_dir / f"{base}{suffix or ''} ({i}){ext}"
-        i += 1
-    path.write_bytes(blob)
+    with _save_lock:
+        path = out_dir / name
+        i = 1
+        while path.exists():
+            path = out_dir / f"{base}{suffix or ''} ({i}){ext}"
+            i += 1
+        os.replace(part, path)
+    if _variants is not None:
+        _variants.submit(path)
     return path
 
 
@@ -175,32 +290,80 @@ def process_single(
     out_dir: pathlib.Path,
     extra_tags: list[str],
     download_all: bool,
-) -> list[pathlib.Path]:
-    """Скачивает 1 работу (одну или все страницы). Возвращает список путей."""
-    illust = get_illust_json(sess, illust_id)
-    pages = get_pages_json(sess, illust_id) if int(illust.get("pageCount") or 1) > 1 else []
+    pool: Optional[ThreadPoolExecutor] = None,
+    existing: Optional[dict[int, pathlib.Path]] = None,
+) -> list[tuple[pathlib.Path, bool]]:
+    """
+    Скачивает 1 работу (одну или все страницы). Возвращает [(путь, скачан ли сейчас)].
+    Если передан pool — запросы метаданных и страницы качаются параллельно,
+    но сохраняются строго по порядку (имена файлов те же, что и без пула).
+    Свежие метаданные берутся из кэша — тогда на pixiv идут только картинки.
+    existing — режим докачки: уже лежащие страницы работы {номер: файл}
+    не качаются заново, а .part-файлы докачиваются.
+    """
+    resume = existing is not None
+    existing = existing or {}
+    if not download_all and 0 in existing:
+        return [(existing[0], False)]   # главная страница уже есть — даже метаданные не нужны
+
+    illust = cache_get("illust", illust_id)
+    if illust is None and pool is not None:
+        # /pages запрашиваем сразу, не дожидаясь pageCount; для одиночных работ ответ просто не нужен
+        pages_fut = pool.submit(get_pages_json, sess, illust_id)
+        illust = get_illust_json(sess, illust_id)
+        pages = pages_fut.result() if int(illust.get("pageCount") or 1) > 1 else []
+    else:
+        if illust is None:
+            illust = get_illust_json(sess, illust_id)
+        pages = get_pages_json(sess, illust_id) if int(illust.get("pageCount") or 1) > 1 else []
 
     title = illust.get("title") or ""
     tags  = list(DEFAULT_TAGS) + (extra_tags or [])
     base  = make_filename(illust_id, title, tags)
 
-    saved_paths: list[pathlib.Path] = []
+    saved_paths: list[tuple[pathlib.Path, bool]] = []
 
     if download_all:
-        for idx, url in enumerate(iter_all_page_urls(illust, pages)):
-            ext  = guess_ext_from_url(url)
-            blob = download_image(sess, url, illust_id)
-            suffix = f"_p{idx}"
-            saved_paths.append(save_blob(out_dir, base, ext, blob, suffix))
+        urls = list(iter_all_page_urls(illust, pages))
+        todo = [(idx, u) for idx, u in enumerate(urls) if idx not in existing]
+        futures = []
+        if pool is not None:
+            futures = [pool.submit(download_image, sess, u, illust_id, out_dir, idx if resume else None)
+                       for idx, u in todo]
+            parts = (f.result() for f in futures)
+        else:
+            parts = (download_image(sess, u, illust_id, out_dir, idx if resume else None) for idx, u in todo)
+        saved_paths.extend((existing[idx], False) for idx in range(len(urls)) if idx in existing)
+        try:
+            for (idx, url), part in zip(todo, parts):
+                ext  = guess_ext_from_url(url)
+                suffix = f"_p{idx}"
+                saved_paths.append((save_blob(out_dir, base, ext, part, suffix), True))
+        except BaseException:
+            # не оставляем .part от страниц, которые уже скачались параллельно
+            # (в режиме докачки оставляем: следующий запуск их подхватит)
+            for f in futures:
+                if f.cancel() or resume:
+                    continue
+                try:
+                    f.result().unlink(missing_ok=True)
+                except Exception:
+                    pass
+            raise
     else:
         url  = pick_main_image_url(illust, pages)
         ext  = guess_ext_from_url(url)
-        blob = download_image(sess, url, illust_id)
-        saved_paths.append(save_blob(out_dir, base, ext, blob))
+        part = download_image(sess, url, illust_id, out_dir, 0 if resume else None)
+        saved_paths.append((save_blob(out_dir, base, ext, part), True))
 
     return saved_paths
 
 
+def print_result(paths: list[tuple[pathlib.Path, bool]]) -> None:
+    for p, fresh in paths:
+        print(f"{'Saved' if fresh else 'Exists'}: {p}")
+
+
 # ----------------- CLI -----------------
 
 def main():
@@ -229,6 +392,16 @@ def main():
     # Общие опции
     parser.add_argument("--out", default=str(OUTPUT_DIR), help="Выходная папка")
     parser.add_argument("--all", dest="download_all", action="store_true", help="Скачать все страницы работы")
+    parser.add_argument("--workers", type=int, default=PIXIV_WORKERS,
+                        help="Сколько работ/страниц качать параллельно (1 = последовательно)")
+    parser.add_argument("--per-host", type=int, default=PIXIV_PER_HOST,
+                        help="Максимум одновременных соединений на один хост")
+    parser.add_argument("--refresh", action="store_true",
+                        help="Не брать метаданные из кэша (перезапросить и обновить кэш)")
+    parser.add_argument("--no-resume", dest="resume", action="store_false", default=DL_RESUME,
+                        help="Качать заново, даже если работа уже есть в папке (копии получат (1), (2)...)")
+    parser.add_argument("--no-variants", dest="variants", action="store_false", default=DL_VARIANTS,
+                        help="Не готовить копии для Telegram и превью после скачивания")
 
     args = parser.parse_args()
 
@@ -267,16 +440,49 @@ def main():
 
     if not id_list:
         raise SystemExit("Не удалось извлечь ни одного Pixiv ID.")
+    id_list = list(dict.fromkeys(id_list))   # повтор ID качал бы ту же работу дважды (и в тот же .part)
 
     out_dir = pathlib.Path(args.out).resolve()
     out_dir.mkdir(parents=True, exist_ok=True)
+    existing = scan_existing(out_dir) if args.resume else None
 
-    with requests.Session() as sess:
+    open_cache(refresh=args.refresh)
+    if args.variants:
+        open_variants()
+    try:
+        run_batch(args, id_list, out_dir, extra_tags, download_all, existing)
+    finally:
+        close_variants()
+        close_cache()
+
+
+def run_batch(args, id_list: list[str], out_dir: pathlib.Path, extra_tags: list[str], download_all: bool,
+              existing: Optional[dict]) -> None:
+    workers = max(1, args.workers)
+
+    # общая сессия процесса (http_client): keep-alive между работами, пул на хост
+    sess = get_session(max(1, args.per_host))
+
+    if workers == 1:
         for iid in id_list:
             try:
-                paths = process_single(sess, iid, out_dir, extra_tags, download_all)
-                for p in paths:
-                    print(f"Saved: {p}")
+                print_result(process_single(sess, iid, out_dir, extra_tags, download_all,
+                                            existing=None if existing is None else existing.get(iid, {})))
+            except Exception as e:
+                print(f"[error] {iid}: {e}")
+        return
+
+    # Параллельный режим: отдельные пулы для работ и для страниц (страницы не ждут слотов работ),
+    # результаты печатаем в исходном порядке id_list.
+    with ThreadPoolExecutor(workers) as item_pool, ThreadPoolExecutor(workers) as page_pool:
+        futures = [
+            item_pool.submit(process_single, sess, iid, out_dir, extra_tags, download_all, page_pool,
+                             None if existing is None else existing.get(iid, {}))
+            for iid in id_list
+        ]
+        for iid, fut in zip(id_list, futures):
+            try:
+                print_result(fut.result())
             except Exception as e:
                 print(f"[error] {iid}: {e}")
 
@@ -0,0 +1,348 @@
+"""
+Расписание постинга: фиксированный интервал, cron-выражение или окна с разными
+интервалами, плюс «тихие часы». Всё считается в локальном времени.
+
+Формат (строка, она же хранится в state.json):
+  interval 30m
+  cron */30 9-23 * * *
+  windows 09:00-13:00=30m 18:00-23:30=15m default=2h
+  ... quiet=01:00-08:00            — можно добавить к любому виду, несколько раз
+"""
+import re
+from datetime import datetime, timedelta
+from typing import Optional
+
+DURATION_RE = re.compile(
+    r"^\s*(?:(\d+)\s*d)?\s*(?:(\d+)\s*h)?\s*(?:(\d+)\s*m)?\s*(?:(\d+)\s*s)?\s*$",
+    re.IGNORECASE,
+)
+HHMM_RANGE_RE = re.compile(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$")
+
+
+def parse_duration(s: str) -> int:
+    """
+    '90' -> 90 sec
+    '10m' -> 600
+    '2h30m' -> 9000
+    '1d' -> 86400
+    """
+    s = s.strip().lower()
+    if s.isdigit():
+        total = int(s)
+    else:
+        m = DURATION_RE.match(s)
+        if not m:
+            raise ValueError("Не смог понять интервал. Примеры: 45, 10m, 2h30m, 1d.")
+        d, h, mnt, sec = (int(x) if x else 0 for x in m.groups())
+        total = d * 86400 + h * 3600 + mnt * 60 + sec
+    if total <= 0:   # 0 — деление на ноль в iter_until и пост «каждое мгновение»
+        raise ValueError("Интервал должен быть больше 0 секунд.")
+    return total
+
+
+def humanize_seconds(sec: int) -> str:
+    d, r = divmod(sec, 86400)
+    h, r = divmod(r, 3600)
+    m, s = divmod(r, 60)
+    parts = []
+    if d: parts.append(f"{d}d")
+    if h: parts.append(f"{h}h")
+    if m: parts.append(f"{m}m")
+    if s or not parts: parts.append(f"{s}s")
+    return "".join(parts)
+
+
+def _parse_hhmm_range(s: str) -> tuple[int, int]:
+    """'09:00-13:30' -> (540, 810) в минутах от полуночи. Конец может быть меньше начала (через полночь)."""
+    m = HHMM_RANGE_RE.match(s.strip())
+    if not m:
+        raise ValueError(f"Не понял диапазон времени '{s}'. Пример: 09:00-13:30")
+    h1, m1, h2, m2 = (int(x) for x in m.groups())
+    if h1 > 24 or h2 > 24 or m1 > 59 or m2 > 59:
+        raise ValueError(f"Неверное время в '{s}'")
+    start, end = (h1 * 60 + m1) % 1440, (h2 * 60 + m2) % 1440
+    if start == end:
+        raise ValueError(f"Пустой диапазон '{s}'")
+    return start, end
+
+
+def _fmt_range(start: int, end: int) -> str:
+    return f"{start // 60:02d}:{start % 60:02d}-{end // 60:02d}:{end % 60:02d}"
+
+
+def _minute_of_day(dt: datetime) -> int:
+    return dt.hour * 60 + dt.minute
+
+
+def _in_range(minute: int, start: int, end: int) -> bool:
+    if start < end:
+        return start <= minute < end
+    return minute >= start or minute < end   # через полночь
+
+
+def _next_time_of_day(ts: float, minute: int) -> float:
+    """Ближайший момент строго после ts, когда локальное время равно minute (от полуночи)."""
+    dt = datetime.fromtimestamp(ts)
+    cand = dt.replace(hour=minute // 60, minute=minute % 60, second=0, microsecond=0)
+    if cand.timestamp() <= ts:
+        cand += timedelta(days=1)
+    return cand.timestamp()
+
+
+# ---------- cron ----------
+
+CRON_FIELDS = (
+    ("minute", 0, 59),
+    ("hour", 0, 23),
+    ("day", 1, 31),
+    ("month", 1, 12),
+    ("weekday", 0, 6),    # 0 = воскресенье (7 тоже принимаем)
+)
+
+
+def _parse_cron_field(text: str, lo: int, hi: int, is_weekday: bool = False) -> frozenset[int]:
+    top = 7 if is_weekday else hi     # день недели 7 — тоже воскресенье
+    values: set[int] = set()
+    for part in text.split(","):
+        step = 1
+        if "/" in part:
+            part, step_s = part.split("/", 1)
+            step = int(step_s)
+            if step <= 0:
+                raise ValueError(f"Неверный шаг в cron: '{text}'")
+        if part in ("*", ""):
+            a, b = lo, hi
+        elif "-" in part:
+            a_s, b_s = part.split("-", 1)
+            a, b = int(a_s), int(b_s)
+        else:
+            a = int(part)
+            b = hi if step > 1 else a
+        if not (lo <= a <= b <= top):
+            raise ValueError(f"Значение вне диапазона в cron: '{text}'")
+        values.update(range(a, b + 1, step))
+    if is_weekday and 7 in values:
+        values.discard(7)
+        values.add(0)
+    return frozenset(values)
+
+
+class CronSpec:
+    """Классический 5-полевой cron: минута час день месяц день_недели."""
+
+    def __init__(self, expr: str):
+        fields = expr.split()
+        if len(fields) != 5:
+            raise ValueError("cron: нужно 5 полей — минута час день месяц день_недели")
+        self.expr = " ".join(fields)
+        try:
+            parsed = [
+                _parse_cron_field(f, lo, hi, is_weekday=(name == "weekday"))
+                for f, (name, lo, hi) in zip(fields, CRON_FIELDS)
+            ]
+        except ValueError as e:
+            if "cron" in str(e):
+                raise
+            raise ValueError(f"cron: не понял выражение '{expr}'") from e
+        self.minutes, self.hours, self.days, self.months, self.weekdays = (sorted(p) for p in parsed)
+        self._days_set, self._wd_set = set(self.days), set(self.weekdays)
+        # как в cron: если ограничены и день месяца, и день недели — подходит любой из них
+        self._dom_any = fields[2] == "*"
+        self._dow_any = fields[4] == "*"
+
+    def _day_ok(self, dt: datetime) -> bool:
+        dom_ok = dt.day in self._days_set
+        dow_ok = (dt.isoweekday() % 7) in self._wd_set
+        if self._dom_any and self._dow_any:
+            return True
+        if self._dom_any:
+            return dow_ok
+        if self._dow_any:
+            return dom_ok
+        return dom_ok or dow_ok
+
+    def next_after(self, ts: float) -> float:
+        """
+        Следующее срабатывание строго после ts. Перескакивает целыми месяцами/днями/часами,
+        так что число итераций ограничено, а не пропорционально времени ожидания.
+        """
+        dt = datetime.fromtimestamp(ts).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        for _ in range(5000):
+            if dt.month not in self.months:
+                nxt = next((m for m in self.months if m > dt.month), None)
+                dt = (dt.replace(month=nxt, day=1, hour=0, minute=0) if nxt
+                      else dt.replace(year=dt.year + 1, month=self.months[0], day=1, hour=0, minute=0))
+                continue
+            if not self._day_ok(dt):
+                dt = (dt + timedelta(days=1)).replace(hour=0, minute=0)
+                continue
+            if dt.hour not in self.hours:
+                nxt = next((h for h in self.hours if h > dt.hour), None)
+                dt = (dt.replace(hour=nxt, minute=0) if nxt is not None
+                      else (dt + timedelta(days=1)).replace(hour=0, minute=0))
+                continue
+            if dt.minute not in self.minutes:
+                nxt = next((m for m in self.minutes if m > dt.minute), None)
+                dt = (dt.replace(minute=nxt) if nxt is not None
+                      else (dt + timedelta(hours=1)).replace(minute=0))
+                continue
+            return dt.timestamp()
+        raise ValueError(f"cron '{self.expr}' не срабатывает в обозримом будущем")
+
+
+# ---------- Расписание целиком ----------
+
+class Schedule:
+    """
+    Вид расписания + тихие часы. next_after(ts) — следующий слот строго после ts
+    (ts — запланированный прошлый слот, поэтому каденция не плывёт).
+    """
+
+    def __init__(
+        self,
+        kind: str,
+        interval_sec: int = 0,
+        cron: Optional[CronSpec] = None,
+        windows: Optional[list[tuple[int, int, int]]] = None,
+        default_sec: Optional[int] = None,
+        quiet: Optional[list[tuple[int, int]]] = None,
+    ):
+        self.kind = kind
+        self.interval_sec = interval_sec
+        self.cron = cron
+        self.windows = windows or []          # (начало, конец в минутах от полуночи, интервал в секундах)
+        self.default_sec = default_sec        # интервал вне окон; None — вне окон не постим
+        self.quiet = quiet or []              # (начало, конец) в минутах от полуночи
+
+    # --- следующий слот ---
+
+    def _raw_next(self, ts: float) -> float:
+        if self.kind == "cron":
+            return self.cron.next_after(ts)
+        if self.kind == "windows":
+            return self._windows_next(ts)
+        return ts + self.interval_sec
+
+    def _window_interval(self, minute: int) -> Optional[int]:
+        for start, end, sec in self.windows:
+            if _in_range(minute, start, end):
+                return sec
+        return self.default_sec
+
+    def _windows_next(self, ts: float) -> float:
+        # следующий слот по интервалу текущего окна, но при входе в новое окно — сразу на его начале
+        minute = _minute_of_day(datetime.fromtimestamp(ts))
+        sec = self._window_interval(minute)
+        starts = [_next_time_of_day(ts, start) for start, end, _ in self.windows
+                  if not _in_range(minute, start, end)]
+        nearest_start = min(starts) if starts else None
+        if sec is not None:
+            cand = ts + sec
+            # вне окон не постим (default=off) — значит ждём начала ближайшего окна
+            cand_minute = _minute_of_day(datetime.fromtimestamp(cand))
+            if self._window_interval(cand_minute) is not None:
+                return min(cand, nearest_start) if nearest_start is not None else cand
+        if nearest_start is None:
+            # единственное окно, и мы внутри него: следующее его начало
+            nearest_start = min(_next_time_of_day(ts, start) for start, _, _ in self.windows)
+        return nearest_start
+
+    def _quiet_end(self, ts: float) -> Optional[float]:
+        """Если ts попадает в тихие часы — момент их окончания, иначе None."""
+        minute = _minute_of_day(datetime.fromtimestamp(ts))
+        for start, end in self.quiet:
+            if _in_range(minute, start, end):
+                return _next_time_of_day(ts, end)
+        return None
+
+    def next_after(self, ts: float) -> float:
+        nxt = self._raw_next(ts)
+        for _ in range(len(self.quiet) + 2):
+            end = self._quiet_end(nxt)
+            if end is None:
+                return nxt
+            # cron — следующее срабатывание после тихих часов; остальные — ровно на их конце
+            nxt = self.cron.next_after(end - 1) if self.kind == "cron" else end
+        return nxt
+
+    def iter_until(self, planned: float, now: float, limit: int = 100000) -> tuple[float, int]:
+        """
+        От запланированного слота planned идём вперёд до первого слота после now.
+        Возвращает (этот слот, сколько слотов между ними пропущено).
+        """
+        if self.kind == "interval" and not self.quiet:
+            k = max(int((now - planned) // self.interval_sec) + 1, 1)
+            return planned + k * self.interval_sec, k - 1
+        nxt, missed = self.next_after(planned), 0
+        while nxt <= now and missed < limit:
+            nxt, missed = self.next_after(nxt), missed + 1
+        if nxt <= now:
+            nxt = self.next_after(now)
+        return nxt, missed
+
+    # --- текстовое представление ---
+
+    def to_spec(self) -> str:
+        if self.kind == "cron":
+            parts = ["cron", self.cron.expr]
+        elif self.kind == "windows":
+            parts = ["windows"] + [f"{_fmt_range(s, e)}={humanize_seconds(sec)}" for s, e, sec in self.windows]
+            parts.append(f"default={humanize_seconds(self.default_sec) if self.default_sec else 'off'}")
+        else:
+            parts = ["interval", humanize_seconds(self.interval_sec)]
+        parts += [f"quiet={_fmt_range(s, e)}" for s, e in self.quiet]
+        return " ".join(parts)
+
+    def describe(self) -> str:
+        if self.kind == "interval" and not self.quiet:
+            return humanize_seconds(self.interval_sec)
+        return self.to_spec()
+
+    def with_interval(self, sec: int) -> "Schedule":
+        """Простой интервал (для /settime), тихие часы сохраняются."""
+        return Schedule("interval", interval_sec=sec, quiet=list(self.quiet))
+
+
+def parse_schedule(spec: str) -> Schedule:
+    """Разбирает строку расписания (см. формат в начале модуля). Ошибки — ValueError."""
+    tokens = spec.split()
+    if not tokens:
+        raise ValueError("Пустое расписание")
+
+    quiet = []
+    rest = []
+    for tok in tokens[1:]:
+        if tok.lower().startswith("quiet="):
+            quiet.append(_parse_hhmm_range(tok[6:]))
+        else:
+            rest.append(tok)
+
+    kind = tokens[0].lower()
+    if kind == "interval":
+        if len(rest) != 1:
+            raise ValueError("interval: укажи один интервал, напр. interval 30m")
+        return Schedule("interval", interval_sec=parse_duration(rest[0]), quiet=quiet)
+
+    if kind == "cron":
+        return Schedule("cron", cron=CronSpec(" ".join(rest)), quiet=quiet)
+
+    if kind == "windows":
+        windows = []
+        default_sec: Optional[int] = None
+        for tok in rest:
+            if "=" not in tok:
+                raise ValueError(f"windows: ожидал ЧЧ:ММ-ЧЧ:ММ=интервал, а получил '{tok}'")
+            key, val = tok.split("=", 1)
+            if key.lower() == "default":
+                default_sec = None if val.lower() == "off" else parse_duration(val)
+                continue
+            start, end = _parse_hhmm_range(key)
+            windows.append((start, end, parse_duration(val)))
+        if not windows:
+            raise ValueError("windows: нужно хотя бы одно окно")
+        return Schedule("windows", windows=windows, default_sec=default_sec, quiet=quiet)
+
+    # просто интервал без слова interval: '/schedule 30m'
+    if len(tokens) == 1 + len(quiet):
+        return Schedule("interval", interval_sec=parse_duration(tokens[0]), quiet=quiet)
+    raise ValueError("Не понял расписание. Виды: interval, cron, windows (+ quiet=ЧЧ:ММ-ЧЧ:ММ)")
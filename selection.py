@@ -0,0 +1,380 @@
+"""
+Стратегии выбора следующей картинки для планировщика.
+
+Стратегия — структура над очередью, которую ImageIndex обновляет точечно
+(add/discard), поэтому выбор не строит список файлов и стоит O(log n):
+  random   — равномерно (дерево Фенвика с весами 1)
+  weighted — вес по тегам, домену источника и автору (PICK_WEIGHTS)
+  fifo     — сначала самые старые по времени скачивания (куча по mtime)
+  bag      — «мешок» авторов: за круг каждый автор выходит по разу, в случайном порядке
+Поверх любой — кулдаун авторов: последние N опубликованных авторов не
+выбираются, пока в очереди есть кто-то ещё.
+"""
+import heapq
+import random
+from collections import Counter, deque
+from dataclasses import dataclass
+from typing import Iterable, Optional
+
+
+@dataclass(frozen=True)
+class ItemInfo:
+    name: str
+    author: str = ""               # в нижнем регистре; "" — неизвестен (кулдаун не действует)
+    tags: tuple[str, ...] = ()     # в нижнем регистре
+    domain: str = ""               # домен источника без www.
+    mtime: float = 0.0             # время скачивания (mtime файла)
+
+
+def parse_weights(spec: str) -> dict[tuple[str, str], float]:
+    """
+    «tag:genshin_impact=3, source:deviantart.com=0.5, author:foo=0» →
+    {("tag", "genshin_impact"): 3.0, ...}. Вес 0 — никогда не выбирать.
+    """
+    out: dict[tuple[str, str], float] = {}
+    for part in (spec or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        key, sep, value = part.rpartition("=")
+        kind, sep2, name = key.partition(":")
+        kind = kind.strip().lower()
+        if not sep or not sep2 or kind not in ("tag", "source", "author"):
+            raise ValueError(f"Не понял вес «{part}», нужно tag:|source:|author:<имя>=<число>")
+        try:
+            w = float(value)
+        except ValueError:
+            raise ValueError(f"Вес должен быть числом: «{part}»") from None
+        if w < 0:
+            raise ValueError(f"Вес не может быть отрицательным: «{part}»")
+        out[(kind, name.strip().lower())] = w
+    return out
+
+
+# ---------- общая часть: учёт элементов и кулдаун авторов ----------
+
+class Selector:
+    kind = ""
+    uses_mtime = False      # нужен ли ItemInfo.mtime (лишний stat на каждый файл только для fifo)
+
+    def __init__(self, cooldown: int = 0):
+        self.cooldown = max(0, cooldown)
+        self._items: dict[str, ItemInfo] = {}
+        self._by_author: dict[str, set[str]] = {}
+        self._recent: deque[str] = deque()
+        self._recent_count: Counter = Counter()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def add(self, info: ItemInfo) -> None:
+        if info.name in self._items:
+            self.discard(info.name)
+        self._items[info.name] = info
+        if info.author:
+            self._by_author.setdefault(info.author, set()).add(info.name)
+        self._add(info)
+
+    def discard(self, name: str) -> None:
+        info = self._items.pop(name, None)
+        if info is None:
+            return
+        if info.author:
+            names = self._by_author.get(info.author)
+            if names is not None:
+                names.discard(name)
+                if not names:
+                    del self._by_author[info.author]
+        self._discard(info)
+
+    def cooled(self, author: str) -> bool:
+        return bool(author) and self._recent_count[author] > 0
+
+    def posted(self, author: str) -> None:
+        """Публикация состоялась: автор уходит в кулдаун на следующие self.cooldown постов."""
+        author = (author or "").lower()
+        if not self.cooldown or not author:
+            return
+        self._recent.append(author)
+        self._recent_count[author] += 1
+        if self._recent_count[author] == 1:
+            self._cooldown_changed(author)
+        while len(self._recent) > self.cooldown:
+            old = self._recent.popleft()
+            self._recent_count[old] -= 1
+            if not self._recent_count[old]:
+                del self._recent_count[old]
+                self._cooldown_changed(old)
+
+    def pick(self, exclude: Iterable[str] = ()) -> Optional[str]:
+        """Имя следующего файла (не удаляется — это сделает move_used). exclude — уже отвергнутые."""
+        if not self._items:
+            return None
+        exclude = set(exclude)
+        name = self._pick(exclude, True)
+        if name is None and self._recent_count:
+            # в очереди остались только авторы на кулдауне — лучше повтор, чем пропуск слота
+            name = self._pick(exclude, False)
+        return name
+
+    def describe(self) -> str:
+        text = self.kind
+        if self.cooldown:
+            text += f", кулдаун авторов {self.cooldown}"
+        return text
+
+    # переопределяются стратегиями
+    def _add(self, info: ItemInfo) -> None: ...
+    def _discard(self, info: ItemInfo) -> None: ...
+    def _cooldown_changed(self, author: str) -> None: ...
+    def _pick(self, exclude: set[str], use_cooldown: bool) -> Optional[str]:
+        raise NotImplementedError
+
+
+# ---------- random / weighted: дерево Фенвика по слотам ----------
+
+class WeightedSelector(Selector):
+    """
+    У каждого файла — слот с весом в дереве Фенвика: выбор по префиксной
+    сумме и изменение веса — O(log n). Кулдаун обнуляет веса файлов автора.
+    """
+
+    def __init__(self, weights: Optional[dict] = None, cooldown: int = 0):
+        super().__init__(cooldown)
+        self.weights = weights or {}
+        self.kind = "weighted" if self.weights else "random"
+        self._tree: list[float] = [0.0]          # 1-based
+        self._w: list[float] = []                # текущий (эффективный) вес слота
+        self._base: dict[str, float] = {}        # вес без учёта кулдауна
+        self._slot: dict[str, int] = {}
+        self._names: list[Optional[str]] = []
+        self._free: list[int] = []
+
+    def weight_of(self, info: ItemInfo) -> float:
+        w = 1.0
+        for tag in info.tags:
+            w *= self.weights.get(("tag", tag), 1.0)
+        if info.domain:
+            w *= self.weights.get(("source", info.domain), 1.0)
+        if info.author:
+            w *= self.weights.get(("author", info.author), 1.0)
+        return w
+
+    def _update(self, i: int, delta: float) -> None:
+        i += 1
+        while i < len(self._tree):
+            self._tree[i] += delta
+            i += i & -i
+
+    def _set(self, i: int, w: float) -> None:
+        if w != self._w[i]:
+            self._update(i, w - self._w[i])
+            self._w[i] = w
+
+    def _grow(self) -> None:
+        # удваиваем ёмкость и строим дерево заново за O(n)
+        old, n = len(self._w), max(16, 2 * len(self._w))
+        self._w += [0.0] * (n - old)
+        self._names += [None] * (n - old)
+        self._free.extend(range(n - 1, old - 1, -1))
+        tree = [0.0] + self._w
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self._tree = tree
+
+    def _add(self, info: ItemInfo) -> None:
+        if not self._free:
+            self._grow()
+        i = self._free.pop()
+        self._slot[info.name] = i
+        self._names[i] = info.name
+        base = self.weight_of(info)
+        self._base[info.name] = base
+        self._set(i, 0.0 if self.cooled(info.author) else base)
+
+    def _discard(self, info: ItemInfo) -> None:
+        i = self._slot.pop(info.name)
+        self._base.pop(info.name, None)
+        self._set(i, 0.0)
+        self._names[i] = None
+        self._free.append(i)
+
+    def _cooldown_changed(self, author: str) -> None:
+        cooled = self.cooled(author)
+        for name in self._by_author.get(author, ()):
+            self._set(self._slot[name], 0.0 if cooled else self._base[name])
+
+    def _find(self, target: float) -> int:
+        """Первый слот, на котором префиксная сумма превышает target."""
+        n = len(self._tree) - 1
+        pos, step = 0, 1 << n.bit_length()
+        while step:
+            nxt = pos + step
+            if nxt <= n and self._tree[nxt] <= target:
+                pos = nxt
+                target -= self._tree[nxt]
+            step >>= 1
+        return min(pos, n - 1)
+
+    def _pick(self, exclude: set[str], use_cooldown: bool) -> Optional[str]:
+        if not use_cooldown:
+            # редкий случай: все оставшиеся на кулдауне — выбираем по базовым весам за O(n)
+            names = [n for n, w in self._base.items() if w > 0 and n not in exclude]
+            if not names:
+                return None
+            return random.choices(names, weights=[self._base[n] for n in names])[0]
+        # отвергнутые временно выключаем, чтобы не выпадали снова
+        saved = [(self._slot[n], self._w[self._slot[n]]) for n in exclude if n in self._slot]
+        for i, _ in saved:
+            self._set(i, 0.0)
+        try:
+            total = self._total()
+            if total <= 0:
+                return None
+            i = self._find(random.random() * total)
+            while i < len(self._w) - 1 and self._w[i] <= 0:   # защита от погрешности float на границе
+                i += 1
+            return self._names[i] if self._w[i] > 0 else None
+        finally:
+            for i, w in saved:
+                self._set(i, w)
+
+    def _total(self) -> float:
+        total, i = 0.0, len(self._tree) - 1
+        while i > 0:
+            total += self._tree[i]
+            i -= i & -i
+        return total
+
+
+# ---------- fifo: куча по времени скачивания ----------
+
+class FifoSelector(Selector):
+    """Самый старый файл очереди. Удаление ленивое: мёртвые записи отбрасываются на вершине кучи."""
+
+    kind = "fifo"
+    uses_mtime = True
+
+    def __init__(self, cooldown: int = 0):
+        super().__init__(cooldown)
+        self._heap: list[tuple[float, str]] = []
+
+    def _add(self, info: ItemInfo) -> None:
+        heapq.heappush(self._heap, (info.mtime, info.name))
+
+    def _discard(self, info: ItemInfo) -> None:
+        if len(self._heap) > 2 * len(self._items) + 1000:
+            self._heap = [(i.mtime, n) for n, i in self._items.items()]
+            heapq.heapify(self._heap)
+
+    def _alive(self, entry: tuple[float, str]) -> bool:
+        info = self._items.get(entry[1])
+        return info is not None and info.mtime == entry[0]
+
+    def _pick(self, exclude: set[str], use_cooldown: bool) -> Optional[str]:
+        held = []
+        found = None
+        while self._heap:
+            entry = self._heap[0]
+            if not self._alive(entry):
+                heapq.heappop(self._heap)
+                continue
+            info = self._items[entry[1]]
+            if info.name in exclude or (use_cooldown and self.cooled(info.author)):
+                held.append(heapq.heappop(self._heap))
+                continue
+            found = info.name
+            break
+        for entry in held:
+            heapq.heappush(self._heap, entry)
+        return found
+
+
+# ---------- bag: по разу на автора за круг ----------
+
+class BagSelector(Selector):
+    """
+    Авторы (файлы без автора — одна общая группа) перемешаны в «мешок»;
+    за круг каждый выходит один раз, внутри группы файл случайный.
+    """
+
+    kind = "bag"
+
+    def __init__(self, cooldown: int = 0):
+        super().__init__(cooldown)
+        self._groups: dict[str, list[str]] = {}
+        self._gpos: dict[str, int] = {}
+        self._bag: list[str] = []
+        self._drawn: set[str] = set()
+
+    def _add(self, info: ItemInfo) -> None:
+        g = info.author
+        members = self._groups.get(g)
+        if members is None:
+            members = self._groups[g] = []
+            # новый автор попадает в текущий круг на случайное место — O(1)
+            self._bag.append(g)
+            j = random.randrange(len(self._bag))
+            self._bag[j], self._bag[-1] = self._bag[-1], self._bag[j]
+        self._gpos[info.name] = len(members)
+        members.append(info.name)
+
+    def _discard(self, info: ItemInfo) -> None:
+        members = self._groups[info.author]
+        i = self._gpos.pop(info.name)
+        last = members.pop()
+        if i < len(members):
+            members[i] = last
+            self._gpos[last] = i
+        if not members:
+            del self._groups[info.author]
+
+    def posted(self, author: str) -> None:
+        self._drawn.add((author or "").lower())
+        super().posted(author)
+
+    def _refill(self) -> None:
+        self._bag = list(self._groups)
+        random.shuffle(self._bag)
+        self._drawn.clear()
+
+    def _pick(self, exclude: set[str], use_cooldown: bool) -> Optional[str]:
+        for attempt in range(2):
+            # вершина мешка — в конце списка; отработанные и опустевшие группы выбрасываем
+            while self._bag and (self._bag[-1] in self._drawn or self._bag[-1] not in self._groups):
+                self._bag.pop()
+            if not self._bag:
+                self._refill()
+            for g in reversed(self._bag):
+                if g in self._drawn or g not in self._groups:
+                    continue
+                if use_cooldown and self.cooled(g):
+                    continue
+                members = self._groups[g]
+                choice = random.choice(members)
+                if choice in exclude:
+                    rest = [n for n in members if n not in exclude]
+                    if not rest:
+                        continue
+                    choice = random.choice(rest)
+                return choice
+            if attempt == 0:
+                # в текущем круге подходящих нет — начинаем новый
+                self._refill()
+        return None
+
+
+STRATEGIES = ("random", "weighted", "fifo", "bag")
+
+
+def make_selector(kind: str, weights: Optional[dict] = None, cooldown: int = 0) -> Selector:
+    kind = (kind or "random").strip().lower()
+    if kind in ("random", "weighted"):
+        return WeightedSelector(weights if kind == "weighted" else None, cooldown)
+    if kind == "fifo":
+        return FifoSelector(cooldown)
+    if kind == "bag":
+        return BagSelector(cooldown)
+    raise ValueError(f"Неизвестная стратегия выбора «{kind}», доступны: {', '.join(STRATEGIES)}")
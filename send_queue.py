@@ -0,0 +1,140 @@
+"""
+Очередь исходящих сообщений Telegram с учётом flood control.
+
+Подключается к сессии бота как request-middleware, поэтому через неё идут
+все отправки — и посты в канал, и msg.answer в командах — без правок в
+местах вызова. Ограничения (по FAQ Telegram): не больше ~30 сообщений в
+секунду всего, в группу/канал — не чаще раза в несколько секунд, в личный
+чат — примерно раз в секунду. Альбом считается за столько сообщений,
+сколько в нём файлов.
+
+Ожидающие отправки выходят по приоритету: посты раньше ответов админу,
+ответы — раньше фоновых загрузок (предзагрузка file_id). Чат, который ещё
+не готов, не задерживает остальные. На TelegramRetryAfter чат ставится на
+паузу на указанное сервером время, и сообщение уходит повторно.
+"""
+import asyncio
+import contextlib
+import contextvars
+import itertools
+import logging
+import time
+from typing import Optional
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_POST = 0         # публикация в канал (по расписанию или /post)
+PRIORITY_REPLY = 1        # ответы на команды, отчёты загрузок
+PRIORITY_BACKGROUND = 2   # предзагрузка в служебный чат
+
+_priority: contextvars.ContextVar[int] = contextvars.ContextVar("send_priority", default=PRIORITY_REPLY)
+
+
+@contextlib.contextmanager
+def send_priority(level: int):
+    """Все отправки внутри блока (и в задачах, созданных в нём) идут с этим приоритетом."""
+    token = _priority.set(level)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+def _is_send(method) -> bool:
+    """Создаёт ли метод сообщение в чате (только такие считаются в лимитах Telegram)."""
+    name = method.__api_method__
+    return name.startswith(("send", "copy", "forward")) and getattr(method, "chat_id", None) is not None
+
+
+def _weight(method) -> int:
+    media = getattr(method, "media", None)
+    return len(media) if method.__api_method__ == "sendMediaGroup" and media else 1
+
+
+class SendQueue(BaseRequestMiddleware):
+    def __init__(self, global_rate: float = 30, group_interval: float = 3, private_interval: float = 1,
+                 max_retries: int = 5):
+        self.global_interval = 1 / global_rate if global_rate > 0 else 0.0
+        self.group_interval = group_interval
+        self.private_interval = private_interval
+        self.max_retries = max_retries
+        self._global_next = 0.0                    # monotonic: когда можно следующую отправку вообще
+        self._chat_next: dict[str, float] = {}     # monotonic: когда можно следующую в этот чат
+        self._waiting: list = []                   # (приоритет, порядок, чат, вес, future)
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._pump_task: Optional[asyncio.Task] = None
+        self.retried = 0                           # сколько раз ловили RetryAfter (для /status)
+
+    def chat_interval(self, chat: str) -> float:
+        # личные чаты — положительные id; группы и каналы — отрицательные или @username
+        return self.private_interval if chat.isdigit() else self.group_interval
+
+    async def __call__(self, make_request, bot, method):
+        if not _is_send(method):
+            return await make_request(bot, method)
+        chat = str(method.chat_id)
+        prio = _priority.get()
+        weight = _weight(method)
+        order = next(self._seq)   # повтор после RetryAfter не теряет место среди равных по приоритету
+        for attempt in range(self.max_retries + 1):
+            await self._turn(chat, prio, order, weight)
+            try:
+                return await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                logger.warning("Flood control в %s (%s): ждём %d с и повторяем", chat, method.__api_method__,
+                               e.retry_after)
+                self.pause(chat, e.retry_after)
+
+    def pause(self, chat: str, seconds: float) -> None:
+        """Не отправлять в chat ближайшие seconds секунд (очередь при этом не стоит)."""
+        self._chat_next[chat] = max(self._chat_next.get(chat, 0.0), time.monotonic() + seconds)
+        self._wakeup.set()
+
+    async def _turn(self, chat: str, prio: int, order: int, weight: int) -> None:
+        """Ждёт своей очереди: по приоритету, с учётом лимитов чата и общего."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiting.append((prio, order, chat, weight, fut))
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+        self._wakeup.set()
+        await fut
+
+    async def _pump(self) -> None:
+        while self._waiting:
+            self._wakeup.clear()
+            wait = self._grant_next()
+            if wait is not None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+
+    def _grant_next(self) -> Optional[float]:
+        """
+        Пропускает первого по приоритету ждущего, чей чат уже готов.
+        Возвращает None, если пропустил, иначе — сколько ждать до ближайшей готовности.
+        """
+        now = time.monotonic()
+        if self._global_next > now:
+            return self._global_next - now
+        self._waiting = [w for w in self._waiting if not w[4].done()]   # отменённые ожидания
+        ready = [w for w in self._waiting if self._chat_next.get(w[2], 0.0) <= now]
+        if not ready:
+            return min((self._chat_next[w[2]] - now for w in self._waiting), default=None)
+        item = min(ready)
+        self._waiting.remove(item)
+        _, _, chat, weight, fut = item
+        self._chat_next[chat] = now + self.chat_interval(chat) * weight
+        self._global_next = now + self.global_interval * weight
+        fut.set_result(None)
+        return None
+
+    def describe(self) -> str:
+        return f"в очереди {len(self._waiting)}, повторов после flood control {self.retried}"
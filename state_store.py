@@ -0,0 +1,284 @@
+"""
+Надёжное хранилище состояния бота на SQLite (вместо перезаписи state.json целиком).
+
+Каждое значение лежит отдельной строкой, поэтому /post или /settime меняют
+только свои ключи. Транзакции SQLite дают атомарность: после падения в файле
+либо старое, либо новое значение, но не обрезанный JSON.
+"""
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+LRU_TOUCH_SEC = 3600   # file_id_get обновляет last_used не чаще раза в час
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS file_ids (
+    digest    TEXT PRIMARY KEY,       -- sha256 содержимого
+    file_id   TEXT NOT NULL,          -- Telegram file_id
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS file_ids_last_used ON file_ids(last_used);
+CREATE TABLE IF NOT EXISTS history (
+    id           INTEGER PRIMARY KEY,
+    work_key     TEXT NOT NULL,       -- pixiv:<id> / deviantart:<id> / нормализованный URL; '' если источника нет
+    page         INTEGER NOT NULL,    -- номер страницы (_pN), 0 для одиночных
+    content_hash TEXT NOT NULL,       -- sha256 файла
+    file_name    TEXT NOT NULL,       -- имя в очереди на момент публикации
+    posted_ts    REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS history_work ON history(work_key, page);
+CREATE INDEX IF NOT EXISTS history_hash ON history(content_hash);
+CREATE INDEX IF NOT EXISTS history_ts ON history(posted_ts);
+CREATE TABLE IF NOT EXISTS deliveries (
+    content_hash TEXT NOT NULL,       -- sha256 файла, ещё не перенесённого в used
+    chat_id      TEXT NOT NULL,       -- канал, который его уже получил
+    sent_ts      REAL NOT NULL,
+    PRIMARY KEY (content_hash, chat_id)
+);
+CREATE TABLE IF NOT EXISTS phashes (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    method   TEXT NOT NULL,
+    hash     TEXT NOT NULL            -- hex: 64-битный хэш не влезает в знаковый INTEGER
+);
+CREATE TABLE IF NOT EXISTS checks (
+    path     TEXT PRIMARY KEY,
+    size     INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    reason   TEXT NOT NULL            -- '' — файл годится, иначе почему нет
+);
+"""
+
+
+class StateStore:
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        # NORMAL под WAL: после падения процесса или ОС база целая, в худшем случае теряется последний commit;
+        # FULL давал бы fsync на каждую запись (кэш file_id, проверки, хэши), а их делает и бот во время поста
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.executescript(SCHEMA)
+
+    def close(self) -> None:
+        with self._lock:
+            self._db.close()
+
+    def _write(self, sql: str, params_seq) -> None:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.executemany(sql, params_seq)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    # ---------- ключ-значение (состояние планировщика и т.п.) ----------
+
+    def get(self, key: str, default: Any = None) -> Any:
+        with self._lock:
+            row = self._db.execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def get_all(self) -> dict:
+        with self._lock:
+            rows = self._db.execute("SELECT key, value FROM kv").fetchall()
+        return {k: json.loads(v) for k, v in rows}
+
+    def set_many(self, values: dict) -> None:
+        self._write(
+            "INSERT INTO kv(key, value) VALUES(?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+            [(k, json.dumps(v, ensure_ascii=False)) for k, v in values.items()],
+        )
+
+    # ---------- кэш file_id ----------
+
+    def file_id_get(self, digest: str) -> Optional[str]:
+        with self._lock:
+            row = self._db.execute("SELECT file_id, last_used FROM file_ids WHERE digest = ?", (digest,)).fetchone()
+            now = time.time()
+            if row and now - row[1] > LRU_TOUCH_SEC:
+                # свежесть для LRU-вытеснения; точнее часа она не нужна, а запись на каждое чтение — лишняя
+                self._db.execute("UPDATE file_ids SET last_used = ? WHERE digest = ?", (now, digest))
+        return row[0] if row else None
+
+    def file_id_put(self, digest: str, file_id: str, max_size: int) -> None:
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                self._db.execute(
+                    "INSERT INTO file_ids(digest, file_id, last_used) VALUES(?, ?, ?) "
+                    "ON CONFLICT(digest) DO UPDATE SET file_id = excluded.file_id, last_used = excluded.last_used",
+                    (digest, file_id, time.time()),
+                )
+                # LRU: оставляем max_size самых свежих
+                self._db.execute(
+                    "DELETE FROM file_ids WHERE digest IN ("
+                    " SELECT digest FROM file_ids ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                    (max_size,),
+                )
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def file_id_drop(self, digest: str) -> None:
+        self._write("DELETE FROM file_ids WHERE digest = ?", [(digest,)])
+
+    def file_id_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM file_ids").fetchone()[0]
+
+    # ---------- история публикаций ----------
+
+    def history_add(self, work_key: str, page: int, content_hash: str, file_name: str, posted_ts: float) -> None:
+        self._write(
+            "INSERT INTO history(work_key, page, content_hash, file_name, posted_ts) VALUES(?, ?, ?, ?, ?)",
+            [(work_key, page, content_hash, file_name, posted_ts)],
+        )
+
+    def history_find_work(self, work_key: str, page: Optional[int] = None) -> Optional[tuple[str, float]]:
+        """Последняя публикация работы (или конкретной её страницы): (имя файла, время) или None."""
+        if not work_key:
+            return None
+        sql = "SELECT file_name, posted_ts FROM history WHERE work_key = ?"
+        params: tuple = (work_key,)
+        if page is not None:
+            sql += " AND page = ?"
+            params += (page,)
+        with self._lock:
+            row = self._db.execute(sql + " ORDER BY posted_ts DESC LIMIT 1", params).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def history_find_hash(self, content_hash: str) -> Optional[tuple[str, float]]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT file_name, posted_ts FROM history WHERE content_hash = ? ORDER BY posted_ts DESC LIMIT 1",
+                (content_hash,),
+            ).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def history_recent(self, limit: int) -> list[str]:
+        """Имена файлов последних limit публикаций, новые первыми."""
+        if limit <= 0:
+            return []
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT file_name FROM history ORDER BY posted_ts DESC LIMIT ?", (limit,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def history_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+
+    # ---------- доставка по каналам (пока пост не выполнил FANOUT_POLICY) ----------
+
+    def delivered_get(self, content_hash: str) -> set[str]:
+        """Каналы, уже получившие этот файл при прошлых попытках."""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT chat_id FROM deliveries WHERE content_hash = ?", (content_hash,)
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def delivered_add(self, content_hashes: list[str], chats: list[str], sent_ts: float) -> None:
+        self._write(
+            "INSERT OR REPLACE INTO deliveries(content_hash, chat_id, sent_ts) VALUES(?, ?, ?)",
+            [(h, c, sent_ts) for h in content_hashes for c in chats],
+        )
+
+    def delivered_drop(self, content_hashes: list[str]) -> None:
+        """Пост засчитан (файлы в used, запись в history) — отметки по каналам больше не нужны."""
+        self._write("DELETE FROM deliveries WHERE content_hash = ?", [(h,) for h in content_hashes])
+
+    # ---------- перцептивные хэши (кэш по пути + размеру + mtime) ----------
+
+    def phash_get(self, path: str, size: int, mtime_ns: int, method: str) -> Optional[int]:
+        with self._lock:
+            row = self._db.execute(
+                "SELECT hash FROM phashes WHERE path = ? AND size = ? AND mtime_ns = ? AND method = ?",
+                (path, size, mtime_ns, method),
+            ).fetchone()
+        return int(row[0], 16) if row else None
+
+    def phash_put(self, path: str, size: int, mtime_ns: int, method: str, h: int) -> None:
+        self._write(
+            "INSERT OR REPLACE INTO phashes(path, size, mtime_ns, method, hash) VALUES(?, ?, ?, ?, ?)",
+            [(path, size, mtime_ns, method, format(h, "x"))],
+        )
+
+    def phash_rename(self, old_path: str, new_path: str, new_mtime_ns: int) -> None:
+        """Файл переехал (move_used, карантин): содержимое то же, переносим запись."""
+        self._write(
+            "UPDATE OR REPLACE phashes SET path = ?, mtime_ns = ? WHERE path = ?",
+            [(new_path, new_mtime_ns, old_path)],
+        )
+
+    def phash_drop(self, path: str) -> None:
+        """Файл ушёл из очереди не в used (дубликат, карантин) — в индексе он больше не нужен."""
+        self._write("DELETE FROM phashes WHERE path = ?", [(path,)])
+
+    # ---------- проверка файлов очереди ----------
+
+    def check_get(self, path: str, size: int, mtime_ns: int) -> Optional[str]:
+        """Результат прошлой проверки того же файла ('' — годится) или None, если не проверялся/изменился."""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT reason FROM checks WHERE path = ? AND size = ? AND mtime_ns = ?",
+                (path, size, mtime_ns),
+            ).fetchone()
+        return row[0] if row else None
+
+    def check_put(self, path: str, size: int, mtime_ns: int, reason: str) -> None:
+        self._write(
+            "INSERT OR REPLACE INTO checks(path, size, mtime_ns, reason) VALUES(?, ?, ?, ?)",
+            [(path, size, mtime_ns, reason)],
+        )
+
+    def check_drop(self, path: str) -> None:
+        """Файл ушёл из очереди (опубликован, дубликат, карантин) — запись больше не нужна."""
+        self._write("DELETE FROM checks WHERE path = ?", [(path,)])
+
+    # ---------- миграция со старых JSON-файлов ----------
+
+    def import_legacy(self, state_json: Path, file_ids_json: Path) -> list[str]:
+        """
+        Однократно переносит state.json и file_ids.json, если хранилище ещё пустое.
+        Старые файлы переименовываются в *.migrated. Возвращает список перенесённого.
+        """
+        done = []
+        if state_json.exists() and not self.get_all():
+            try:
+                data = json.loads(state_json.read_text(encoding="utf-8"))
+            except Exception:
+                data = None
+            if isinstance(data, dict):
+                self.set_many(data)
+                state_json.rename(state_json.with_name(state_json.name + ".migrated"))
+                done.append(state_json.name)
+        if file_ids_json.exists() and not self.file_id_count():
+            try:
+                data = json.loads(file_ids_json.read_text(encoding="utf-8"))
+            except Exception:
+                data = None
+            if isinstance(data, dict):
+                now = time.time()
+                # порядок в JSON был LRU (старые первыми) — сохраняем его через last_used
+                self._write(
+                    "INSERT OR REPLACE INTO file_ids(digest, file_id, last_used) VALUES(?, ?, ?)",
+                    [(d, fid, now - len(data) + i) for i, (d, fid) in enumerate(data.items())],
+                )
+                file_ids_json.rename(file_ids_json.with_name(file_ids_json.name + ".migrated"))
+                done.append(file_ids_json.name)
+        return done